@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+对比逐个插入、在一个事务中逐个插入和 insert_many 批量插入的速度
+
+运行方式: python -m benchmarks.batch_insert -n 100000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from gbplustree import BPlusTree
+
+
+def single_inserts(tree: BPlusTree, items: list):
+    for key, value in items:
+        tree.insert(key, value)
+
+
+def transaction_inserts(tree: BPlusTree, items: list):
+    with tree.transaction():
+        for key, value in items:
+            tree.insert(key, value)
+
+
+def insert_many(tree: BPlusTree, items: list):
+    tree.insert_many(items)
+
+
+def run(method, items: list, order: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.db')
+        with BPlusTree(filename, order=order) as tree:
+            start = time.perf_counter()
+            method(tree, items)
+            elapsed = time.perf_counter() - start
+            assert len(tree) == len(items)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=10000)
+    parser.add_argument('--order', type=int, default=50)
+    parser.add_argument('--skip-single', action='store_true',
+                        help='不运行逐个插入，n 很大时它需要很长时间')
+    args = parser.parse_args()
+
+    value = b'x' * 16
+    workloads = {
+        'append': [(i, value) for i in range(args.n)],
+        'random': [(i, value) for i in
+                   random.Random(0).sample(range(args.n * 10), args.n)],
+    }
+    methods = {
+        'transaction': transaction_inserts,
+        'insert_many': insert_many,
+    }
+    if not args.skip_single:
+        methods = dict(single=single_inserts, **methods)
+
+    print('{:<8} {:<12} {:>10} {:>14}'.format(
+        'workload', 'method', 'seconds', 'inserts/s'
+    ))
+    for name, items in workloads.items():
+        for method_name, method in methods.items():
+            elapsed = run(method, items, args.order)
+            print('{:<8} {:<12} {:>10.3f} {:>14,.0f}'.format(
+                name, method_name, elapsed, len(items) / elapsed
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+对比两次基准测试的 JSON 结果，列出每个用例的速度变化
+
+变慢超过 threshold 的用例被标记为回退，有回退时退出码为 1，可以用在 CI 中。
+
+运行方式: python -m benchmarks.compare before.json after.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+
+def load_results(filename: str) -> tuple:
+    with open(filename) as f:
+        report = json.load(f)
+    results = {r['name']: r for r in report['results']}
+    return report['environment'].get('commit'), results
+
+
+def compare(before: dict, after: dict, threshold: float) -> tuple:
+    """ 返回 ([(名字, 之前, 之后, 比值, 是否回退)], 回退的个数) """
+    rows = []
+    regressions = 0
+    for name, result in after.items():
+        if name not in before:
+            continue
+        old = before[name]['ops_per_sec']
+        new = result['ops_per_sec']
+        ratio = new / old
+        regressed = ratio < 1 - threshold
+        regressions += regressed
+        rows.append((name, old, new, ratio, regressed))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='ops/s 下降超过这个比例时认为是回退')
+    args = parser.parse_args()
+
+    before_commit, before = load_results(args.before)
+    after_commit, after = load_results(args.after)
+    rows, regressions = compare(before, after, args.threshold)
+
+    width = max((len(row[0]) for row in rows), default=4)
+    print('{:<{width}} {:>14} {:>14} {:>8}'.format(
+        'name', before_commit or 'before', after_commit or 'after', 'ratio',
+        width=width
+    ))
+    for name, old, new, ratio, regressed in rows:
+        print('{:<{width}} {:>14,.0f} {:>14,.0f} {:>7.2f}x{}'.format(
+            name, old, new, ratio, '  REGRESSION' if regressed else '',
+            width=width
+        ))
+    missing = sorted(set(before) ^ set(after))
+    if missing:
+        print('Only in one of the files: {}'.format(', '.join(missing)))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
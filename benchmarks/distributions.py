@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试和负载测试使用的键分布，都接受一个 random.Random，结果可以复现
+"""
+
+import random
+
+
+class UniformGenerator:
+    """ [0, n) 中均匀分布的整数 """
+
+    __slots__ = ['n', '_rng']
+
+    def __init__(self, n: int, rng: random.Random):
+        self.n = n
+        self._rng = rng
+
+    def next(self) -> int:
+        return self._rng.randrange(self.n)
+
+
+class ZipfianGenerator:
+    """ [0, n) 中 Zipf 分布的整数，0 出现的次数最多
+
+    使用 YCSB 中的方法 (Gray et al., Quickly Generating Billion-Record
+    Synthetic Databases)，创建时计算一次 zeta(n)，之后每次 O(1)。
+    scrambled 为 True 时把结果打散到整个区间，热点的键不再相邻。
+    """
+
+    __slots__ = ['n', 'theta', 'scrambled', '_rng', '_alpha', '_zetan',
+                 '_eta', '_half_pow_theta']
+
+    THETA = 0.99
+
+    def __init__(self, n: int, rng: random.Random, theta: float = THETA,
+                 scrambled: bool = False):
+        self.n = n
+        self.theta = theta
+        self.scrambled = scrambled
+        self._rng = rng
+        self._zetan = self._zeta(n, theta)
+        zeta2 = self._zeta(2, theta)
+        self._alpha = 1 / (1 - theta)
+        self._eta = ((1 - (2 / n) ** (1 - theta))
+                     / (1 - zeta2 / self._zetan))
+        self._half_pow_theta = 1 + 0.5 ** theta
+
+    @staticmethod
+    def _zeta(n: int, theta: float) -> float:
+        return sum(1 / (i ** theta) for i in range(1, n + 1))
+
+    def next(self) -> int:
+        u = self._rng.random()
+        uz = u * self._zetan
+        if uz < 1:
+            rv = 0
+        elif uz < self._half_pow_theta:
+            rv = 1
+        else:
+            rv = int(self.n * (self._eta * u - self._eta + 1) ** self._alpha)
+            rv = min(rv, self.n - 1)
+        if self.scrambled:
+            rv = fnv_hash(rv) % self.n
+        return rv
+
+
+class LatestGenerator:
+    """ 偏向最近插入的键，最新的键出现的次数最多
+
+    last 是当前最大的键，插入新的键之后由调用者更新
+    """
+
+    __slots__ = ['last', '_zipfian']
+
+    def __init__(self, n: int, rng: random.Random):
+        self.last = n - 1
+        self._zipfian = ZipfianGenerator(n, rng)
+
+    def next(self) -> int:
+        return max(self.last - self._zipfian.next(), 0)
+
+
+def fnv_hash(value: int) -> int:
+    """ 64 位 FNV-1a，把相邻的整数打散 """
+    h = 0xcbf29ce484222325
+    for _ in range(8):
+        h ^= value & 0xff
+        h = (h * 0x100000001b3) & 0xffffffffffffffff
+        value >>= 8
+    return h
+
+
+DISTRIBUTIONS = {
+    'uniform': UniformGenerator,
+    'zipfian': lambda n, rng: ZipfianGenerator(n, rng, scrambled=True),
+    'latest': LatestGenerator,
+}
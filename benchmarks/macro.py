@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+宏基准测试: 在几组 order/page_size 下运行整棵树上的负载
+
+负载:
+    insert.sequential / insert.random / insert.zipfian  插入 (zipfian 是覆盖写)
+    get.point                                           随机读取存在的键
+    scan.range                                          从随机位置开始遍历 100 个键
+    mixed                                               50% 读取，50% 覆盖写
+
+写入每 batch 个操作放在一个事务中提交，结果不会只反映 fsync 的速度。
+键和操作的顺序由 seed 决定，结果以 JSON 输出。
+
+运行方式: python -m benchmarks.macro -n 20000 --configs 50:4096,200:16384
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from gbplustree import BPlusTree
+from gbplustree.metrics import Histogram
+
+from .distributions import ZipfianGenerator
+from .report import write_report, print_table
+
+SCAN_LENGTH = 100
+VALUE = b'v' * 16
+
+
+def run_ops(tree: BPlusTree, ops: list, batch: int) -> Histogram:
+    """ 执行 [(函数, 参数)]，每 batch 个操作一个事务，返回每个操作的耗时 """
+    histogram = Histogram()
+    for i in range(0, len(ops), batch):
+        with tree.transaction():
+            for func, args in ops[i:i + batch]:
+                start = time.perf_counter()
+                func(*args)
+                histogram.record(time.perf_counter() - start)
+    return histogram
+
+
+def scan(tree: BPlusTree, start: int):
+    for _ in zip(range(SCAN_LENGTH), tree.scan(start, projection='keys')):
+        pass
+
+
+def build_ops(tree: BPlusTree, name: str, n: int,
+              rng: random.Random) -> list:
+    """ 返回负载 name 的操作列表 [(函数, 参数)] """
+    insert = tree.insert
+    if name == 'insert.sequential':
+        return [(insert, (k, VALUE)) for k in range(n)]
+    if name == 'insert.random':
+        return [(insert, (k, VALUE)) for k in rng.sample(range(n), n)]
+    if name == 'insert.zipfian':
+        zipfian = ZipfianGenerator(n, rng, scrambled=True)
+        return [(insert, (zipfian.next(), VALUE, True)) for _ in range(n)]
+    if name == 'get.point':
+        return [(tree.get, (rng.randrange(n),)) for _ in range(n)]
+    if name == 'scan.range':
+        return [(scan, (tree, rng.randrange(n)))
+                for _ in range(n // SCAN_LENGTH)]
+    if name == 'mixed':
+        return [
+            (tree.get, (rng.randrange(n),)) if rng.random() < 0.5
+            else (insert, (rng.randrange(n), VALUE, True))
+            for _ in range(n)
+        ]
+    raise ValueError('Unknown workload {}'.format(name))
+
+
+# 负载的名字 -> 是否需要先加载 n 个键
+WORKLOADS = {
+    'insert.sequential': False,
+    'insert.random': False,
+    'insert.zipfian': False,
+    'get.point': True,
+    'scan.range': True,
+    'mixed': True,
+}
+
+
+def run_config(n: int, order: int, page_size: int, cache_size: int,
+               batch: int, seed: int, selected: str) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, preload in WORKLOADS.items():
+            if selected not in name:
+                continue
+            filename = os.path.join(directory, name + '.db')
+            with BPlusTree(filename, order=order, page_size=page_size,
+                           cache_size=cache_size) as tree:
+                if preload:
+                    tree.insert_many((k, VALUE) for k in range(n))
+                ops = build_ops(tree, name, n, random.Random(seed))
+                start = time.perf_counter()
+                histogram = run_ops(tree, ops, batch)
+                elapsed = time.perf_counter() - start
+
+            results.append({
+                'name': '{}/order={},page_size={}'.format(
+                    name, order, page_size
+                ),
+                'workload': name,
+                'order': order,
+                'page_size': page_size,
+                'ops': len(ops),
+                'seconds': elapsed,
+                'ops_per_sec': len(ops) / elapsed,
+                'p50': histogram.percentile(50),
+                'p99': histogram.percentile(99),
+                'max': histogram.max,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000,
+                        help='键的个数，也是每个负载的操作次数')
+    parser.add_argument('--configs', default='50:4096,100:8192,200:16384',
+                        help='逗号分隔的 order:page_size')
+    parser.add_argument('--cache-size', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='每个事务中的操作次数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-k', dest='filter', default='',
+                        help='只运行名字中包含这个字符串的负载')
+    parser.add_argument('-o', '--output', help='JSON 输出文件，默认标准输出')
+    args = parser.parse_args()
+
+    results = []
+    for config in args.configs.split(','):
+        order, page_size = (int(x) for x in config.split(':'))
+        results.extend(run_config(args.n, order, page_size, args.cache_size,
+                                  args.batch, args.seed, args.filter))
+
+    print_table(results)
+    write_report('macro', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
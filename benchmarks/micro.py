@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+微基准测试: Record、Reference、各种节点的 load/dump 和每个 Serializer
+
+每个用例运行 repeat 轮，取最快的一轮，结果以 JSON 输出。
+
+运行方式: python -m benchmarks.micro -o micro.json
+"""
+
+import argparse
+import datetime
+import random
+import timeit
+import uuid
+
+from gbplustree.const import TreeConf
+from gbplustree.entry import Record, Reference
+from gbplustree.node import (
+    LonelyRootNode,
+    RootNode,
+    InternalNode,
+    LeafNode,
+    FreelistNode,
+    Node,
+)
+from gbplustree.serializer import (
+    IntSerializer,
+    StrSerializer,
+    UUIDSerializer,
+    DatetimeUTCSerializer,
+    SignedIntSerializer,
+    FloatSerializer,
+    DatetimeMicrosSerializer,
+    FixedWidthSerializer,
+)
+
+from .report import write_report, print_table
+
+
+def entry_cases(tree_conf: TreeConf) -> dict:
+    record = Record(tree_conf, 42, b'x' * (tree_conf.value_size // 2))
+    reference = Reference(tree_conf, 42, 7, 8)
+    record_data = record.dump()
+    reference_data = reference.dump()
+    return {
+        'record.dump': record.dump,
+        'record.load': lambda: Record(tree_conf, data=record_data),
+        'reference.dump': reference.dump,
+        'reference.load': lambda: Reference(tree_conf, data=reference_data),
+    }
+
+
+def node_cases(tree_conf: TreeConf) -> dict:
+    keys = sorted(random.Random(0).sample(range(10 ** 9), tree_conf.order))
+    value = b'x' * (tree_conf.value_size // 2)
+    leaf_entries = [Record(tree_conf, k, value) for k in keys[:-1]]
+    reference_entries = [Reference(tree_conf, k, i + 1, i + 2)
+                         for i, k in enumerate(keys[:-1])]
+
+    nodes = [
+        LonelyRootNode(tree_conf, page=1),
+        LeafNode(tree_conf, page=1, next_page=2, prev_page=3),
+        RootNode(tree_conf, page=1),
+        InternalNode(tree_conf, page=1),
+        FreelistNode(tree_conf, page=1, next_page=2),
+    ]
+    cases = dict()
+    for node in nodes:
+        if isinstance(node, FreelistNode):
+            node.entries = list(range(node.max_children))
+        elif isinstance(node, (LonelyRootNode, LeafNode)):
+            node.entries = list(leaf_entries)
+        else:
+            node.entries = list(reference_entries)
+        data = bytes(node.dump())
+        name = 'node.{}'.format(type(node).__name__)
+        cases[name + '.dump'] = node.dump
+        cases[name + '.load'] = (
+            lambda data=data: Node.from_page_data(tree_conf, data, page=1)
+        )
+    return cases
+
+
+def serializer_cases() -> dict:
+    values = [
+        (IntSerializer(), 2 ** 40, 8),
+        (StrSerializer(), 'gbplustree-key', 16),
+        (UUIDSerializer(), uuid.UUID(int=2 ** 100), 16),
+        (SignedIntSerializer(), -2 ** 40, 8),
+        (FloatSerializer(), -1234.5, 8),
+        (DatetimeMicrosSerializer(), datetime.datetime(
+            2018, 4, 17, tzinfo=datetime.timezone.utc
+        ), 8),
+    ]
+    try:
+        values.append((
+            DatetimeUTCSerializer(),
+            datetime.datetime(2018, 4, 17, tzinfo=datetime.timezone.utc), 16
+        ))
+    except RuntimeError:
+        # 没有安装 temporenc
+        pass
+
+    cases = dict()
+    for serializer, value, key_size in values:
+        data = serializer.serialize(value, key_size)
+        name = 'serializer.{}'.format(type(serializer).__name__)
+        cases[name + '.serialize'] = (
+            lambda s=serializer, v=value, k=key_size: s.serialize(v, k)
+        )
+        cases[name + '.deserialize'] = (
+            lambda s=serializer, d=data: s.deserialize(d)
+        )
+        if isinstance(serializer, FixedWidthSerializer):
+            # 每次处理 100 个键，结果是每个键的速度
+            many = [value] * 100
+            batch = serializer.serialize_many(many)
+            cases[name + '.serialize_many'] = (
+                lambda s=serializer, v=many: s.serialize_many(v)
+            )
+            cases[name + '.deserialize_many'] = (
+                lambda s=serializer, b=batch: s.deserialize_many(b)
+            )
+    return cases
+
+
+def run_case(func, number: int, repeat: int) -> float:
+    """ 返回最快的一轮中每次调用的秒数 """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--order', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=8192)
+    parser.add_argument('--number', type=int, default=1000,
+                        help='每一轮调用的次数，节点的用例除以 order')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-k', dest='filter', default='',
+                        help='只运行名字中包含这个字符串的用例')
+    parser.add_argument('-o', '--output', help='JSON 输出文件，默认标准输出')
+    args = parser.parse_args()
+
+    tree_conf = TreeConf(args.page_size, args.order, 8, 32, IntSerializer())
+    cases = dict()
+    cases.update(entry_cases(tree_conf))
+    cases.update(serializer_cases())
+    node_cases_ = node_cases(tree_conf)
+    cases.update(node_cases_)
+
+    results = []
+    for name, func in cases.items():
+        if args.filter not in name:
+            continue
+        number = args.number
+        if name in node_cases_:
+            number = max(1, number // args.order * 10)
+        seconds = run_case(func, number, args.repeat)
+        if name.endswith('_many'):
+            seconds /= 100
+        results.append({
+            'name': name,
+            'seconds_per_op': seconds,
+            'ops_per_sec': 1 / seconds,
+        })
+
+    print_table(results)
+    write_report('micro', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
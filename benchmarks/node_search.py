@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+对比节点内的二分查找和插值查找
+
+先在一个大的叶子节点中直接查找，再在整棵树上用 get 查找，
+键分别是均匀分布和偏斜 (指数分布) 的整数。
+
+运行方式: python -m benchmarks.node_search -n 100000 --order 400
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from gbplustree import BPlusTree
+from gbplustree.const import TreeConf, SEARCH_STRATEGIES
+from gbplustree.entry import Record
+from gbplustree.node import LeafNode
+from gbplustree.serializer import IntSerializer
+
+
+def make_keys(distribution: str, n: int, rng: random.Random) -> list:
+    if distribution == 'uniform':
+        return rng.sample(range(n * 100), n)
+    keys = {int(rng.expovariate(1 / n) * 1000) for _ in range(n * 2)}
+    return rng.sample(sorted(keys), min(n, len(keys)))
+
+
+def node_lookups(search: str, keys: list, order: int, lookups: int,
+                 rng: random.Random) -> float:
+    conf = TreeConf(4096, order, 8, 8, IntSerializer(), search=search)
+    node = LeafNode(conf)
+    node.entries = [Record(conf, k, b'') for k in sorted(keys[:order - 1])]
+    probes = [rng.choice(node.entries).key for _ in range(lookups)]
+
+    start = time.perf_counter()
+    for key in probes:
+        node.find_index(key)
+    return time.perf_counter() - start
+
+
+def tree_lookups(search: str, keys: list, order: int, lookups: int,
+                 rng: random.Random) -> float:
+    probes = [rng.choice(keys) for _ in range(lookups)]
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.db')
+        with BPlusTree(filename, order=order, page_size=16384, value_size=8,
+                       cache_size=100000, search=search) as tree:
+            tree.insert_many((k, b'x') for k in sorted(keys))
+            for key in probes[:1000]:
+                tree.get(key)
+
+            start = time.perf_counter()
+            for key in probes:
+                tree.get(key)
+            return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000,
+                        help='树中键的个数')
+    parser.add_argument('--order', type=int, default=400)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('{:<8} {:<6} {:<14} {:>10} {:>14}'.format(
+        'keys', 'scope', 'search', 'seconds', 'lookups/s'
+    ))
+    for distribution in ('uniform', 'skewed'):
+        keys = make_keys(distribution, args.n, random.Random(0))
+        for scope, bench in (('node', node_lookups), ('tree', tree_lookups)):
+            for search in SEARCH_STRATEGIES:
+                elapsed = bench(search, keys, args.order, args.lookups,
+                                random.Random(1))
+                print('{:<8} {:<6} {:<14} {:>10.3f} {:>14,.0f}'.format(
+                    distribution, scope, search, elapsed,
+                    args.lookups / elapsed
+                ))
+
+
+if __name__ == '__main__':
+    main()
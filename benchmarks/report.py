@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试的 JSON 输出，micro 和 macro 的结果都使用这个格式，
+可以用 python -m benchmarks.compare 对比两次提交的结果
+"""
+
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from typing import Optional
+
+
+def git_commit() -> Optional[str]:
+    """ 当前的 git 提交，不在 git 仓库中时返回 None """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> dict:
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def write_report(suite: str, params: dict, results: list,
+                 output: Optional[str] = None):
+    """ 把结果写入 output，output 为 None 或者 '-' 时写到标准输出
+
+    每个结果都有唯一的 name 和越大越好的 ops_per_sec，compare 用它们对比
+    """
+    report = {
+        'suite': suite,
+        'environment': environment(),
+        'params': params,
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if output is None or output == '-':
+        sys.stdout.write(data + '\n')
+    else:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+
+
+def print_table(results: list):
+    """ 在标准错误中打印一个便于阅读的表格，不影响标准输出中的 JSON """
+    width = max(len(r['name']) for r in results)
+    for r in results:
+        print('{:<{width}} {:>14,.0f} ops/s'.format(
+            r['name'], r['ops_per_sec'], width=width
+        ), file=sys.stderr)
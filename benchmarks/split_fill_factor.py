@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+对比顺序插入和随机插入时叶子节点的填充率
+
+运行方式: python -m benchmarks.split_fill_factor
+"""
+
+import argparse
+import os
+import random
+import tempfile
+
+from gbplustree import BPlusTree
+
+
+def leaf_fill_factor(tree: BPlusTree) -> tuple:
+    """ 遍历所有的叶子节点，返回 (叶子节点数, 平均填充率) """
+    node = tree._left_record_node
+    num_leaves = 0
+    num_entries = 0
+    while True:
+        num_leaves += 1
+        num_entries += len(node.entries)
+        if not node.next_page:
+            break
+        node = tree._mem.get_node(node.next_page)
+    return num_leaves, num_entries / (num_leaves * node.max_children)
+
+
+def run(keys: list, order: int) -> tuple:
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.db')
+        with BPlusTree(filename, order=order) as tree:
+            for key in keys:
+                tree.insert(key, b'')
+            num_leaves, fill_factor = leaf_fill_factor(tree)
+            tree.checkpoint()
+            file_size = os.path.getsize(filename)
+    return num_leaves, fill_factor, file_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000)
+    parser.add_argument('--order', type=int, default=50)
+    args = parser.parse_args()
+
+    workloads = {
+        'append': list(range(args.n)),
+        'random': random.Random(0).sample(range(args.n * 10), args.n),
+    }
+    print('{:<8} {:>8} {:>12} {:>12}'.format(
+        'workload', 'leaves', 'fill factor', 'file size'
+    ))
+    for name, keys in workloads.items():
+        num_leaves, fill_factor, file_size = run(keys, args.order)
+        print('{:<8} {:>8} {:>12.1%} {:>12}'.format(
+            name, num_leaves, fill_factor, file_size
+        ))
+
+
+if __name__ == '__main__':
+    main()
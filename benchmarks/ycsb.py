@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+YCSB 风格的负载测试
+
+先加载 --records 条记录 (树已经有数据时跳过)，然后用多个线程按照
+工作负载中读取、更新、插入、遍历和读改写的比例执行操作，
+每隔 --interval 秒打印这段时间的吞吐量和每种操作的延迟百分位数。
+
+工作负载和 YCSB 的 core workloads 相同:
+    a  50% read, 50% update            b  95% read, 5% update
+    c  100% read                       d  95% read, 5% insert (latest)
+    e  95% scan, 5% insert             f  50% read, 50% read-modify-write
+也可以用 --mix read=0.9,insert=0.1 自定义比例。
+
+使用多个进程时，每个进程打开自己的树文件 <filename>.<进程序号>，
+同一个树文件不能被多个进程同时写入。
+
+运行方式: python -m benchmarks.ycsb /tmp/ycsb.db -w a --records 100000
+          --operations 200000 --threads 4 --distribution zipfian
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+
+from gbplustree import BPlusTree
+from gbplustree.const import TreeConf
+from gbplustree.entry import Record
+from gbplustree.metrics import Histogram
+from gbplustree.serializer import IntSerializer
+
+from .distributions import (
+    UniformGenerator,
+    ZipfianGenerator,
+    LatestGenerator,
+    fnv_hash,
+)
+from .report import write_report
+
+OPERATIONS = ('read', 'update', 'insert', 'scan', 'rmw')
+
+WORKLOADS = {
+    'a': {'read': 0.5, 'update': 0.5},
+    'b': {'read': 0.95, 'update': 0.05},
+    'c': {'read': 1.0},
+    'd': {'read': 0.95, 'insert': 0.05},
+    'e': {'scan': 0.95, 'insert': 0.05},
+    'f': {'read': 0.5, 'rmw': 0.5},
+}
+
+# 没有指定 --distribution 时每个工作负载使用的键分布
+DEFAULT_DISTRIBUTIONS = {'d': 'latest'}
+
+# 加载时每个事务插入的记录数
+LOAD_BATCH = 100000
+
+
+def parse_mix(mix: str) -> dict:
+    """ 'read=0.9,insert=0.1' -> {'read': 0.9, 'insert': 0.1} """
+    rv = dict()
+    for part in mix.split(','):
+        operation, _, ratio = part.partition('=')
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation {}'.format(operation))
+        rv[operation] = float(ratio)
+    if not rv or sum(rv.values()) <= 0:
+        raise ValueError('Operation mix {} is empty'.format(mix))
+    return rv
+
+
+def fit_page_size(order: int, value_size: int) -> int:
+    """ 能放下 order 个记录的最小的 2 的幂的页大小 """
+    tree_conf = TreeConf(4096, order, 8, value_size, IntSerializer())
+    used = (order - 1) * Record(tree_conf).length + 12
+    page_size = 4096
+    while page_size <= used:
+        page_size *= 2
+    return page_size
+
+
+class KeySpace:
+    """ 一个进程中所有线程共享的键空间，第 i 条记录的键是 key(i) """
+
+    __slots__ = ['hashed', '_counter', '_lock', 'count']
+
+    def __init__(self, count: int, hashed: bool):
+        self.hashed = hashed
+        self.count = count
+        self._counter = itertools.count(count)
+        self._lock = threading.Lock()
+
+    def key(self, i: int) -> int:
+        return fnv_hash(i) if self.hashed else i
+
+    def next_insert(self) -> int:
+        with self._lock:
+            i = next(self._counter)
+            self.count = max(self.count, i + 1)
+        return i
+
+
+class Worker(threading.Thread):
+    """ 执行操作的线程，每种操作的延迟记录在 Histogram 中 """
+
+    def __init__(self, tree: BPlusTree, keys: KeySpace, args, seed: int,
+                 operations: int, deadline: float):
+        super().__init__(daemon=True)
+        self._tree = tree
+        self._keys = keys
+        self._args = args
+        self._rng = random.Random(seed)
+        self._operations = operations
+        self._deadline = deadline
+        self._values = [os.urandom(args.value_size) for _ in range(16)]
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+        mix = args.mix
+        self._choices = list(mix)
+        self._weights = list(itertools.accumulate(mix.values()))
+        if args.distribution == 'uniform':
+            self._generator = UniformGenerator(keys.count, self._rng)
+        elif args.distribution == 'zipfian':
+            self._generator = ZipfianGenerator(keys.count, self._rng,
+                                               scrambled=True)
+        else:
+            self._generator = LatestGenerator(keys.count, self._rng)
+
+    def take_histograms(self) -> dict:
+        """ 返回上一次调用之后的延迟，并重新开始记录 """
+        with self._lock:
+            rv, self._histograms = self._histograms, dict()
+        return rv
+
+    def run(self):
+        for _ in range(self._operations):
+            if self._deadline and time.monotonic() >= self._deadline:
+                return
+            operation = self._rng.choices(self._choices,
+                                          cum_weights=self._weights)[0]
+            start = time.perf_counter()
+            getattr(self, '_' + operation)()
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                histogram = self._histograms.get(operation)
+                if histogram is None:
+                    histogram = self._histograms[operation] = Histogram()
+                histogram.record(elapsed)
+
+    def _existing_key(self) -> int:
+        if isinstance(self._generator, LatestGenerator):
+            self._generator.last = self._keys.count - 1
+        return self._keys.key(self._generator.next())
+
+    def _value(self) -> bytes:
+        return self._rng.choice(self._values)
+
+    def _read(self):
+        self._tree.get(self._existing_key())
+
+    def _update(self):
+        self._tree.insert(self._existing_key(), self._value(), replace=True)
+
+    def _insert(self):
+        key = self._keys.key(self._keys.next_insert())
+        self._tree.insert(key, self._value(), replace=True)
+
+    def _scan(self):
+        length = self._rng.randint(1, self._args.max_scan_length)
+        records = self._tree.scan(self._existing_key(), projection='keys')
+        for _ in zip(range(length), records):
+            pass
+
+    def _rmw(self):
+        key = self._existing_key()
+        self._tree.get(key)
+        self._tree.insert(key, self._value(), replace=True)
+
+
+def load(tree: BPlusTree, keys: KeySpace, value_size: int):
+    value = os.urandom(value_size)
+    for start in range(0, keys.count, LOAD_BATCH):
+        stop = min(start + LOAD_BATCH, keys.count)
+        tree.insert_many((keys.key(i), value) for i in range(start, stop))
+
+
+def run_process(args, index: int, results):
+    """ 在一个进程中运行 --threads 个 Worker，定期把延迟放入 results 队列
+
+    放入的消息: ('interval', {操作: Histogram})，结束时 ('done', index)
+    """
+    filename = args.filename
+    if args.processes > 1:
+        filename = '{}.{}'.format(filename, index)
+    tree = BPlusTree(filename, order=args.order, page_size=args.page_size,
+                     key_size=8, value_size=args.value_size,
+                     cache_size=args.cache_size)
+    try:
+        if not tree:
+            keys = KeySpace(args.records, not args.ordered)
+            load(tree, keys, args.value_size)
+        else:
+            keys = KeySpace(len(tree), not args.ordered)
+
+        deadline = time.monotonic() + args.duration if args.duration else 0
+        per_thread = args.operations // args.threads
+        workers = [
+            Worker(tree, keys, args, seed=hash((args.seed, index, i)),
+                   operations=per_thread, deadline=deadline)
+            for i in range(args.threads)
+        ]
+        for worker in workers:
+            worker.start()
+
+        next_report = time.monotonic() + args.interval
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(max(0, next_report - time.monotonic()))
+                if time.monotonic() >= next_report:
+                    results.put(('interval', collect(workers)))
+                    next_report += args.interval
+        results.put(('interval', collect(workers)))
+    finally:
+        tree.close()
+        results.put(('done', index))
+
+
+def collect(workers: list) -> dict:
+    rv = dict()
+    for worker in workers:
+        for operation, histogram in worker.take_histograms().items():
+            rv.setdefault(operation, Histogram()).merge(histogram)
+    return rv
+
+
+def merge_into(target: dict, histograms: dict):
+    for operation, histogram in histograms.items():
+        target.setdefault(operation, Histogram()).merge(histogram)
+
+
+def format_line(elapsed: float, seconds: float, histograms: dict) -> str:
+    total = sum(h.count for h in histograms.values())
+    parts = ['[{:>6.1f}s] {:>10,.0f} ops/s'.format(elapsed, total / seconds)]
+    for operation in OPERATIONS:
+        h = histograms.get(operation)
+        if h is not None:
+            parts.append('{} {:,} p50 {:.2f} ms p99 {:.2f} ms'.format(
+                operation, h.count, h.percentile(50) * 1000,
+                h.percentile(99) * 1000
+            ))
+    return ' | '.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('filename', help='树文件，不存在时会被创建并加载')
+    parser.add_argument('-w', '--workload', choices=sorted(WORKLOADS),
+                        default='a')
+    parser.add_argument('--mix', type=parse_mix,
+                        help='自定义操作比例，覆盖 --workload')
+    parser.add_argument('--distribution',
+                        choices=('uniform', 'zipfian', 'latest'))
+    parser.add_argument('--records', type=int, default=100000,
+                        help='每个树文件加载的记录数')
+    parser.add_argument('--operations', type=int, default=100000,
+                        help='每个进程执行的操作数')
+    parser.add_argument('--duration', type=float,
+                        help='最多运行的秒数')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='每个进程中的线程数')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--max-scan-length', type=int, default=100)
+    parser.add_argument('--order', type=int, default=50)
+    parser.add_argument('--page-size', type=int,
+                        help='默认是能放下 order 个记录的最小的 2 的幂')
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--ordered', action='store_true',
+                        help='按照插入的顺序使用连续的键，默认把键打散')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='打印一次统计的间隔秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='最终结果的 JSON 输出文件')
+    args = parser.parse_args()
+
+    if args.mix is None:
+        args.mix = WORKLOADS[args.workload]
+    if args.distribution is None:
+        args.distribution = DEFAULT_DISTRIBUTIONS.get(args.workload,
+                                                      'zipfian')
+    if args.page_size is None:
+        args.page_size = fit_page_size(args.order, args.value_size)
+
+    if args.processes == 1:
+        results = queue.Queue()
+        processes = [threading.Thread(target=run_process,
+                                      args=(args, 0, results), daemon=True)]
+    else:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_process,
+                                             args=(args, i, results))
+                     for i in range(args.processes)]
+
+    start = last_print = time.monotonic()
+    for process in processes:
+        process.start()
+
+    totals, interval = dict(), dict()
+    running = len(processes)
+    while running:
+        try:
+            message = results.get(timeout=args.interval)
+        except queue.Empty:
+            message = None
+        if message is not None and message[0] == 'done':
+            running -= 1
+        elif message is not None:
+            merge_into(interval, message[1])
+            merge_into(totals, message[1])
+
+        now = time.monotonic()
+        if now - last_print >= args.interval and interval:
+            print(format_line(now - start, now - last_print, interval),
+                  flush=True)
+            interval, last_print = dict(), now
+
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - start
+
+    print('\nTotal after {:.1f}s'.format(elapsed))
+    print(format_line(elapsed, elapsed, totals))
+    results_json = []
+    for operation, h in sorted(totals.items()):
+        summary = h.summary()
+        summary.update(name='ycsb.{}'.format(operation),
+                       ops_per_sec=h.count / elapsed)
+        results_json.append(summary)
+    if args.output:
+        params = dict(vars(args))
+        write_report('ycsb', params, results_json, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,14 @@
-# -*- coding: utf-8 -*-
\ No newline at end of file
+# -*- coding: utf-8 -*-
+
+from .tree import BPlusTree
+from .metrics import Metrics
+from .serializer import (
+    IntSerializer,
+    StrSerializer,
+    UUIDSerializer,
+    DatetimeUTCSerializer,
+    SignedIntSerializer,
+    FloatSerializer,
+    DatetimeMicrosSerializer,
+    TupleSerializer,
+)
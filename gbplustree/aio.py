@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional
+
+from .node import Node, LonelyRootNode, LeafNode
+from .tree import BPlusTree
+
+
+class AsyncRWLock:
+    """ asyncio 中的读写锁，等待中的写者优先 """
+
+    __slots__ = ['_cond', '_readers', '_writer', '_waiting_writers']
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: not self._writer and not self._waiting_writers
+            )
+            self._readers += 1
+        try:
+            yield
+        finally:
+            await self.release_shared()
+
+    def acquire_nested(self):
+        """ 已经持有读锁时再获取一次读锁，不等待写者，需要调用 release_shared """
+        assert self._readers and not self._writer
+        self._readers += 1
+
+    async def release_shared(self):
+        async with self._cond:
+            self._readers -= 1
+            self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            self._waiting_writers += 1
+            try:
+                await self._cond.wait_for(
+                    lambda: not self._writer and not self._readers
+                )
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class AsyncBPlusTree:
+    """ BPlusTree 的 asyncio 接口
+
+    磁盘读取、写入和 fsync 都在一个有大小限制的线程池中执行，
+    要读取的节点都在缓存中时，直接在事件循环中返回，不需要切换线程。
+    多个协程同时读取同一个不在缓存中的页时，只会读取一次。
+
+    读取在事件循环中进行，只受这个对象自己的读写锁保护，
+    所以 AsyncBPlusTree 打开之后，不应该再通过同步的接口修改这棵树。
+    多次修改可以放在 transaction() 中，只提交一次 (一次 fsync)。
+    """
+
+    __slots__ = ['_tree', '_executor', '_writer', '_lock', '_loading']
+
+    def __init__(self, tree: BPlusTree, max_workers: int = 4,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self._tree = tree
+        self._executor = executor or ThreadPoolExecutor(max_workers)
+        # 树的写事务属于持有它的线程，事务中的操作都在这一个线程中执行
+        self._writer = ThreadPoolExecutor(1)
+        self._lock = AsyncRWLock()
+        # 正在从磁盘读取的页，页号 -> Future
+        self._loading = dict()
+
+    @classmethod
+    async def open(cls, filename: str, max_workers: int = 4,
+                   **kwargs) -> 'AsyncBPlusTree':
+        """ 在线程池中打开树，kwargs 会被传给 BPlusTree """
+        executor = ThreadPoolExecutor(max_workers)
+        loop = asyncio.get_running_loop()
+        tree = await loop.run_in_executor(
+            executor, functools.partial(BPlusTree, filename, **kwargs)
+        )
+        return cls(tree, executor=executor)
+
+    async def close(self):
+        async with self._lock.exclusive():
+            await self._run(self._tree.close)
+        self._executor.shutdown(wait=False)
+        self._writer.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def get(self, key, default=None) -> bytes:
+        if not self._tree._may_contain(key):
+            return default
+        async with self._lock.shared():
+            node = await self._search_in_tree(key)
+            try:
+                record = node.get_entry(key)
+            except ValueError:
+                return default
+            else:
+                return record.value
+
+    async def contains(self, key) -> bool:
+        o = object()
+        return await self.get(key, default=o) is not o
+
+    async def insert(self, key, value: bytes, replace: bool = False):
+        """ 插入一个值，返回时这次插入已经被提交 (WAL 已经 fsync) """
+        async with self._lock.exclusive():
+            await self._run(self._tree.insert, key, value, replace)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator['AsyncTransaction']:
+        """ 异步的事务，和 BPlusTree.transaction 相同
+
+        事务持有排他锁，其中的修改通过返回的 AsyncTransaction 进行，
+        退出时一起提交，出现异常时全部回滚::
+
+            async with tree.transaction() as txn:
+                await txn.insert(1, b'1')
+                await txn.insert(2, b'2')
+        """
+        async with self._lock.exclusive():
+            transaction = self._tree.transaction()
+            await self._run_in_writer(transaction.__enter__)
+            try:
+                yield AsyncTransaction(self)
+            except BaseException as e:
+                if not await self._run_in_writer(
+                        transaction.__exit__, type(e), e, e.__traceback__):
+                    raise
+            else:
+                await self._run_in_writer(transaction.__exit__,
+                                          None, None, None)
+
+    async def checkpoint(self) -> bool:
+        async with self._lock.exclusive():
+            return await self._run(self._tree.checkpoint)
+
+    async def items(self, slice_: Optional[slice] = None) -> AsyncIterator:
+        """ 按照键的顺序异步遍历 (key, value)
+
+        每次只在读取一个叶子节点的时候持有锁，yield 的时候不持有，
+        所以遍历的过程中可以有写入，遍历可以看到遍历开始之后插入的值。
+        """
+        slice_ = slice_ or slice(None)
+        if slice_.step is not None:
+            raise ValueError('Cannot iterate with a custom step')
+
+        after = None
+        while True:
+            async with self._lock.shared():
+                records = await self._next_records(slice_.start, after)
+            for record in records:
+                if slice_.stop is not None and record.key >= slice_.stop:
+                    return
+                yield record.key, record.value
+            if not records:
+                return
+            after = records[-1].key
+
+    async def keys(self, slice_: Optional[slice] = None) -> AsyncIterator:
+        async for key, _ in self.items(slice_):
+            yield key
+
+    async def values(self, slice_: Optional[slice] = None) -> AsyncIterator:
+        async for _, value in self.items(slice_):
+            yield value
+
+    def __repr__(self):
+        return '<AsyncBPlusTree: {}>'.format(self._tree._filename)
+
+    async def _next_records(self, start, after) -> list:
+        """ 返回第一个包含 >= start 且 > after 的键的叶子节点中的这些记录
+
+        每次都从根节点开始查找，所以两次调用之间树的结构被修改也没有关系
+        """
+        key = after if after is not None else start
+        if key is None:
+            node = await self._get_node(self._tree._root_node_page)
+            while not isinstance(node, (LonelyRootNode, LeafNode)):
+                node = await self._get_node(node.smallest_entry.before)
+        else:
+            node = await self._search_in_tree(key)
+
+        while True:
+            records = [
+                r for r in node.entries
+                if (start is None or r.key >= start)
+                and (after is None or r.key > after)
+            ]
+            if records or not node.next_page:
+                return records
+            node = await self._get_node(node.next_page)
+
+    async def _search_in_tree(self, key) -> Node:
+        node = await self._get_node(self._tree._root_node_page)
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            node = await self._get_node(self._tree._child_page(key, node))
+        return node
+
+    async def _get_node(self, page: int) -> Node:
+        node = self._tree._mem.get_cached_node(page)
+        if node is not None:
+            return node
+
+        future = self._loading.get(page)
+        if future is None:
+            # 调用者持有读锁，读取自己再持有一次，直到线程池中的读取结束。
+            # 等待者都被取消之后读取还会继续，写者需要等它结束，
+            # 不会在读取的过程中修改这个页，读取也不会把旧的节点放回缓存
+            self._lock.acquire_nested()
+            future = asyncio.ensure_future(self._load_node(page))
+            self._loading[page] = future
+            future.add_done_callback(lambda _: self._loading.pop(page, None))
+        # 一个等待者被取消时，不能取消其他等待者共享的读取
+        return await asyncio.shield(future)
+
+    async def _load_node(self, page: int) -> Node:
+        try:
+            return await self._run(self._tree._mem.get_node, page)
+        finally:
+            await self._lock.release_shared()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _run_in_writer(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, func, *args)
+
+
+class AsyncTransaction:
+    """ AsyncBPlusTree.transaction() 返回的对象
+
+    所有的操作都在持有写事务的线程中执行，退出 transaction() 时才被提交。
+    事务持有排他锁，事务中需要通过这个对象读取，不能调用 AsyncBPlusTree.get。
+    """
+
+    __slots__ = ['_tree']
+
+    def __init__(self, tree: AsyncBPlusTree):
+        self._tree = tree
+
+    async def get(self, key, default=None) -> bytes:
+        return await self._tree._run_in_writer(self._tree._tree.get,
+                                               key, default)
+
+    async def insert(self, key, value: bytes, replace: bool = False):
+        await self._tree._run_in_writer(self._tree._tree.insert,
+                                        key, value, replace)
+
+    async def insert_many(self, items, replace: bool = False):
+        await self._tree._run_in_writer(self._tree._tree.insert_many,
+                                        items, replace)
+
+    async def update_many(self, items):
+        await self._tree._run_in_writer(self._tree._tree.update_many, items)
+
+    async def delete_range(self, start=None, end=None):
+        await self._tree._run_in_writer(self._tree._tree.delete_range,
+                                        start, end)
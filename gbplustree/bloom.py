@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from typing import Optional
+
+from .const import ENDIAN
+
+# 头: 容量 + 已经加入的键的个数
+BLOOM_HEADER_BYTES = 8
+
+# hashlib.blake2b，第一次创建 BloomFilter 时才导入
+blake2b = None
+
+
+class BloomFilter:
+    """ 布隆过滤器，用来在不读取叶子节点的情况下判断一个键一定不存在
+
+    每个键使用 BITS_PER_KEY 个位和 NUM_HASHES 个哈希函数，误判率大约是 1%。
+    加入的键的个数超过 capacity 之后误判率会上升，is_full 变为 True，
+    由调用者用更大的容量重新创建。
+    布隆过滤器不支持删除，被删除的键只会增加误判，不会导致漏判。
+    """
+
+    __slots__ = ['capacity', 'count', 'num_bits', '_bits', '_lock']
+
+    BITS_PER_KEY = 10
+    NUM_HASHES = 7
+    MIN_CAPACITY = 1024
+
+    def __init__(self, capacity: int, data: Optional[bytes] = None):
+        global blake2b
+        if blake2b is None:
+            from hashlib import blake2b
+        self.capacity = max(capacity, self.MIN_CAPACITY)
+        self.count = 0
+        self.num_bits = self.capacity * self.BITS_PER_KEY
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        # 多个乐观的写者可能同时加入键，修改同一个字节时不能丢失其中的位
+        self._lock = threading.Lock()
+        if data:
+            self.load(data)
+
+    def add(self, key: bytes):
+        positions = self._positions(key)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    @property
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    def _positions(self, key: bytes) -> list:
+        """ 用一次 blake2b 得到两个哈希值，组合出 NUM_HASHES 个位置 """
+        digest = blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], ENDIAN)
+        h2 = int.from_bytes(digest[8:], ENDIAN) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.NUM_HASHES)]
+
+    def load(self, data: bytes):
+        capacity = int.from_bytes(data[:BLOOM_HEADER_BYTES], ENDIAN)
+        end_count = 2 * BLOOM_HEADER_BYTES
+        bits = data[end_count:]
+        if capacity != self.capacity or len(bits) != len(self._bits):
+            raise ValueError('Bloom filter data does not match its capacity')
+        self.count = int.from_bytes(data[BLOOM_HEADER_BYTES:end_count],
+                                    ENDIAN)
+        self._bits = bytearray(bits)
+
+    def dump(self) -> bytes:
+        return (
+            self.capacity.to_bytes(BLOOM_HEADER_BYTES, ENDIAN)
+            + self.count.to_bytes(BLOOM_HEADER_BYTES, ENDIAN)
+            + bytes(self._bits)
+        )
+
+    @classmethod
+    def from_file(cls, filename: str) -> 'BloomFilter':
+        """ 从文件中读取，文件不存在或者不完整时抛出 OSError 或 ValueError """
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if len(data) < 2 * BLOOM_HEADER_BYTES:
+            raise ValueError('Bloom filter file is truncated')
+        capacity = int.from_bytes(data[:BLOOM_HEADER_BYTES], ENDIAN)
+        return cls(capacity, data=data)
+
+    def to_file(self, filename: str):
+        """ 先写入临时文件再重命名，文件中不会出现写了一半的数据 """
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self.dump())
+        os.replace(tmp_filename, filename)
+
+    def __repr__(self):
+        return '<BloomFilter: {}/{} keys>'.format(self.count, self.capacity)
@@ -27,10 +27,21 @@ USED_VALUE_LENGTH_BYTES = 2
 # 用于存储有特定目的的整数，例如文件的元数据
 OTHER_BYTES = 4
 
+# 内部节点的引用中保存子树中记录的个数使用的字节数
+SUBTREE_COUNT_BYTES = 8
+
 TreeConf = namedtuple('TestConf', [
     'page_size',
     'order',
     'key_size',
     'value_size',
     'serializer',
-])
+    # 内部节点的引用中是否保存子树中记录的个数
+    'order_statistics',
+    # 节点内查找键的方法，见 SEARCH_STRATEGIES，只在内存中使用，不会被保存
+    'search',
+], defaults=[False, 'bisect'])
+
+# 节点内查找键的方法: 'bisect' 二分查找，
+# 'interpolation' 对整数键使用插值查找，其他类型的键仍然使用二分查找
+SEARCH_STRATEGIES = ('bisect', 'interpolation')
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from itertools import islice
+from typing import Optional
+
+from .metrics import timed_operation
+from .node import LonelyRootNode, LeafNode
+
+# 遍历时可以选择的返回值
+PROJECTIONS = ('items', 'keys', 'values')
+
+
+class PrefixEnd:
+    """ 以 prefix 开头的元组键的上界 (不包含)
+
+    比所有以 prefix 开头的键和比 prefix 小的键都大，比其他的键都小，
+    作为 end 传给游标时，游标在第一个不以 prefix 开头的键处停止。
+    """
+
+    __slots__ = ['prefix']
+
+    def __init__(self, prefix: tuple):
+        self.prefix = prefix
+
+    def _above(self, key: tuple) -> bool:
+        return key[:len(self.prefix)] <= self.prefix
+
+    def __gt__(self, key):
+        return self._above(key)
+
+    __ge__ = __gt__
+
+    def __lt__(self, key):
+        return not self._above(key)
+
+    __le__ = __lt__
+
+    def __eq__(self, other):
+        return (isinstance(other, PrefixEnd)
+                and self.prefix == other.prefix)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<PrefixEnd: {}>'.format(self.prefix)
+
+
+class Cursor:
+    """ 流式遍历 [start, end) 区间中的记录
+
+    游标按照叶子节点的父节点中的引用，预先知道接下来的叶子节点所在的页，
+    每次用一次批量读取取回 prefetch 个叶子节点，树文件中连续的页只需要读取一次。
+    读取的节点不会放入 FileMemory 的缓存中，遍历不会把热点页挤出缓存。
+
+    每读取一批叶子节点时才持有读锁，遍历的过程中树可以被修改。
+    树的结构被修改 (节点分裂) 之后，游标会从根节点重新查找上一次返回的键，
+    游标不会重复返回同一个键，但是可以看到遍历开始之后插入的值。
+    """
+
+    __slots__ = ['_tree', '_end', '_projection', '_prefetch', '_lower',
+                 '_inclusive', '_position', '_records', '_pending_pages',
+                 '_planned_leaf', '_fence', '_version', '_exhausted']
+
+    def __init__(self, tree, start=None, end=None, projection: str = 'items',
+                 prefetch: int = 8, after=None):
+        """
+        :param start: 第一个键的下界 (包含)
+        :param end: 键的上界 (不包含)
+        :param projection: 'items' 返回 (key, value)，'keys' 只返回键，
+                           'values' 只返回值
+        :param prefetch: 每次批量读取的叶子节点的个数
+        :param after: 从这个键之后开始遍历 (不包含)，用于从 position 恢复遍历
+        """
+        if projection not in PROJECTIONS:
+            raise ValueError('Unknown projection {}'.format(projection))
+        if prefetch < 1:
+            raise ValueError('Cannot prefetch less than one leaf')
+        if start is not None and end is not None and start >= end:
+            raise ValueError('Cannot iterate backwards')
+
+        self._tree = tree
+        self._end = end
+        self._projection = projection
+        self._prefetch = prefetch
+        self._position = None
+        self._records = deque()
+        if after is not None:
+            self._seek(after, inclusive=False)
+        else:
+            self._seek(start, inclusive=True)
+
+    @property
+    def position(self):
+        """ 上一次返回的键，可以传给 BPlusTree.scan(after=...) 恢复遍历 """
+        return self._position
+
+    def seek(self, key):
+        """ 移动游标，下一次返回第一个 >= key 的记录 """
+        self._seek(key, inclusive=True)
+
+    def close(self):
+        self._exhausted = True
+        self._records.clear()
+        self._pending_pages.clear()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._records:
+            if self._exhausted:
+                raise StopIteration
+            self._fill()
+
+        record = self._records.popleft()
+        if self._end is not None and record.key >= self._end:
+            self.close()
+            raise StopIteration
+
+        self._position = self._lower = record.key
+        self._inclusive = False
+        if self._projection == 'keys':
+            return record.key
+        if self._projection == 'values':
+            return record.value
+        return record.key, record.value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<Cursor: position={}>'.format(self._position)
+
+    def _seek(self, key, inclusive: bool):
+        self._lower = key
+        self._inclusive = inclusive
+        self._records.clear()
+        self._pending_pages = deque()
+        self._planned_leaf = None
+        self._fence = None
+        # None 表示还没有从根节点查找过
+        self._version = None
+        self._exhausted = False
+
+    @timed_operation('scan_step', lambda cursor: cursor._tree._metrics)
+    def _fill(self):
+        """ 批量读取接下来的叶子节点，把其中符合条件的记录放入 _records """
+        tree = self._tree
+        mem = tree._mem
+        with mem.read_transaction:
+            if self._version != tree._structure_version:
+                # 第一次读取，或者树的结构已经改变，从根节点重新查找
+                self._version = tree._structure_version
+                self._plan(self._lower)
+            elif not self._pending_pages:
+                if self._fence is None:
+                    self._exhausted = True
+                    return
+                self._plan(self._fence)
+
+            pages = [self._pending_pages.popleft() for _ in
+                     range(min(self._prefetch, len(self._pending_pages)))]
+            if not pages:
+                self._exhausted = self._fence is None
+                return
+
+            # 查找时已经读取过第一个叶子节点，不需要再读一次
+            planned_leaf, self._planned_leaf = self._planned_leaf, None
+            if planned_leaf is not None and planned_leaf.page == pages[0]:
+                nodes = [planned_leaf] + mem.read_nodes(pages[1:])
+            else:
+                nodes = mem.read_nodes(pages)
+            # 在调用者处理这一批记录的时候，内核在后台读取下一批叶子节点
+            mem.prefetch(list(islice(self._pending_pages, self._prefetch)))
+
+            for node in nodes:
+                with mem.latch(node.page):
+                    entries = list(node.entries)
+                for record in entries:
+                    if self._lower is not None and (
+                            record.key < self._lower
+                            or (record.key == self._lower
+                                and not self._inclusive)):
+                        continue
+                    self._records.append(record)
+
+    def _plan(self, key: Optional[object]):
+        """ 从根节点下降到 key 所在的叶子节点
+
+        把这个叶子节点和它在父节点中右边的兄弟节点放入 _pending_pages，
+        并记录父节点的上界 _fence，读完这些叶子节点之后从 _fence 继续查找。
+        """
+        tree = self._tree
+        node = tree._root_node
+        path = []
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            if key is None:
+                i = 0
+            else:
+                i = node.find_index(key, right=True)
+            path.append((node, i))
+            # 不知道子节点是不是叶子节点，所以也不放入缓存
+            node = tree._mem.read_nodes([node.children_pages[i]])[0]
+        self._planned_leaf = node
+
+        if not path:
+            self._pending_pages = deque([node.page])
+            self._fence = None
+            return
+
+        parent, i = path[-1]
+        pages = parent.children_pages[i:]
+        lower_bounds = [None] + [ref.key for ref in parent.entries[i:]]
+        # 下界已经超过 end 的叶子节点不需要读取
+        self._pending_pages = deque(
+            page for page, lower in zip(pages, lower_bounds)
+            if self._end is None or lower is None or lower < self._end
+        )
+
+        self._fence = None
+        for node, i in reversed(path):
+            if i < len(node.entries):
+                self._fence = node.entries[i].key
+                break
+        if (self._fence is not None and self._end is not None
+                and self._fence >= self._end):
+            self._fence = None
+
+
+class ReverseCursor:
+    """ 从大到小流式遍历 [start, end) 区间中的记录
+
+    只在开始时从根节点查找一次 end 所在的叶子节点，之后沿着叶子节点的
+    prev_page 向左读取，每次只读取一个叶子节点，所以“最新的 N 条记录”
+    这样带有数量限制的查询只需要读取很少的页。
+    读取的节点同样不会放入 FileMemory 的缓存中。
+
+    和 Cursor 一样，树的结构被修改之后会从根节点重新查找上一次返回的键。
+    """
+
+    __slots__ = ['_tree', '_start', '_projection', '_upper', '_inclusive',
+                 '_position', '_records', '_prev_page', '_version',
+                 '_exhausted']
+
+    def __init__(self, tree, start=None, end=None, projection: str = 'items',
+                 after=None):
+        """
+        :param start: 键的下界 (包含)
+        :param end: 第一个键的上界 (不包含)
+        :param projection: 'items' 返回 (key, value)，'keys' 只返回键，
+                           'values' 只返回值
+        :param after: 从这个键之前开始遍历 (不包含)，用于从 position 恢复遍历
+        """
+        if projection not in PROJECTIONS:
+            raise ValueError('Unknown projection {}'.format(projection))
+        if start is not None and end is not None and start >= end:
+            raise ValueError('Cannot iterate backwards')
+
+        self._tree = tree
+        self._start = start
+        self._projection = projection
+        self._position = None
+        self._records = deque()
+        self._seek(after if after is not None else end, inclusive=False)
+
+    @property
+    def position(self):
+        """ 上一次返回的键，可以传给 BPlusTree.scan(after=..., reverse=True) """
+        return self._position
+
+    def seek(self, key):
+        """ 移动游标，下一次返回第一个 <= key 的记录 """
+        self._seek(key, inclusive=True)
+
+    def close(self):
+        self._exhausted = True
+        self._records.clear()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._records:
+            if self._exhausted:
+                raise StopIteration
+            self._fill()
+
+        record = self._records.popleft()
+        self._position = self._upper = record.key
+        self._inclusive = False
+        if self._projection == 'keys':
+            return record.key
+        if self._projection == 'values':
+            return record.value
+        return record.key, record.value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<ReverseCursor: position={}>'.format(self._position)
+
+    def _seek(self, key, inclusive: bool):
+        self._upper = key
+        self._inclusive = inclusive
+        self._records.clear()
+        self._prev_page = None
+        # None 表示还没有从根节点查找过
+        self._version = None
+        self._exhausted = False
+
+    @timed_operation('scan_step', lambda cursor: cursor._tree._metrics)
+    def _fill(self):
+        """ 读取左边的下一个叶子节点，把其中符合条件的记录倒序放入 _records """
+        tree = self._tree
+        mem = tree._mem
+        with mem.read_transaction:
+            if self._version != tree._structure_version:
+                # 第一次读取，或者树的结构已经改变，从根节点重新查找
+                self._version = tree._structure_version
+                node = self._descend(self._upper)
+            elif self._prev_page is None:
+                self._exhausted = True
+                return
+            else:
+                node = mem.read_nodes([self._prev_page])[0]
+
+            with mem.latch(node.page):
+                entries = list(node.entries)
+            self._prev_page = node.prev_page
+
+        for record in reversed(entries):
+            if self._upper is not None and (
+                    record.key > self._upper
+                    or (record.key == self._upper and not self._inclusive)):
+                continue
+            if self._start is not None and record.key < self._start:
+                self._exhausted = True
+                break
+            self._records.append(record)
+        if self._prev_page is None:
+            self._exhausted = True
+
+    def _descend(self, key: Optional[object]):
+        """ 从根节点下降到 key 所在的叶子节点，key 为 None 时下降到最右边 """
+        tree = self._tree
+        node = tree._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            pages = node.children_pages
+            if key is None:
+                page = pages[-1]
+            else:
+                page = pages[node.find_index(key, right=True)]
+            node = tree._mem.read_nodes([page])[0]
+        return node
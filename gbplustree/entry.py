@@ -10,6 +10,7 @@ from .const import (
     USED_KEY_LENGTH_BYTES,
     USED_VALUE_LENGTH_BYTES,
     PAGE_REFERENCE_BYTES,
+    SUBTREE_COUNT_BYTES,
 )
 
 
@@ -73,6 +74,16 @@ class Record(Entry):
 
         if data:
             self.load(data)
+        elif value is not None:
+            # 要写入的记录在写入任何节点之前拒绝过长的键，而不是在提交时
+            # dump 失败；只用来查找位置的记录没有 value，不需要检查
+            key_length = len(self._tree_conf.serializer.serialize(
+                key, self._tree_conf.key_size
+            ))
+            if key_length > self._tree_conf.key_size:
+                raise ValueError('Key {} is bigger than key_size {}'.format(
+                    key, self._tree_conf.key_size
+                ))
         if value:
             assert len(self.value) <= self._tree_conf.value_size
 
@@ -160,19 +171,29 @@ class Record(Entry):
 
 class Reference(Entry):
 
-    __slots__ = ['_tree_conf', 'length', 'key', 'before', 'after']
+    __slots__ = ['_tree_conf', 'length', 'key', 'before', 'after',
+                 'before_count', 'after_count']
 
     def __init__(self, tree_conf: TreeConf, key=None, before=None, after=None,
-                 data: bytes = None):
+                 data: bytes = None, before_count: int = 0,
+                 after_count: int = 0):
+        """
+        before_count 和 after_count 是 before 和 after 子树中记录的个数，
+        只有 tree_conf.order_statistics 为 True 时才会被保存
+        """
         self._tree_conf = tree_conf
         self.length = (
             2 * PAGE_REFERENCE_BYTES
             + USED_KEY_LENGTH_BYTES
             + self._tree_conf.key_size
         )
+        if self._tree_conf.order_statistics:
+            self.length += 2 * SUBTREE_COUNT_BYTES
         self.key = key
         self.before = before
         self.after = after
+        self.before_count = before_count
+        self.after_count = after_count
         if data:
             self.load(data)
 
@@ -196,6 +217,11 @@ class Reference(Entry):
 
             + self.after.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
         )
+        if self._tree_conf.order_statistics:
+            data += (
+                self.before_count.to_bytes(SUBTREE_COUNT_BYTES, ENDIAN)
+                + self.after_count.to_bytes(SUBTREE_COUNT_BYTES, ENDIAN)
+            )
 
         return data
 
@@ -219,6 +245,16 @@ class Reference(Entry):
         end_after = start_after + PAGE_REFERENCE_BYTES
         self.after = int.from_bytes(data[start_after:end_after], ENDIAN)
 
+        if self._tree_conf.order_statistics:
+            end_before_count = end_after + SUBTREE_COUNT_BYTES
+            self.before_count = int.from_bytes(
+                data[end_after:end_before_count], ENDIAN
+            )
+            self.after_count = int.from_bytes(
+                data[end_before_count:end_before_count + SUBTREE_COUNT_BYTES],
+                ENDIAN
+            )
+
     def __repr__(self):
         return '<Reference: key={} before={} after={}>'.format(
             self.key, self.before, self.after
@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import enum
+import importlib
 import io
 import logging
+import mmap
 import os
 import platform
-import rwlock
-import cachetools
-from typing import Tuple, Union, Optional, BinaryIO
+import struct
+import threading
+import time
+import weakref
+from typing import Tuple, Union, Optional, BinaryIO, Iterator
 
-from .node import Node
+try:
+    import fcntl
+except ImportError:
+    # Windows 上没有 fcntl，checkpoint 不能和只读的读者协调
+    fcntl = None
+
+from .metrics import Metrics, timed_operation
+from .node import Node, FreelistNode
+from .serializer import TupleSerializer, serializer_from_id
 from .const import (
     TreeConf,
     PAGE_REFERENCE_BYTES,
@@ -20,6 +34,92 @@ from .const import (
 
 logger = logging.getLogger(__name__)
 
+# 压缩模式下每个 extent 的头: 页号 + 压缩后数据的长度
+EXTENT_HEADER_LENGTH = PAGE_REFERENCE_BYTES + OTHER_BYTES
+
+# 压缩文件的文件头之后是 epoch，每次压实文件时重新生成，
+# filename-extents 中保存的 epoch 和它不同时，说明映射文件属于压实之前的文件
+EPOCH_BYTES = 8
+
+# filename-extents: epoch、映射覆盖到的文件位置、extent 的个数，
+# 之后每个 extent 是 页号、起始位置、压缩后的长度
+EXTENT_MAP_HEADER = struct.Struct('<{}sQI'.format(EPOCH_BYTES))
+EXTENT_MAP_ENTRY = struct.Struct('<IQI')
+
+# 压缩文件中被覆盖的旧 extent 超过有效数据的大小，并且超过这个字节数时，
+# checkpoint 会把有效的 extent 复制到新的文件中
+COMPACTION_MIN_BYTES = 64 * 1024
+
+# 元数据中的标志位: 内部节点的引用中保存了子树中记录的个数
+METADATA_FLAG_ORDER_STATISTICS = 1
+
+# 文件头: 魔数、文件格式的版本和压缩算法的编号，
+# 不压缩的文件中是第 0 页的开头，压缩的文件中写在第一个 extent 之前，
+# 打开时在解析任何节点之前检查，旧格式的文件和其他文件会被拒绝
+MAGIC = b'GBPT'
+FORMAT_VERSION = 1
+FILE_HEADER_LENGTH = len(MAGIC) + 2 * OTHER_BYTES
+
+# 每次 checkpoint 写入树文件时加一的计数器，只读的读者用它判断树文件
+# 是否被修改过，文件的大小和修改时间都可能不变
+CHECKPOINT_COUNTER_BYTES = 8
+
+# TupleSerializer 的字段个数和每个字段的 Serializer 的编号 (各一个字节)，
+# 其他的 Serializer 全部为 0
+TUPLE_LAYOUT_BYTES = 1 + TupleSerializer.MAX_FIELDS
+
+# 第 0 页开头的元数据: 文件头、根节点、页大小、order、key_size、value_size、
+# 空闲页链表、标志位、Serializer 的编号、元组的字段和 checkpoint 计数器，
+# 打开树时只需要读取这几个字节
+METADATA_LENGTH = (FILE_HEADER_LENGTH + 2 * PAGE_REFERENCE_BYTES
+                   + 6 * OTHER_BYTES + TUPLE_LAYOUT_BYTES
+                   + CHECKPOINT_COUNTER_BYTES)
+
+# 压缩文件中第一个 extent 的位置
+COMPRESSED_HEADER_LENGTH = FILE_HEADER_LENGTH + EPOCH_BYTES
+
+# MmapMemory 的读者在开始读取之前短暂地获取这个文件的共享锁，
+# checkpoint 持有它的排他锁时新的读取会等待，正在进行的读取结束后写者就能拿到树文件的锁
+TURNSTILE_SUFFIX = '-turnstile'
+
+# 丢弃 WAL 开头已经写回树文件的帧时，每次复制这么多字节到新的 WAL 中
+WAL_COPY_CHUNK = 1 << 20
+
+# O_DIRECT 模式下读取的偏移量、长度和缓冲区都需要按这个大小对齐
+DIRECT_IO_ALIGNMENT = mmap.PAGESIZE
+
+# posix_fadvise 只在部分平台上可用，不可用时所有的提示都被忽略
+_fadvise = getattr(os, 'posix_fadvise', None)
+_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+_FADV_RANDOM = getattr(os, 'POSIX_FADV_RANDOM', None)
+_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+# 可用的页压缩算法，值为提供 compress 和 decompress 的模块，使用时才导入
+COMPRESSION_CODECS = {
+    'zlib': 'zlib',
+    'lzma': 'lzma',
+}
+
+# 保存在文件头中的压缩算法的编号
+COMPRESSION_IDS = {
+    None: 0,
+    'zlib': 1,
+    'lzma': 2,
+}
+
+# rwlock 和 cachetools 在第一次打开树时才导入，
+# 只是导入 gbplustree 的命令行工具不需要为它们付出启动时间
+rwlock = None
+cachetools = None
+
+
+def _import_dependencies():
+    global rwlock, cachetools
+    if cachetools is None:
+        import rwlock
+        import cachetools
+
 
 class ReachedEndOfFile(Exception):
     """Read a file until its end"""
@@ -50,7 +150,8 @@ def open_file_in_dir(path: str) -> Tuple[BinaryIO, Optional[int]]:
 
 
 def write_to_file(file_fd: BinaryIO, dir_fileno: Optional[int],
-                  data: bytes, fsync: bool = True):
+                  data: bytes, fsync: bool = True,
+                  metrics: Optional[Metrics] = None):
     length_to_write = len(data)
     written = 0
 
@@ -58,10 +159,11 @@ def write_to_file(file_fd: BinaryIO, dir_fileno: Optional[int],
         # 这里应该使用 += 保留写入的总字节数
         written += file_fd.write(data[written:])
     if fsync:
-        fsync_file_and_dir(file_fd.fileno(), dir_fileno)
+        fsync_file_and_dir(file_fd.fileno(), dir_fileno, metrics)
 
 
-def fsync_file_and_dir(file_fileno: int, dir_fileno: Optional[int]):
+def fsync_file_and_dir(file_fileno: int, dir_fileno: Optional[int],
+                       metrics: Optional[Metrics] = None):
     """
     os.fsync(fd) 函数
 
@@ -74,11 +176,16 @@ def fsync_file_and_dir(file_fileno: int, dir_fileno: Optional[int]):
 
     :param file_fileno:
     :param dir_fileno:
+    :param metrics: 不为 None 时记录 fsync 的耗时
     :return:
     """
+    if metrics is not None:
+        start = time.perf_counter()
     os.fsync(file_fileno)
     if dir_fileno is not None:
         os.fsync(dir_fileno)
+    if metrics is not None:
+        metrics.observe('fsync', time.perf_counter() - start)
 
 
 def read_from_file(file_fd: BinaryIO, start: int, stop: int) -> bytes:
@@ -98,38 +205,1327 @@ def read_from_file(file_fd: BinaryIO, start: int, stop: int) -> bytes:
     return data
 
 
+# 不支持 os.pread 的平台上，用这个锁保护 seek 和 read
+_pread_fallback_lock = threading.Lock()
+
+
+def pread_from_file(file_fd: BinaryIO, start: int, stop: int) -> bytes:
+    """
+    和 read_from_file 一样读取 [start, stop) 区间的数据，
+    但是不依赖文件的偏移量，可以在多个线程中同时调用
+    """
+    if not hasattr(os, 'pread'):
+        with _pread_fallback_lock:
+            return read_from_file(file_fd, start, stop)
+
+    length = stop - start
+    assert length >= 0
+
+    data = bytes()
+    while len(data) < length:
+        read_data = os.pread(file_fd.fileno(), length - len(data),
+                             start + len(data))
+        if read_data == b'':
+            raise ReachedEndOfFile('Read until the end of file')
+        data += read_data
+
+    return data
+
+
+def replace_file(path: str, data: bytes, dir_fileno: Optional[int]):
+    """ 原子地替换 path 的内容: 先写入临时文件并 fsync，再重命名 """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb', buffering=0) as f:
+        write_to_file(f, None, data)
+    os.replace(tmp_path, path)
+    if dir_fileno is not None:
+        os.fsync(dir_fileno)
+
+
+def _page_runs(pages: list):
+    """ 把排好序的页号分成连续的段，返回 (第一个页, 页的个数) """
+    i = 0
+    while i < len(pages):
+        count = 1
+        while i + count < len(pages) and pages[i + count] == pages[i] + count:
+            count += 1
+        yield pages[i], count
+        i += count
+
+
+def file_header(compression: Optional[str]) -> bytes:
+    return (
+        MAGIC
+        + FORMAT_VERSION.to_bytes(OTHER_BYTES, ENDIAN)
+        + COMPRESSION_IDS[compression].to_bytes(OTHER_BYTES, ENDIAN)
+    )
+
+
+def parse_file_header(data: bytes, filename: str) -> Optional[str]:
+    """ 检查文件头中的魔数和格式版本，返回文件使用的压缩算法 """
+    if len(data) < FILE_HEADER_LENGTH or not data.startswith(MAGIC):
+        raise ValueError('{} is not a GBPlusTree file or was written in an '
+                         'older format without a file header'.format(filename))
+    end_version = len(MAGIC) + OTHER_BYTES
+    version = int.from_bytes(data[len(MAGIC):end_version], ENDIAN)
+    if version != FORMAT_VERSION:
+        raise ValueError('{} has format version {}, expected {}'.format(
+            filename, version, FORMAT_VERSION
+        ))
+    compression_id = int.from_bytes(data[end_version:FILE_HEADER_LENGTH],
+                                    ENDIAN)
+    for compression, id_ in COMPRESSION_IDS.items():
+        if id_ == compression_id:
+            return compression
+    raise ValueError('{} uses an unknown compression {}'.format(
+        filename, compression_id
+    ))
+
+
+def checkpoint_counter(data: bytes) -> int:
+    """ 返回元数据中的 checkpoint 计数器 """
+    return int.from_bytes(
+        data[METADATA_LENGTH - CHECKPOINT_COUNTER_BYTES:METADATA_LENGTH], ENDIAN
+    )
+
+
+def parse_metadata(data: bytes, tree_conf: TreeConf) -> tuple:
+    """ 解析第 0 页开头的元数据
+
+    Serializer 的编号对应一个内置的 Serializer，
+    而 tree_conf 中的是另一种 Serializer 时，使用保存的 Serializer。
+    TupleSerializer 的字段和保存的不同时，用保存的字段创建 TupleSerializer，
+    有自定义的字段不能创建时抛出 ValueError。
+
+    文件头由调用者在打开文件时检查过了，这里直接跳过。
+
+    :return: (根节点所在的页, 空闲页链表的第一个页, TreeConf)
+    """
+    end_root_node_page = FILE_HEADER_LENGTH + PAGE_REFERENCE_BYTES
+    root_node_page = int.from_bytes(
+        data[FILE_HEADER_LENGTH:end_root_node_page], ENDIAN
+    )
+    end_page_size = end_root_node_page + OTHER_BYTES
+    page_size = int.from_bytes(
+        data[end_root_node_page:end_page_size], ENDIAN
+    )
+    end_order = end_page_size + OTHER_BYTES
+    order = int.from_bytes(data[end_page_size:end_order], ENDIAN)
+    end_key_size = end_order + OTHER_BYTES
+    key_size = int.from_bytes(data[end_order:end_key_size], ENDIAN)
+    end_value_size = end_key_size + OTHER_BYTES
+    value_size = int.from_bytes(
+        data[end_key_size:end_value_size], ENDIAN
+    )
+    end_freelist_start_page = end_value_size + PAGE_REFERENCE_BYTES
+    freelist_start_page = int.from_bytes(
+        data[end_value_size:end_freelist_start_page], ENDIAN
+    )
+    end_flags = end_freelist_start_page + OTHER_BYTES
+    flags = int.from_bytes(data[end_freelist_start_page:end_flags], ENDIAN)
+    end_serializer_id = end_flags + OTHER_BYTES
+    serializer_id = int.from_bytes(data[end_flags:end_serializer_id],
+                                   ENDIAN)
+    field_ids = tuple(
+        data[end_serializer_id + 1:end_serializer_id + 1
+             + data[end_serializer_id]]
+    )
+    serializer = tree_conf.serializer
+    if serializer_id == TupleSerializer.serializer_id:
+        if getattr(serializer, 'field_ids', None) != field_ids:
+            serializer = serializer_from_id(serializer_id, field_ids)
+            if serializer is None:
+                raise ValueError('Tree was created with a TupleSerializer of '
+                                 'fields {}, it needs to be passed when '
+                                 'opening the tree'.format(field_ids))
+    elif serializer_id and serializer.serializer_id != serializer_id:
+        serializer = serializer_from_id(serializer_id) or serializer
+    tree_conf = TreeConf(
+        page_size, order, key_size, value_size, serializer,
+        order_statistics=bool(flags & METADATA_FLAG_ORDER_STATISTICS),
+        search=tree_conf.search
+    )
+    return root_node_page, freelist_start_page, tree_conf
+
+
 class FileMemory:
 
-    __slots__ = ['_filename', '_tree_conf', '_lock', '_cache', '_fd',
-                 '_dir_fd', '_wal', 'last_page']
+    __slots__ = ['_filename', '_tree_conf', '_lock', '_cache', '_cache_lock',
+                 '_latches', '_latches_lock', '_wal_lock', '_snapshots',
+                 '_fd', '_dir_fd', '_wal', 'last_page', '_compression',
+                 '_codec', '_file_metadata', '_checkpoints',
+                 '_extents', '_extents_end', '_dirty_pages', '_write_depth',
+                 '_writer', '_root_node_page', '_freelist_start_page',
+                 '_committed_state', '_metrics', '_direct_fd',
+                 '_direct_buffers', '_sequential_readers', '_advice_lock',
+                 '_freed_pages', '_sync_cond', '_wal_written', '_wal_synced',
+                 '_syncing', '_epoch', '_live_bytes', '_saved_extents_end',
+                 'on_rollback']
 
     def __init__(self, filename: str, tree_conf: TreeConf,
-                 cache_size: int = 512):
+                 cache_size: int = 512, compression: Optional[str] = None,
+                 metrics: Optional[Metrics] = None, direct_io: bool = False):
+        """
+        :param compression: 页压缩算法，None 表示不压缩，可选 'zlib' 或 'lzma'，
+                            已经存在的文件使用文件头中保存的压缩算法，
+                            传入的和保存的不同时抛出 ValueError
+        :param metrics: 记录缓存命中、读写的页、WAL 和 fsync 的统计
+        :param direct_io: 用 O_DIRECT 读取树文件中的页，绕过操作系统的页缓存，
+                          适用于 FileMemory 的缓存足够大、不需要再缓存一份的场景，
+                          页大小需要是 DIRECT_IO_ALIGNMENT 的整数倍
+        """
+        if compression is not None and compression not in COMPRESSION_CODECS:
+            raise ValueError('Unknown compression {}'.format(compression))
+        if direct_io and compression:
+            raise ValueError('Cannot use O_DIRECT with compressed pages')
+        if direct_io and not hasattr(os, 'O_DIRECT'):
+            raise ValueError('O_DIRECT is not supported on this platform')
+        _import_dependencies()
+
         self._filename = filename
         self._tree_conf = tree_conf
-        self._lock = rwlock.RWLock
+        self._metrics = metrics
+        # 多个读者可以同时读，写者独占，锁的范围是树的一次操作
+        self._lock = rwlock.RWLock()
 
         if cache_size == 0:
             self._cache = FakeCache()
         else:
             self._cache = cachetools.LRUCache(maxsize=cache_size)
+        # LRUCache 在读取时也会修改内部的顺序，多个读者同时访问时需要加锁
+        self._cache_lock = threading.Lock()
+
+        # 每个页的读写锁 (latch)，页号 -> [RWLock, 引用计数]
+        self._latches = dict()
+        self._latches_lock = threading.Lock()
+        # 多个线程同时提交单个节点时，保护 WAL 的写入
+        self._wal_lock = threading.Lock()
+        # 组提交: commit_node 写入 WAL 的提交的序号、已经 fsync 的序号，
+        # 以及是否有线程正在 fsync
+        self._sync_cond = threading.Condition()
+        self._wal_written = 0
+        self._wal_synced = 0
+        self._syncing = False
+        # 还没有关闭的快照，不再被引用的快照被垃圾回收时自动移除
+        self._snapshots = weakref.WeakSet()
+        # 写事务中修改过的页，页号 -> Node (第 0 页是元数据的 bytes)，
+        # 提交时才写入 WAL，同一个页被修改多次也只写入最后一个版本
+        self._dirty_pages = dict()
+        # 写事务嵌套的层数，只有最外层的写事务会提交
+        self._write_depth = 0
+        # 持有写事务的线程
+        self._writer = None
+        # 元数据中的根节点和空闲页链表的第一个页，0 表示没有空闲页
+        self._root_node_page = 0
+        self._freelist_start_page = 0
+        # 正在批量读取连续的页的线程的个数，大于 0 时提示内核顺序读取
+        self._sequential_readers = 0
+        self._advice_lock = threading.Lock()
+        # 这个写事务中被释放的页，提交之后提示内核丢弃它们的页缓存
+        self._freed_pages = []
+        # 最外层的写事务回滚 (包括提交失败) 之后、释放写锁之前调用
+        self.on_rollback = None
 
         self._fd, self._dir_fd = open_file_in_dir(filename)
+        self._epoch = None
+        # 在创建 WAL 和解析任何节点之前检查文件头，失败时不留下 WAL
+        try:
+            compression = self._open_file_header(compression)
+            if direct_io and compression:
+                raise ValueError('{} has compressed pages, cannot use '
+                                 'O_DIRECT'.format(filename))
+        except ValueError:
+            self._fd.close()
+            if self._dir_fd is not None:
+                os.close(self._dir_fd)
+            raise
+        self._compression = compression
+        self._codec = None
+        if compression:
+            self._codec = importlib.import_module(
+                COMPRESSION_CODECS[compression]
+            )
+        self._direct_fd = None
+        # 每个线程自己的按页对齐的读取缓冲区
+        self._direct_buffers = threading.local()
+
+        # 压缩模式下，页号 -> (extent 在文件中的起始位置, 压缩后的长度)，
+        # 有效的 extent (包括头) 的总字节数，上一次保存映射时的文件末尾
+        self._extents = dict()
+        self._extents_end = COMPRESSED_HEADER_LENGTH
+        self._live_bytes = 0
+        self._saved_extents_end = None
+        if self._compression:
+            self._load_extents()
 
-        self._wal = WAL(filename, tree_conf.page_size)
+        # 已经存在的树使用文件中保存的页大小，而不是调用者传入的
+        self._file_metadata = self._read_file_metadata()
+        if self._file_metadata:
+            page_size = int.from_bytes(
+                self._file_metadata[FILE_HEADER_LENGTH + PAGE_REFERENCE_BYTES:
+                                    FILE_HEADER_LENGTH + PAGE_REFERENCE_BYTES
+                                    + OTHER_BYTES],
+                ENDIAN
+            )
+            self._tree_conf = tree_conf = tree_conf._replace(
+                page_size=page_size
+            )
+            self._checkpoints = checkpoint_counter(self._file_metadata)
+        else:
+            self._checkpoints = 0
+        if direct_io:
+            self._open_direct()
+        # 大部分读取是随机的单点查找，关闭内核的预读
+        self._advise(_FADV_RANDOM)
+
+        self._wal = WAL(filename, tree_conf.page_size, metrics)
+        if self._wal.need_recovery:
+            self.perform_checkpoint(reopen_wal=True)
+
+        # 获取最后一个已使用的页
+        if self._compression:
+            self.last_page = max(self._extents, default=0)
+        else:
+            self._fd.seek(0, io.SEEK_END)
+            last_byte = self._fd.tell()
+            self.last_page = int(last_byte / self._tree_conf.page_size)
+        # 上一次提交时的 (last_page, 空闲页链表)，回滚时恢复
+        self._committed_state = (self.last_page, self._freelist_start_page)
 
     def __repr__(self):
         return "<FileMemory: {}>".format(self._filename)
 
     def get_node(self, page: int) -> Node:
-        pass
+        node = self.get_cached_node(page)
+        if node is not None:
+            return node
+
+        # 读取和解析页的时候持有这个页的共享 latch，而不是缓存锁，
+        # 这样正在修改这个页的写者提交之后，旧的数据不会再被放回缓存中
+        with self.latch(page):
+            with self._cache_lock:
+                node = self._cache.get(page)
+            if node is not None:
+                return node
+
+            data = self._wal.get_page(page)
+            if not data:
+                data = self._read_page(page)
+
+            node = self._load_node(page, data)
+            with self._cache_lock:
+                self._cache[node.page] = node
+        return node
+
+    def get_cached_node(self, page: int) -> Optional[Node]:
+        """ 只从缓存中获取节点，不在缓存中时返回 None，不会读取文件 """
+        node = self._dirty_pages.get(page)
+        if node is None:
+            with self._cache_lock:
+                node = self._cache.get(page)
+        if node is not None and self._metrics is not None:
+            self._metrics.incr('cache.hit.' + type(node).__name__)
+        return node
+
+    def read_nodes(self, pages: list) -> list:
+        """ 一次读取多个节点，按照 pages 的顺序返回
+
+        已经在缓存中的节点直接返回，其他的节点读取后不会放入缓存，
+        树文件中连续的页合并成一次读取，用于范围遍历时的预读。
+        """
+        nodes = dict()
+        to_read = list()
+        for page in pages:
+            node = self.get_cached_node(page)
+            if node is None:
+                data = self._wal.get_page(page)
+                if data:
+                    node = self._load_node(page, data)
+            if node is None:
+                to_read.append(page)
+            else:
+                nodes[page] = node
+
+        page_size = self._tree_conf.page_size
+        to_read.sort()
+        with self.sequential_access():
+            for page, count in _page_runs(to_read):
+                data = self._read_pages(page, count)
+                for i in range(count):
+                    nodes[page + i] = self._load_node(
+                        page + i, data[i * page_size:(i + 1) * page_size]
+                    )
+
+        return [nodes[page] for page in pages]
+
+    def prefetch(self, pages: list):
+        """ 提示内核在后台读取这些页，游标用它预读下一批叶子节点 """
+        if self._direct_fd is not None or self._compression:
+            return
+        page_size = self._tree_conf.page_size
+        for page, count in _page_runs(sorted(
+                page for page in pages if self.get_cached_node(page) is None
+        )):
+            self._advise(_FADV_WILLNEED,
+                         page * page_size, count * page_size)
+
+    @contextlib.contextmanager
+    def sequential_access(self):
+        """ 在范围遍历和批量加载的过程中提示内核顺序读取树文件
+
+        多个线程可以同时进入，最后一个退出时恢复为随机读取
+        """
+        with self._advice_lock:
+            self._sequential_readers += 1
+            if self._sequential_readers == 1:
+                self._advise(_FADV_SEQUENTIAL)
+        try:
+            yield
+        finally:
+            with self._advice_lock:
+                self._sequential_readers -= 1
+                if not self._sequential_readers:
+                    self._advise(_FADV_RANDOM)
 
     def set_node(self, node: Node):
+        """ 标记一个节点被修改了，节点在写事务提交时才被写入 WAL """
+        self._dirty_pages[node.page] = node
+        with self._cache_lock:
+            self._cache[node.page] = node
+
+    @timed_operation('commit')
+    def commit_node(self, node: Node):
+        """ 将一个节点的修改作为一个单独的事务提交
+
+        调用者只需要持有读事务和这个节点的排他 latch，
+        多个线程可以同时提交不同的节点。
+        写入 WAL 时持有 _wal_lock，fsync 在锁外进行，由 _sync_wal 合并。
+        """
+        data = self._dump_node(node)
+        with self._wal_lock:
+            try:
+                self._wal.commit_pages([(node.page, data)], fsync=False)
+            except BaseException:
+                # 缓存中的节点已经被修改了，但是修改没有被持久化
+                with self._cache_lock:
+                    self._cache.pop(node.page, None)
+                self._wal.rollback()
+                raise
+            self._wal_written += 1
+            ticket = self._wal_written
+        self._sync_wal(ticket)
+        with self._cache_lock:
+            self._cache[node.page] = node
+
+    def _sync_wal(self, ticket: int):
+        """ 组提交: 等待序号不超过 ticket 的提交都被 fsync
+
+        一个线程 fsync 的时候，其他线程继续写入 WAL 然后等待，
+        下一次 fsync 把这期间写入的所有提交一起持久化，
+        不同叶子节点的乐观写入不会因为 fsync 而完全串行。
+        """
+        with self._sync_cond:
+            while self._wal_synced < ticket:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                # 序号在写入完成之后才增加，target 之前的提交都已经写入
+                target = self._wal_written
+                self._sync_cond.release()
+                try:
+                    self._wal.sync()
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    self._sync_cond.notify_all()
+                self._wal_synced = target
+                if self._metrics is not None:
+                    self._metrics.incr('wal.group_commits')
+
+    @contextlib.contextmanager
+    def latch(self, page: int, exclusive: bool = False):
+        """ 获取一个页的 latch，同一个线程可以重复获取
+
+        latch 只保护单个页中的 entries，树的结构由 read_transaction 和
+        write_transaction 保护：持有读事务时，只有叶子节点可能被修改。
+        """
+        with self._latches_lock:
+            latch = self._latches.get(page)
+            if latch is None:
+                latch = self._latches[page] = [rwlock.RWLock(), 0]
+            latch[1] += 1
+
+        lock = latch[0].writer_lock if exclusive else latch[0].reader_lock
+        lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+            with self._latches_lock:
+                latch[1] -= 1
+                if latch[1] == 0:
+                    del self._latches[page]
+
+    @property
+    def next_available_page(self) -> int:
+        """ 分配一个页，优先使用空闲页链表中的页 """
+        if self._freelist_start_page:
+            freelist_node = self.get_node(self._freelist_start_page)
+            if freelist_node.entries:
+                page = freelist_node.entries.pop()
+                self.set_node(freelist_node)
+                return page
+            # 链表中的节点已经空了，它所在的页本身也可以使用
+            self._forget_page(freelist_node.page)
+            self._set_freelist_start(freelist_node.next_page or 0)
+            return freelist_node.page
+
+        self.last_page += 1
+        return self.last_page
+
+    def del_page(self, page: int):
+        """ 释放一个页，把它放入空闲页链表，需要在写事务中调用 """
+        self._forget_page(page)
+        self._freed_pages.append(page)
+        if self._freelist_start_page:
+            freelist_node = self.get_node(self._freelist_start_page)
+            if freelist_node.can_add_entry:
+                freelist_node.entries.append(page)
+                self.set_node(freelist_node)
+                return
+
+        # 用这个页本身保存新的链表节点
+        freelist_node = FreelistNode(self._tree_conf, page=page,
+                                     next_page=self._freelist_start_page)
+        self.set_node(freelist_node)
+        self._set_freelist_start(page)
+
+    def _forget_page(self, page: int):
+        self._dirty_pages.pop(page, None)
+        with self._cache_lock:
+            self._cache.pop(page, None)
+
+    def _set_freelist_start(self, page: int):
+        self._freelist_start_page = page
+        self.set_metadata(self._root_node_page, self._tree_conf)
+
+    @property
+    def read_transaction(self):
+
+        class ReadTransaction:
+
+            def __enter__(self2):
+                self._lock.reader_lock.acquire()
+
+            def __exit__(self2, exc_type, exc_val, exc_tb):
+                self._lock.reader_lock.release()
+
+        return ReadTransaction()
+
+    @property
+    def write_transaction(self):
+
+        class WriteTransaction:
+
+            def __enter__(self2):
+                self._lock.writer_lock.acquire()
+                self._write_depth += 1
+                self._writer = threading.get_ident()
+
+            def __exit__(self2, exc_type, exc_val, exc_tb):
+                self._write_depth -= 1
+                try:
+                    if self._write_depth:
+                        # 嵌套的写事务由最外层的写事务提交或者回滚
+                        return
+                    self._writer = None
+                    if exc_type:
+                        self.rollback()
+                        return
+                    try:
+                        self.commit()
+                    except BaseException:
+                        self.rollback()
+                        raise
+                finally:
+                    self._lock.writer_lock.release()
+
+        return WriteTransaction()
+
+    @property
+    def in_write_transaction(self) -> bool:
+        """ 当前线程是否持有写事务 """
+        return self._writer == threading.get_ident()
+
+    @timed_operation('commit')
+    def commit(self):
+        """ 把修改过的页按照页号排序，和 COMMIT 帧一起一次写入 WAL """
+        if self._dirty_pages:
+            pages = [
+                (page, node if page == 0 else self._dump_node(node))
+                for page, node in sorted(self._dirty_pages.items())
+            ]
+            with self._wal_lock:
+                self._wal.commit_pages(pages)
+            self._dirty_pages.clear()
+        self._wal.commit()
+        self._committed_state = (self.last_page, self._freelist_start_page)
+        if self._freed_pages:
+            self._drop_freed_pages()
+
+    def rollback(self):
+        # 写入过程中出错时，缓存中的节点可能已经被部分修改了，所以需要清空缓存
+        self._dirty_pages.clear()
+        self._freed_pages.clear()
+        self.last_page, self._freelist_start_page = self._committed_state
+        self._wal.rollback()
+        with self._cache_lock:
+            self._cache.clear()
+        if self.on_rollback is not None:
+            self.on_rollback()
+
+    @property
+    def has_metadata(self) -> bool:
+        """ 元数据是否已经写入过，新的树为 False """
+        return bool(self._dirty_pages.get(0) or self._wal.get_page(0)
+                    or self._file_metadata)
+
+    def get_metadata(self) -> tuple:
+        """ 从第 0 页中读取树的元数据
+
+        树文件中的元数据在打开时已经读取过了，
+        没有被修改过时 (不在 WAL 中) 不需要再读取文件。
+
+        :return: (根节点所在的页, TreeConf)
+        """
+        data = (self._dirty_pages.get(0) or self._wal.get_page(0)
+                or self._file_metadata)
+        if not data:
+            raise ValueError('Metadata not set yet')
+
+        (self._root_node_page, self._freelist_start_page,
+         self._tree_conf) = parse_metadata(data, self._tree_conf)
+        self._committed_state = (self.last_page, self._freelist_start_page)
+        return self._root_node_page, self._tree_conf
+
+    def set_metadata(self, root_node_page: int, tree_conf: TreeConf):
+        """ 将树的元数据写入第 0 页
+
+        元数据和节点一样写入 WAL 中，保证它和根节点的修改在同一个事务中提交
+        """
+        self._tree_conf = tree_conf
+        self._root_node_page = root_node_page
+        flags = 0
+        if tree_conf.order_statistics:
+            flags |= METADATA_FLAG_ORDER_STATISTICS
+        field_ids = getattr(tree_conf.serializer, 'field_ids', ())
+        layout = bytes((len(field_ids),) + field_ids)
+        data = (
+            file_header(self._compression)
+            + root_node_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+            + tree_conf.page_size.to_bytes(OTHER_BYTES, ENDIAN)
+            + tree_conf.order.to_bytes(OTHER_BYTES, ENDIAN)
+            + tree_conf.key_size.to_bytes(OTHER_BYTES, ENDIAN)
+            + tree_conf.value_size.to_bytes(OTHER_BYTES, ENDIAN)
+            + self._freelist_start_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+            + flags.to_bytes(OTHER_BYTES, ENDIAN)
+            + tree_conf.serializer.serializer_id.to_bytes(OTHER_BYTES, ENDIAN)
+            + layout.ljust(TUPLE_LAYOUT_BYTES, b'\0')
+            + self._checkpoints.to_bytes(CHECKPOINT_COUNTER_BYTES, ENDIAN)
+            + bytes(tree_conf.page_size - METADATA_LENGTH)
+        )
+        self._dirty_pages[0] = data
+
+    def open_snapshot(self) -> 'SnapshotMemory':
+        """ 打开一个快照，快照中只能看到当前已经提交的页
+
+        调用者需要持有读事务，保证没有写到一半的结构修改。
+        """
+        with self._wal_lock:
+            snapshot = SnapshotMemory(self, self._wal.snapshot(),
+                                      self._wal.end)
+        self._snapshots.add(snapshot)
+        return snapshot
+
+    def release_snapshot(self, snapshot: 'SnapshotMemory'):
+        self._snapshots.discard(snapshot)
+
+    def close(self):
+        if self._snapshots:
+            raise ValueError('Cannot close {} with {} open snapshots'.format(
+                self._filename, len(self._snapshots)
+            ))
+        self.perform_checkpoint()
+        self._fd.close()
+        if self._direct_fd is not None:
+            os.close(self._direct_fd)
+        if self._dir_fd is not None:
+            os.close(self._dir_fd)
+
+    @timed_operation('checkpoint')
+    def perform_checkpoint(self, reopen_wal=False) -> bool:
+        """ 将 WAL 中已经提交的页写回到树文件中
+
+        快照会从树文件中读取 WAL 之外的页，所以有快照没有关闭时只写回最老的快照
+        打开之前提交的页，它们正是这个快照看到的版本，其他快照从树文件中读取的页
+        不会被修改；WAL 中只留下之后的帧，返回 False。
+        其他进程中的 MmapMemory 在每次读取时持有树文件的共享锁，checkpoint
+        先关闭它们的 turnstile，新的读取不能开始，再等待正在进行的读取结束，
+        拿到树文件的排他锁，不断有读者的时候 checkpoint 也不会被饿死。
+        """
+        snapshots = list(self._snapshots)
+        oldest = min(snapshots, key=lambda s: s.position, default=None)
+        if oldest is not None:
+            logger.info('Partial checkpoint of {}, {} snapshots are open'
+                        .format(self._filename, len(snapshots)))
+
+        turnstile = self._close_turnstile()
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._checkpoint_locked(oldest)
+        finally:
+            if turnstile is not None:
+                # 关闭文件同时释放锁
+                os.close(turnstile)
+        if oldest is not None:
+            return False
+        if reopen_wal:
+            self._wal = WAL(self._filename, self._tree_conf.page_size,
+                            self._metrics)
+        return True
+
+    def _close_turnstile(self) -> Optional[int]:
+        """ 有只读的读者时，排他地锁住它们的 turnstile 文件，返回文件描述符 """
+        if fcntl is None:
+            return None
+        try:
+            fd = os.open(self._filename + TURNSTILE_SUFFIX, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _checkpoint_locked(self, oldest: Optional['SnapshotMemory']):
+        """ oldest 不为 None 时只写回这个快照中的页，然后丢弃它之前的帧 """
+        try:
+            logger.info('Performing checkpoint of {}'.format(self._filename))
+            if oldest is None:
+                frames = self._wal.checkpoint()
+            else:
+                frames = self._wal.read_frames(oldest.committed_pages)
+            metadata_page = None
+            written = False
+            for page, page_data in frames:
+                if page == 0:
+                    metadata_page = page_data
+                else:
+                    self._write_page_in_tree(page, page_data, fsync=False)
+                    written = True
+            if written or metadata_page is not None:
+                self._write_checkpoint_counter(metadata_page)
+            fsync_file_and_dir(self._fd.fileno(), self._dir_fd,
+                               self._metrics)
+            if self._compression:
+                # 快照不持有锁，读取树文件时文件不能被压实替换
+                self._checkpoint_extents(compact=oldest is None)
+            if oldest is not None:
+                self._wal.drop_before(oldest.position)
+            if self._direct_fd is not None:
+                # 读取不经过页缓存，checkpoint 写入的页不需要留在页缓存中
+                self._advise(_FADV_DONTNEED)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _load_node(self, page: int, data: bytes) -> Node:
+        """ 解析从文件中读取的页，不在缓存中的节点都经过这里 """
+        if self._metrics is None:
+            return Node.from_page_data(self._tree_conf, data=data, page=page)
+
+        start = time.perf_counter()
+        node = Node.from_page_data(self._tree_conf, data=data, page=page)
+        self._metrics.observe('node.load', time.perf_counter() - start)
+        self._metrics.incr('cache.miss.' + type(node).__name__)
+        return node
+
+    def _dump_node(self, node: Node) -> bytes:
+        if self._metrics is None:
+            return node.dump()
+
+        start = time.perf_counter()
+        data = node.dump()
+        self._metrics.observe('node.dump', time.perf_counter() - start)
+        return data
+
+    def _open_file_header(self, compression: Optional[str]) -> Optional[str]:
+        """ 检查文件头，返回文件使用的压缩算法
+
+        新的压缩文件在这里写入文件头，不压缩的文件的文件头是第 0 页的一部分，
+        checkpoint 时和元数据一起写入
+        """
+        try:
+            header = pread_from_file(self._fd, 0, FILE_HEADER_LENGTH)
+        except ReachedEndOfFile:
+            if os.fstat(self._fd.fileno()).st_size:
+                raise ValueError('{} is not a GBPlusTree file'.format(
+                    self._filename
+                ))
+            if compression:
+                self._epoch = os.urandom(EPOCH_BYTES)
+                write_to_file(self._fd, self._dir_fd,
+                              file_header(compression) + self._epoch,
+                              metrics=self._metrics)
+            return compression
+
+        stored = parse_file_header(header, self._filename)
+        if compression is not None and compression != stored:
+            raise ValueError('{} was created with compression {}'.format(
+                self._filename, stored
+            ))
+        if stored:
+            try:
+                self._epoch = pread_from_file(self._fd, FILE_HEADER_LENGTH,
+                                              COMPRESSED_HEADER_LENGTH)
+            except ReachedEndOfFile:
+                raise ValueError('{} has a truncated file header'.format(
+                    self._filename
+                ))
+        return stored
+
+    def _read_file_metadata(self) -> Optional[bytes]:
+        """ 读取树文件中第 0 页开头的元数据，新的树文件返回 None """
+        if self._compression:
+            if 0 not in self._extents:
+                return None
+            # 这时还不知道页大小，不能使用 _read_compressed_page
+            start, length = self._extents[0]
+            data = pread_from_file(self._fd, start, start + length)
+            return self._codec.decompress(data)[:METADATA_LENGTH]
+
+        try:
+            return pread_from_file(self._fd, 0, METADATA_LENGTH)
+        except ReachedEndOfFile:
+            return None
+
+    def _read_page(self, page: int) -> bytes:
+        if self._metrics is not None:
+            self._metrics.incr('pages.read')
+        if self._compression:
+            return self._read_compressed_page(page)
+
+        start = page * self._tree_conf.page_size
+        stop = start + self._tree_conf.page_size
+        assert stop - start == self._tree_conf.page_size
+        return self._pread(start, stop)
+
+    def _read_pages(self, page: int, count: int) -> bytes:
+        """ 读取从 page 开始的 count 个连续的页 """
+        if self._metrics is not None:
+            self._metrics.incr('pages.read', count)
+        if self._compression:
+            return b''.join(self._read_compressed_page(p)
+                            for p in range(page, page + count))
+
+        start = page * self._tree_conf.page_size
+        stop = start + count * self._tree_conf.page_size
+        return self._pread(start, stop)
+
+    def _open_direct(self):
+        if self._tree_conf.page_size % DIRECT_IO_ALIGNMENT:
+            raise ValueError('O_DIRECT needs a page size multiple of {}'.format(
+                DIRECT_IO_ALIGNMENT
+            ))
+        try:
+            self._direct_fd = os.open(self._filename,
+                                      os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            raise ValueError('Cannot open {} with O_DIRECT: {}'.format(
+                self._filename, e
+            ))
+
+    def _pread(self, start: int, stop: int) -> bytes:
+        """ 读取树文件的 [start, stop)，O_DIRECT 模式下读入按页对齐的缓冲区 """
+        if self._direct_fd is None:
+            return pread_from_file(self._fd, start, stop)
+
+        length = stop - start
+        buffer = getattr(self._direct_buffers, 'buffer', None)
+        if buffer is None or len(buffer) < length:
+            if buffer is not None:
+                buffer.close()
+            # 匿名映射总是按页对齐的
+            buffer = self._direct_buffers.buffer = mmap.mmap(-1, length)
+        with memoryview(buffer) as view:
+            read = os.preadv(self._direct_fd, [view[:length]], start)
+        if read < length:
+            raise ReachedEndOfFile('Read until the end of file')
+        return buffer[:length]
+
+    def _advise(self, advice: int, start: int = 0, length: int = 0):
+        """ 调用 posix_fadvise，length 为 0 表示到文件末尾，平台不支持时忽略 """
+        if _fadvise is None:
+            return
+        try:
+            _fadvise(self._fd.fileno(), start, length, advice)
+        except OSError:
+            # 提示失败不影响正确性
+            pass
+
+    def _drop_freed_pages(self):
+        """ 被释放的页中的数据不会再被读取，提示内核丢弃它们的页缓存 """
+        freed, self._freed_pages = sorted(self._freed_pages), []
+        if self._compression:
+            return
+        page_size = self._tree_conf.page_size
+        for page, count in _page_runs(freed):
+            self._advise(_FADV_DONTNEED,
+                         page * page_size, count * page_size)
+
+    def _write_page_in_tree(self, page: int, data: Union[bytes, bytearray],
+                            fsync: bool = True):
+        """ 直接将一页数据写入到树文件中，只在 checkpoint 等场景中使用 """
+        assert len(data) == self._tree_conf.page_size
+        if self._metrics is not None:
+            self._metrics.incr('pages.written')
+        if self._compression:
+            self._write_compressed_page(page, data, fsync)
+            return
+
+        self._fd.seek(page * self._tree_conf.page_size)
+        write_to_file(self._fd, self._dir_fd, data, fsync=fsync,
+                      metrics=self._metrics)
+
+    @property
+    def _extent_map_filename(self) -> str:
+        return self._filename + '-extents'
+
+    def _load_extents(self):
+        """ 重建页号到 extent 的映射
+
+        checkpoint 时映射被保存在 filename-extents 中，打开时只需要扫描
+        它之后追加的 extent；映射文件不存在或者已经过期时扫描整个文件。
+        同一个页可能被写入多次，后写入的 extent 覆盖先写入的。
+        文件末尾不完整的 extent (checkpoint 时崩溃) 会被忽略，
+        后续的写入会直接覆盖它，其中的数据会在 WAL 恢复时重新写入。
+        """
+        start = self._read_extent_map()
+        while True:
+            try:
+                header = read_from_file(self._fd, start,
+                                        start + EXTENT_HEADER_LENGTH)
+                page = int.from_bytes(header[:PAGE_REFERENCE_BYTES], ENDIAN)
+                length = int.from_bytes(header[PAGE_REFERENCE_BYTES:], ENDIAN)
+                data_start = start + EXTENT_HEADER_LENGTH
+                # 只检查 extent 是否完整，真正的读取在缓存未命中时进行
+                read_from_file(self._fd, data_start + length - 1,
+                               data_start + length)
+            except ReachedEndOfFile:
+                break
+            self._set_extent(page, data_start, length)
+            start = data_start + length
+        self._extents_end = start
+
+    def _read_extent_map(self) -> int:
+        """ 读取保存的映射，返回需要开始扫描的位置 """
+        try:
+            with open(self._extent_map_filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return COMPRESSED_HEADER_LENGTH
+
+        if len(data) >= EXTENT_MAP_HEADER.size:
+            epoch, end, count = EXTENT_MAP_HEADER.unpack_from(data)
+            if (epoch == self._epoch
+                    and end <= os.fstat(self._fd.fileno()).st_size
+                    and len(data) == EXTENT_MAP_HEADER.size
+                    + count * EXTENT_MAP_ENTRY.size):
+                for page, start, length in EXTENT_MAP_ENTRY.iter_unpack(
+                        memoryview(data)[EXTENT_MAP_HEADER.size:]):
+                    self._set_extent(page, start, length)
+                self._saved_extents_end = end
+                return end
+
+        logger.info('Ignoring the stale extent map of {}'.format(
+            self._filename
+        ))
+        return COMPRESSED_HEADER_LENGTH
+
+    def _set_extent(self, page: int, start: int, length: int):
+        old = self._extents.get(page)
+        if old is not None:
+            self._live_bytes -= EXTENT_HEADER_LENGTH + old[1]
+        self._extents[page] = (start, length)
+        self._live_bytes += EXTENT_HEADER_LENGTH + length
+
+    def _write_checkpoint_counter(self, metadata_page: Optional[bytes]):
+        """ checkpoint 写入其他的页之后，把计数器加一的第 0 页写入树文件
+
+        metadata_page 为 None 时 (元数据没有被修改) 使用树文件中的元数据，
+        第 0 页中元数据之后都是 0；还没有元数据时什么也不做
+        """
+        if metadata_page is None:
+            if self._file_metadata is None:
+                return
+            metadata_page = self._file_metadata.ljust(
+                self._tree_conf.page_size, b'\0'
+            )
+        self._checkpoints += 1
+        data = bytearray(metadata_page)
+        data[METADATA_LENGTH - CHECKPOINT_COUNTER_BYTES:METADATA_LENGTH] = \
+            self._checkpoints.to_bytes(CHECKPOINT_COUNTER_BYTES, ENDIAN)
+        self._write_page_in_tree(0, data, fsync=False)
+        self._file_metadata = bytes(data[:METADATA_LENGTH])
+
+    def _checkpoint_extents(self, compact: bool = True):
+        """ checkpoint 写入的 extent 已经 fsync 之后调用
+
+        旧的 extent 太多 (并且 compact 为 True) 时压实文件，然后保存映射，
+        下一次打开时不需要扫描整个文件
+        """
+        dead_bytes = (self._extents_end - COMPRESSED_HEADER_LENGTH
+                      - self._live_bytes)
+        if compact and dead_bytes > max(self._live_bytes,
+                                        COMPACTION_MIN_BYTES):
+            self._compact_extents()
+        if self._saved_extents_end != self._extents_end:
+            data = bytearray(EXTENT_MAP_HEADER.pack(
+                self._epoch, self._extents_end, len(self._extents)
+            ))
+            for page, (start, length) in self._extents.items():
+                data += EXTENT_MAP_ENTRY.pack(page, start, length)
+            replace_file(self._extent_map_filename, data, self._dir_fd)
+            self._saved_extents_end = self._extents_end
+
+    def _compact_extents(self):
+        """ 把有效的 extent 按照原来的顺序复制到新的文件中，再替换树文件
+
+        新的文件使用新的 epoch，替换之后旧的映射文件自动失效，
+        替换之前崩溃时，原来的树文件和映射文件都没有被修改。
+        """
+        logger.info('Compacting {}, {} of {} bytes are live'.format(
+            self._filename, self._live_bytes, self._extents_end
+        ))
+        epoch = os.urandom(EPOCH_BYTES)
+        path = self._filename + '-compact'
+        extents = dict()
+        with open(path, 'wb', buffering=0) as f:
+            buffer = bytearray(file_header(self._compression) + epoch)
+            end = len(buffer)
+            for page, (start, length) in sorted(self._extents.items(),
+                                                key=lambda item: item[1]):
+                buffer += page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+                buffer += length.to_bytes(OTHER_BYTES, ENDIAN)
+                buffer += pread_from_file(self._fd, start, start + length)
+                extents[page] = (end + EXTENT_HEADER_LENGTH, length)
+                end += EXTENT_HEADER_LENGTH + length
+                if len(buffer) >= 1 << 20:
+                    write_to_file(f, None, buffer, fsync=False)
+                    buffer = bytearray()
+            write_to_file(f, None, buffer, metrics=self._metrics)
+        os.replace(path, self._filename)
+        if self._dir_fd is not None:
+            os.fsync(self._dir_fd)
+
+        self._fd.close()
+        self._fd = open(self._filename, mode='r+b', buffering=0)
+        self._advise(_FADV_RANDOM)
+        self._epoch = epoch
+        self._extents = extents
+        self._extents_end = end
+        self._saved_extents_end = None
+
+    def _read_compressed_page(self, page: int) -> bytes:
+        try:
+            start, length = self._extents[page]
+        except KeyError:
+            raise ReachedEndOfFile('Page {} not in file'.format(page))
+
+        data = self._codec.decompress(
+            pread_from_file(self._fd, start, start + length)
+        )
+        assert len(data) == self._tree_conf.page_size
+        return data
+
+    def _write_compressed_page(self, page: int, data: Union[bytes, bytearray],
+                               fsync: bool):
+        """ 将页压缩后追加到文件末尾，旧的 extent 在压实文件时被回收 """
+        compressed = self._codec.compress(bytes(data))
+        extent = (
+            page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+            + len(compressed).to_bytes(OTHER_BYTES, ENDIAN)
+            + compressed
+        )
+        self._fd.seek(self._extents_end)
+        write_to_file(self._fd, self._dir_fd, extent, fsync=fsync,
+                      metrics=self._metrics)
+        self._set_extent(page, self._extents_end + EXTENT_HEADER_LENGTH,
+                         len(compressed))
+        self._extents_end += len(extent)
+
+
+class SnapshotMemory:
+    """ FileMemory 在某个时刻的只读视图
+
+    WAL 只会在末尾追加帧，所以快照只需要保存打开时已经提交的页在 WAL 中的位置
+    和 WAL 的末尾 position，其他的页从树文件中读取。checkpoint 只会把 position
+    之前的帧写回树文件，这些页都在最老的快照中，被丢弃的帧从树文件中读取。
+    快照有自己的缓存，不会看到 FileMemory 的缓存中被修改的节点。
+    """
+
+    __slots__ = ['_memory', 'committed_pages', 'position', '_cache',
+                 '_cache_lock', '__weakref__']
+
+    def __init__(self, memory: FileMemory, committed_pages: dict,
+                 position: int, cache_size: int = 64):
+        self._memory = memory
+        self.committed_pages = committed_pages
+        self.position = position
+        self._cache = cachetools.LRUCache(maxsize=cache_size)
+        self._cache_lock = threading.Lock()
+
+    def get_node(self, page: int) -> Node:
+        with self._cache_lock:
+            node = self._cache.get(page)
+        if node is not None:
+            return node
+
+        page_start = self.committed_pages.get(page)
+        data = None
+        if page_start:
+            data = self._memory._wal.read_frame(page_start)
+        if data is None:
+            data = self._memory._read_page(page)
+
+        node = self._memory._load_node(page, data)
+        with self._cache_lock:
+            self._cache[node.page] = node
+        return node
+
+    def read_nodes(self, pages: list) -> list:
+        return [self.get_node(page) for page in pages]
+
+    def prefetch(self, pages: list):
         pass
 
+    def sequential_access(self):
+        return contextlib.nullcontext()
+
+    @property
+    def read_transaction(self):
+        # 快照中的页不会被修改，不需要加锁
+        return contextlib.nullcontext()
+
+    def latch(self, page: int, exclusive: bool = False):
+        return contextlib.nullcontext()
+
     def close(self):
+        self._memory.release_snapshot(self)
+        self._cache.clear()
+
+    def __repr__(self):
+        return '<SnapshotMemory: {} pages in WAL>'.format(
+            len(self.committed_pages)
+        )
+
+
+class MmapMemory:
+    """ 只读地把树文件映射到内存中，用于多个进程共享同一个树文件
+
+    所有进程映射的是同一份操作系统的页缓存，每个进程只缓存少量解析过的节点。
+    不会创建 WAL，也不需要写锁和 fsync，只能看到写者 checkpoint 之后的数据。
+    压缩的树文件不能被映射，打开时抛出 ValueError。
+
+    读取时持有树文件的共享锁 (flock)，写者在 checkpoint 时需要排他锁，
+    所以读取的过程中树文件不会被修改。每个读事务开始之前先通过 filename-turnstile
+    (获取并立即释放它的共享锁)，写者等待时新的读事务不会开始，写者不会被饿死。
+    这个进程中第一个读者开始读取时检查元数据中的 checkpoint 计数器，
+    树文件被 checkpoint 过时清空缓存并重新读取元数据 (文件大小改变时重新映射)，
+    generation 加一。
+    """
+
+    __slots__ = ['_filename', '_tree_conf', '_fd', '_turnstile', '_mmap',
+                 '_checkpoints', '_cache', '_cache_lock', '_readers', '_readers_lock',
+                 '_depth', '_metrics', 'root_node_page', 'generation']
+
+    def __init__(self, filename: str, tree_conf: TreeConf,
+                 cache_size: int = 64, metrics: Optional[Metrics] = None):
+        _import_dependencies()
+        self._filename = filename
+        self._tree_conf = tree_conf
+        self._metrics = metrics
+        self._fd = open(filename, 'rb')
+        self._turnstile = None
+        if fcntl is not None:
+            try:
+                self._turnstile = os.open(filename + TURNSTILE_SUFFIX,
+                                          os.O_RDONLY | os.O_CREAT, 0o644)
+            except OSError:
+                # 不能创建 turnstile (例如只读的目录) 时，写者可能需要多等待一会
+                logger.warning('Cannot create the turnstile of {}'.format(
+                    filename
+                ))
+        self._mmap = None
+        self._checkpoints = None
+        if cache_size == 0:
+            self._cache = FakeCache()
+        else:
+            self._cache = cachetools.LRUCache(maxsize=cache_size)
+        self._cache_lock = threading.Lock()
+        # 这个进程中正在读取的读者的个数，第一个读者获取共享锁，最后一个释放
+        self._readers = 0
+        self._readers_lock = threading.Lock()
+        # 每个线程中读事务嵌套的层数，只有最外层的读事务需要通过 turnstile
+        self._depth = threading.local()
+        self.root_node_page = 0
+        self.generation = 0
+        try:
+            with self.read_transaction:
+                pass
+        except BaseException:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return '<MmapMemory: {}>'.format(self._filename)
+
+    def get_node(self, page: int) -> Node:
+        with self._cache_lock:
+            node = self._cache.get(page)
+        if node is not None:
+            if self._metrics is not None:
+                self._metrics.incr('cache.hit.' + type(node).__name__)
+            return node
+
+        node = self._load_node(page)
+        with self._cache_lock:
+            self._cache[node.page] = node
+        return node
+
+    def read_nodes(self, pages: list) -> list:
+        """ 和 FileMemory.read_nodes 一样，读取的节点不会放入缓存 """
+        rv = []
+        for page in pages:
+            with self._cache_lock:
+                node = self._cache.get(page)
+            rv.append(node if node is not None else self._load_node(page))
+        return rv
+
+    def prefetch(self, pages: list):
         pass
 
+    def sequential_access(self):
+        return contextlib.nullcontext()
+
+    @property
+    def read_transaction(self):
+        return self._read_transaction()
+
+    @contextlib.contextmanager
+    def _read_transaction(self):
+        depth = getattr(self._depth, 'value', 0)
+        if not depth and self._turnstile is not None:
+            # 不能持有 _readers_lock，正在读取的其他线程需要结束读事务
+            fcntl.flock(self._turnstile, fcntl.LOCK_SH)
+            fcntl.flock(self._turnstile, fcntl.LOCK_UN)
+        self._depth.value = depth + 1
+        try:
+            with self._shared_lock():
+                yield
+        finally:
+            self._depth.value = depth
+
+    @contextlib.contextmanager
+    def _shared_lock(self):
+        with self._readers_lock:
+            if not self._readers:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_SH)
+                try:
+                    self._refresh()
+                except BaseException:
+                    if fcntl is not None:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                    raise
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._readers_lock:
+                self._readers -= 1
+                if not self._readers and fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def latch(self, page: int, exclusive: bool = False):
+        # 映射中的页只会在没有读者时被修改
+        return contextlib.nullcontext()
+
+    def get_metadata(self) -> tuple:
+        return self.root_node_page, self._tree_conf
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._fd.close()
+        if self._turnstile is not None:
+            os.close(self._turnstile)
+            self._turnstile = None
+        self._cache.clear()
+
+    def _refresh(self):
+        """ 树文件在上一次读取之后被 checkpoint 过时，重新读取元数据
+
+        映射和页缓存是共享的，原地覆盖的页在映射中直接可见，
+        只有文件的大小改变时才需要重新映射
+        """
+        size = os.fstat(self._fd.fileno()).st_size
+        if self._mmap is None or size != len(self._mmap):
+            if size < METADATA_LENGTH:
+                raise ValueError('{} is not a tree file'.format(
+                    self._filename
+                ))
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._fd.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            if parse_file_header(self._mmap[:FILE_HEADER_LENGTH],
+                                 self._filename):
+                raise ValueError('{} has compressed pages, only uncompressed '
+                                 'trees can be opened read-only'.format(
+                                     self._filename
+                                 ))
+            self._checkpoints = None
+
+        metadata = self._mmap[:METADATA_LENGTH]
+        checkpoints = checkpoint_counter(metadata)
+        if checkpoints == self._checkpoints:
+            return
+        self._checkpoints = checkpoints
+        self.root_node_page, _, self._tree_conf = parse_metadata(
+            metadata, self._tree_conf
+        )
+        with self._cache_lock:
+            self._cache.clear()
+        self.generation += 1
+
+    def _load_node(self, page: int) -> Node:
+        page_size = self._tree_conf.page_size
+        start = page * page_size
+        if start + page_size > len(self._mmap):
+            raise ReachedEndOfFile('Page {} not in file'.format(page))
+        data = self._mmap[start:start + page_size]
+        if self._metrics is None:
+            return Node.from_page_data(self._tree_conf, data=data, page=page)
+
+        self._metrics.incr('pages.read')
+        begin = time.perf_counter()
+        node = Node.from_page_data(self._tree_conf, data=data, page=page)
+        self._metrics.observe('node.load', time.perf_counter() - begin)
+        self._metrics.incr('cache.miss.' + type(node).__name__)
+        return node
+
 
 class FakeCache:
     """
@@ -142,25 +1538,43 @@ class FakeCache:
     def __setitem__(self, key, value):
         pass
 
+    def pop(self, key, default=None):
+        return default
+
     def clear(self):
         pass
 
 
+class FrameType(enum.Enum):
+    PAGE = 1
+    COMMIT = 2
+    ROLLBACK = 3
+
+
 class WAL:
 
     __slots__ = ['filename', '_fd', '_dir_fd', '_page_size',
-                 '_committed_pages', '_not_committed_pages', 'need_recovery']
+                 '_committed_pages', '_not_committed_pages', 'need_recovery',
+                 '_metrics', '_base', '_start', '_lock']
 
     FRAME_HEADER_LENGTH = (
         FRAME_TYPE_BYTES + PAGE_REFERENCE_BYTES
     )
 
-    def __init__(self, filename: str, page_size: int):
+    def __init__(self, filename: str, page_size: int,
+                 metrics: Optional[Metrics] = None):
         self.filename = filename + '-wal'
         self._fd, self._dir_fd = open_file_in_dir(self.filename)
         self._page_size = page_size
+        self._metrics = metrics
         self._committed_pages = dict()
         self._not_committed_pages = dict()
+        # 帧的位置是逻辑位置，文件中的偏移量加上 _base，丢弃开头的帧之后不变；
+        # _start 之前的帧已经被丢弃，它们的页在树文件中
+        self._base = 0
+        self._start = 0
+        # 保护 drop_before 替换文件时的读取
+        self._lock = threading.Lock()
 
         self._fd.seek(0, io.SEEK_END)
         if self._fd.tell() == 0:
@@ -172,11 +1586,220 @@ class WAL:
             self.need_recovery = True
             self._load_wal()
 
+    def checkpoint(self):
+        """ 将修改过的数据传回给树文件，并且关闭 WAL """
+        if self._not_committed_pages:
+            logger.warning('Closing WAL with uncommitted data, discarding it')
+
+        fsync_file_and_dir(self._fd.fileno(), self._dir_fd, self._metrics)
+
+        for page, page_start in self._committed_pages.items():
+            page_data = read_from_file(
+                self._fd,
+                page_start - self._base,
+                page_start - self._base + self._page_size
+            )
+            yield page, page_data
+
+        self._fd.close()
+        os.unlink(self.filename)
+        if self._dir_fd is not None:
+            os.fsync(self._dir_fd)
+            os.close(self._dir_fd)
+
     def _create_header(self):
         data = self._page_size.to_bytes(OTHER_BYTES, ENDIAN)
         self._fd.seek(0)
-        write_to_file(self._fd, self._dir_fd, data, True)
+        write_to_file(self._fd, self._dir_fd, data, True, self._metrics)
 
     def _load_wal(self):
         self._fd.seek(0)
         header_data = read_from_file(self._fd, 0, OTHER_BYTES)
+        assert int.from_bytes(header_data, ENDIAN) == self._page_size
+
+        while True:
+            try:
+                self._load_next_frame()
+            except ReachedEndOfFile:
+                break
+        if self._not_committed_pages:
+            logger.warning('WAL has uncommitted data, discarding it')
+            self._not_committed_pages = dict()
+
+    def _load_next_frame(self):
+        start = self._fd.tell()
+        stop = start + self.FRAME_HEADER_LENGTH
+        data = read_from_file(self._fd, start, stop)
+
+        frame_type = int.from_bytes(data[0:FRAME_TYPE_BYTES], ENDIAN)
+        page = int.from_bytes(
+            data[FRAME_TYPE_BYTES:FRAME_TYPE_BYTES+PAGE_REFERENCE_BYTES],
+            ENDIAN
+        )
+
+        frame_type = FrameType(frame_type)
+        if frame_type is FrameType.PAGE:
+            self._fd.seek(stop + self._page_size)
+
+        self._index_frame(frame_type, page, stop + self._base)
+
+    def _index_frame(self, frame_type: FrameType, page: int, page_start: int):
+        if frame_type is FrameType.PAGE:
+            self._not_committed_pages[page] = page_start
+        elif frame_type is FrameType.COMMIT:
+            self._committed_pages.update(self._not_committed_pages)
+            self._not_committed_pages = dict()
+        elif frame_type is FrameType.ROLLBACK:
+            self._not_committed_pages = dict()
+        else:
+            assert False
+
+    def _add_frame(self, frame_type: FrameType, page: Optional[int] = None,
+                   page_data: Optional[bytes] = None):
+        if frame_type is FrameType.PAGE and not page_data:
+            raise ValueError('PAGE frame without page data')
+        if page_data and len(page_data) != self._page_size:
+            raise ValueError('Page data is different from page size')
+        if not page:
+            page = 0
+        if frame_type is not FrameType.PAGE:
+            page_data = b''
+        data = (
+            frame_type.value.to_bytes(FRAME_TYPE_BYTES, ENDIAN)
+            + page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+            + page_data
+        )
+        if self._metrics is not None:
+            start = time.perf_counter()
+        self._fd.seek(0, io.SEEK_END)
+        # 只有 COMMIT 和 ROLLBACK 帧需要 fsync
+        write_to_file(self._fd, self._dir_fd, data,
+                      fsync=frame_type != FrameType.PAGE,
+                      metrics=self._metrics)
+        if self._metrics is not None:
+            self._metrics.observe('wal.write', time.perf_counter() - start)
+            self._metrics.incr('wal.frames')
+            self._metrics.incr('wal.bytes', len(data))
+        self._index_frame(frame_type, page,
+                          self._fd.tell() + self._base - self._page_size)
+
+    def get_page(self, page: int) -> Optional[bytes]:
+        page_start = None
+        for store in (self._not_committed_pages, self._committed_pages):
+            page_start = store.get(page)
+            if page_start:
+                break
+
+        if not page_start:
+            return None
+
+        return self.read_frame(page_start)
+
+    def set_page(self, page: int, page_data: bytes):
+        self._add_frame(FrameType.PAGE, page, page_data)
+
+    def commit_pages(self, pages: list, fsync: bool = True):
+        """ 把 [(页号, 数据)] 和一个 COMMIT 帧一次写入 WAL，只需要一次 fsync
+
+        fsync 为 False 时由调用者之后调用 sync，用于组提交
+        """
+        if self._metrics is not None:
+            start = time.perf_counter()
+        data = bytearray()
+        self._fd.seek(0, io.SEEK_END)
+        file_end = self._fd.tell() + self._base
+        page_starts = dict()
+        for page, page_data in pages:
+            if len(page_data) != self._page_size:
+                raise ValueError('Page data is different from page size')
+            data.extend(FrameType.PAGE.value.to_bytes(FRAME_TYPE_BYTES, ENDIAN))
+            data.extend(page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN))
+            page_starts[page] = file_end + len(data)
+            data.extend(page_data)
+        data.extend(FrameType.COMMIT.value.to_bytes(FRAME_TYPE_BYTES, ENDIAN))
+        data.extend(bytes(PAGE_REFERENCE_BYTES))
+
+        write_to_file(self._fd, self._dir_fd, data, fsync=fsync,
+                      metrics=self._metrics)
+        if self._metrics is not None:
+            self._metrics.observe('wal.write', time.perf_counter() - start)
+            self._metrics.incr('wal.frames', len(pages) + 1)
+            self._metrics.incr('wal.bytes', len(data))
+        self._not_committed_pages.update(page_starts)
+        self._index_frame(FrameType.COMMIT, 0, 0)
+
+    def sync(self):
+        """ fsync 之前用 commit_pages(fsync=False) 写入的所有帧 """
+        fsync_file_and_dir(self._fd.fileno(), self._dir_fd, self._metrics)
+
+    def snapshot(self) -> dict:
+        """ 返回已经提交的页在 WAL 中的位置，之后的提交不会修改它 """
+        return dict(self._committed_pages)
+
+    @property
+    def end(self) -> int:
+        """ WAL 末尾的逻辑位置 """
+        return os.fstat(self._fd.fileno()).st_size + self._base
+
+    def read_frame(self, page_start: int) -> Optional[bytes]:
+        """ 读取一个帧中的页，帧已经被 drop_before 丢弃时返回 None """
+        with self._lock:
+            if page_start < self._start:
+                return None
+            if self._metrics is not None:
+                self._metrics.incr('pages.read')
+            return pread_from_file(self._fd, page_start - self._base,
+                                   page_start - self._base + self._page_size)
+
+    def read_frames(self, page_starts: dict) -> Iterator[tuple]:
+        """ 返回 page_starts 中还没有被丢弃的帧 (页号, 数据) """
+        for page, page_start in page_starts.items():
+            page_data = self.read_frame(page_start)
+            if page_data is not None:
+                yield page, page_data
+
+    def drop_before(self, position: int):
+        """ 丢弃逻辑位置 position 之前的帧，调用者已经把它们的页写回了树文件
+
+        之后的帧被复制到新的 WAL 文件中再替换原来的文件，帧的逻辑位置不变，
+        快照中保存的位置仍然有效。崩溃恢复时不会有快照，新的文件可以直接加载。
+        """
+        self.sync()
+        tmp_path = self.filename + '.tmp'
+        with self._lock:
+            start = position - self._base
+            stop = os.fstat(self._fd.fileno()).st_size
+            with open(tmp_path, 'wb', buffering=0) as f:
+                write_to_file(f, None,
+                              self._page_size.to_bytes(OTHER_BYTES, ENDIAN),
+                              fsync=False)
+                for offset in range(start, stop, WAL_COPY_CHUNK):
+                    write_to_file(f, None, pread_from_file(
+                        self._fd, offset, min(offset + WAL_COPY_CHUNK, stop)
+                    ), fsync=False)
+                fsync_file_and_dir(f.fileno(), None, self._metrics)
+            os.replace(tmp_path, self.filename)
+            if self._dir_fd is not None:
+                os.fsync(self._dir_fd)
+            self._fd.close()
+            self._fd = open(self.filename, mode='r+b', buffering=0)
+            self._base = position - OTHER_BYTES
+            self._start = position
+            self._committed_pages = {
+                page: page_start
+                for page, page_start in self._committed_pages.items()
+                if page_start >= position
+            }
+
+    def commit(self):
+        # 没有未提交的页时，commit 什么也不做
+        if self._not_committed_pages:
+            self._add_frame(FrameType.COMMIT)
+
+    def rollback(self):
+        # 没有未提交的页时，rollback 什么也不做
+        if self._not_committed_pages:
+            self._add_frame(FrameType.ROLLBACK)
+
+    def __repr__(self):
+        return '<WAL: {}>'.format(self.filename)
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import operator
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+
+class Metrics:
+    """ 树的运行时统计，计数器和耗时都用以 . 分隔的名字区分
+
+    计数器:
+        cache.hit.<节点类型> / cache.miss.<节点类型>  FileMemory 缓存的命中和未命中
+        pages.read / pages.written                    读取的页 (树文件和 WAL)，
+                                                      checkpoint 写回树文件的页
+        wal.frames / wal.bytes                        追加到 WAL 中的帧和字节数
+        wal.group_commits                             commit_node 的组提交 (合并的 fsync)
+        split.level.<层>                              节点分裂，叶子节点是第 0 层
+    耗时 (秒):
+        node.load / node.dump                         节点的解析和序列化
+        fsync                                         fsync_file_and_dir
+        wal.write                                     追加 WAL (包含 fsync)
+        op.<操作>                                     get、insert、scan_step、
+                                                      commit 和 checkpoint
+
+    每个耗时都有一个 Histogram，snapshot 中包含 p50、p90 和 p99。
+
+    每记录一次都会调用 hooks 中的函数 hook(name, value)，
+    value 是计数器增加的值或者这次的耗时，可以用来把数据转发到外部的监控系统。
+    树没有使用 Metrics 时，各个统计点只多了一次 is None 判断。
+
+    add_slow_hook 添加的函数会在一次操作超过阈值时被调用，
+    hook(name, seconds, breakdown)，breakdown 中是这次操作期间在同一个线程中
+    记录的 counters 和 timings，例如读取的页、缓存未命中、WAL 和 fsync 的耗时。
+    """
+
+    __slots__ = ['_counters', '_timings', '_hooks', '_slow_hooks', '_local',
+                 '_lock']
+
+    def __init__(self, hooks: Optional[Iterable[Callable]] = None):
+        self._counters = dict()
+        # 名字 -> Histogram
+        self._timings = dict()
+        self._hooks = list(hooks or [])
+        # [(阈值, hook)]
+        self._slow_hooks = list()
+        # 当前线程中正在追踪的操作
+        self._local = threading.local()
+        # 多个读者同时更新计数器时不能丢失更新
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable):
+        self._hooks.remove(hook)
+
+    def add_slow_hook(self, hook: Callable, threshold: float):
+        """ 耗时不少于 threshold 秒的操作会被报告给 hook """
+        self._slow_hooks.append((threshold, hook))
+
+    def remove_slow_hook(self, hook: Callable):
+        self._slow_hooks = [(t, h) for t, h in self._slow_hooks if h != hook]
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.incr(name, value)
+        for hook in self._hooks:
+            hook(name, value)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self._timings.get(name)
+            if histogram is None:
+                histogram = self._timings[name] = Histogram()
+            histogram.record(seconds)
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.observe(name, seconds)
+        for hook in self._hooks:
+            hook(name, seconds)
+
+    def operation(self, name: str) -> '_Operation':
+        """ with metrics.operation(name): ... 记录一次操作的耗时到 op.<name>
+
+        有 slow hook 时同时追踪这次操作，嵌套的操作算在最外层的操作中
+        """
+        return _Operation(self, name)
+
+    def timer(self, name: str) -> '_Timer':
+        """ with metrics.timer(name): ... 记录代码块的耗时 """
+        return _Timer(self, name)
+
+    def snapshot(self) -> dict:
+        """ 返回当前所有计数器和耗时的副本 """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': {
+                    name: histogram.summary()
+                    for name, histogram in self._timings.items()
+                },
+            }
+
+    def histogram(self, name: str) -> Optional['Histogram']:
+        """ 返回一个耗时的 Histogram 的副本，没有记录过时返回 None """
+        with self._lock:
+            histogram = self._timings.get(name)
+            return histogram.copy() if histogram is not None else None
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def __repr__(self):
+        return '<Metrics: {} counters, {} timings>'.format(
+            len(self._counters), len(self._timings)
+        )
+
+
+class _Timer:
+
+    __slots__ = ['_metrics', '_name', '_start']
+
+    def __init__(self, metrics: Metrics, name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+
+
+class Histogram:
+    """ 按照 2 的幂分桶的延迟直方图
+
+    第 0 个桶是不到 1 微秒的耗时，第 i 个桶是 [2 ** (i - 1), 2 ** i) 微秒，
+    最后一个桶包含所有更长的耗时。桶在创建时一次分配，记录时不分配内存，
+    百分位数返回所在的桶的上界 (不超过最大值)，误差不超过两倍。
+    """
+
+    __slots__ = ['buckets', 'count', 'total', 'max']
+
+    NUM_BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        i = int(seconds * 1000000).bit_length()
+        if i >= self.NUM_BUCKETS:
+            i = self.NUM_BUCKETS - 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """ 返回 p (0 到 100) 百分位的耗时，单位是秒 """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << i) / 1000000, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+    def merge(self, other: 'Histogram'):
+        """ 把另一个 Histogram 中的记录加到这个 Histogram 中 """
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram()
+        histogram.buckets = list(self.buckets)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+    def __repr__(self):
+        return '<Histogram: {} samples>'.format(self.count)
+
+
+class _Trace:
+    """ 一次操作期间在同一个线程中记录的统计 """
+
+    __slots__ = ['counters', 'timings']
+
+    def __init__(self):
+        self.counters = dict()
+        # 名字 -> 总耗时
+        self.timings = dict()
+
+    def incr(self, name: str, value: int):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+class _Operation:
+
+    __slots__ = ['_metrics', '_name', '_start', '_trace']
+
+    def __init__(self, metrics: Metrics, name: str):
+        self._metrics = metrics
+        self._name = name
+        self._trace = None
+
+    def __enter__(self):
+        metrics = self._metrics
+        if (metrics._slow_hooks
+                and getattr(metrics._local, 'trace', None) is None):
+            self._trace = metrics._local.trace = _Trace()
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        metrics = self._metrics
+        trace = self._trace
+        if trace is not None:
+            # 这次操作本身的耗时不属于 breakdown
+            metrics._local.trace = None
+        metrics.observe('op.' + self._name, elapsed)
+        if trace is None:
+            return
+        breakdown = {'counters': trace.counters, 'timings': trace.timings}
+        for threshold, hook in metrics._slow_hooks:
+            if elapsed >= threshold:
+                hook(self._name, elapsed, breakdown)
+
+
+def timed_operation(name: str, get_metrics: Callable = None):
+    """ 方法的装饰器，用 Metrics.operation 记录每次调用
+
+    get_metrics(self) 返回 Metrics 或者 None，默认是 self._metrics，
+    为 None 时直接调用方法
+    """
+    get_metrics = get_metrics or operator.attrgetter('_metrics')
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = get_metrics(self)
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            with metrics.operation(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -14,10 +14,49 @@ from .const import (
 )
 from .entry import Entry, Record, Reference
 
+# 一个节点连续在末尾插入的次数达到这个值时，认为它正在被顺序插入
+SEQUENTIAL_INSERTS_THRESHOLD = 4
+
+# 插值查找最多按照插值选择这么多次位置，之后改为二分，键分布很不均匀时也不会退化
+MAX_INTERPOLATION_PROBES = 3
+
+
+def interpolation_search(entries: list, key: int, right: bool = False) -> int:
+    """ 在按照整数键排好序的 entries 中插值查找
+
+    返回值和 bisect_left (right 为 True 时 bisect_right) 相同，
+    比较的是 entry.key，不需要创建 Entry 对象，也不会调用 Entry.__lt__，
+    键分布均匀时一两次探测就能找到位置。
+    """
+    lo, hi = 0, len(entries)
+    probes = 0
+    # 结果总是在 [lo, hi] 中
+    while lo < hi:
+        lo_key = entries[lo].key
+        if key < lo_key or (key == lo_key and not right):
+            return lo
+        hi_key = entries[hi - 1].key
+        if key > hi_key or (key == hi_key and right):
+            return hi
+
+        if probes < MAX_INTERPOLATION_PROBES:
+            mid = lo + (key - lo_key) * (hi - 1 - lo) // (hi_key - lo_key)
+        else:
+            mid = (lo + hi) // 2
+        probes += 1
+
+        mid_key = entries[mid].key
+        if mid_key < key or (mid_key == key and right):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
 
 class Node(metaclass=abc.ABCMeta):
 
-    __slots__ = ['_tree_conf', 'entries', 'page', 'parent', 'next_page']
+    __slots__ = ['_tree_conf', 'entries', 'page', 'parent', 'next_page',
+                 'prev_page', 'append_streak']
 
     # 下面这些属性可以在子类中被重新定义
     _node_type_int = 0
@@ -26,12 +65,16 @@ class Node(metaclass=abc.ABCMeta):
     _entry_class = None
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int = None, parent: 'Node'=None, next_page: int=None):
+                 page: int = None, parent: 'Node'=None, next_page: int=None,
+                 prev_page: int=None):
         self._tree_conf = tree_conf
         self.entries = list()
         self.page = page
         self.parent = parent
         self.next_page = next_page
+        self.prev_page = prev_page
+        # 连续在节点末尾插入的次数，只保存在内存中，用来选择分裂点
+        self.append_streak = 0
         if data:
             self.load(data)
 
@@ -61,13 +104,23 @@ class Node(metaclass=abc.ABCMeta):
         # 恢复 next_page
         self.next_page = None if next_page == 0 else next_page
 
-        # 获取 entry 的长度，从数据中逐个恢复entry
-        # node 节点头的长度为 4
+        # 计算 prev_page 的区间
+        end_prev_page_bytes = end_reference_bytes + PAGE_REFERENCE_BYTES
+        prev_page = int.from_bytes(
+            data[end_reference_bytes:end_prev_page_bytes],
+            ENDIAN
+        )
+        self.prev_page = None if prev_page == 0 else prev_page
+
+        # used_length 中 node 节点头的长度为 4
+        self._load_entries(
+            data[end_prev_page_bytes:used_length + end_prev_page_bytes - 4]
+        )
+
+    def _load_entries(self, data: bytes):
+        """ 获取 entry 的长度，从数据中逐个恢复entry """
         entry_length = self._entry_class(self._tree_conf).length
-        for start_offset in range(
-                end_reference_bytes,
-                used_length + end_reference_bytes - 4,
-                entry_length):
+        for start_offset in range(0, len(data), entry_length):
             entry_data = data[start_offset:start_offset+entry_length]
             entry = self._entry_class(self._tree_conf, data=entry_data)
             self.entries.append(entry)
@@ -79,24 +132,24 @@ class Node(metaclass=abc.ABCMeta):
         :return:
         bytearry 和 bytes 类似，都是由整数组成的序列，区别在于 bytearray 是可变的数组，bytes 是不可变的数组
         """
-        data = bytearray()
         # 首先备份所有数据
-        for record in self.entries:
-            data.extend(record.dump())
+        data = self._dump_entries()
 
         # 然后计算使用的页的长度，包括数据和头，4表示B+树节点头的长度
         used_length = len(data) + 4
         # 检查使用的页的长度有没有超出页大小
         assert 4 <= used_length < self._tree_conf.page_size
 
-        # 获取 next_page 的内容
+        # 获取 next_page 和 prev_page 的内容
         next_page = 0 if self.next_page is None else self.next_page
+        prev_page = 0 if self.prev_page is None else self.prev_page
 
         # 计算头的数据
         header = (
             self._node_type_int.to_bytes(NODE_TYPE_BYTES, ENDIAN)
             + used_length.to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN)
             + next_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
+            + prev_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
         )
 
         # 获取总的数据，添加padding
@@ -112,6 +165,12 @@ class Node(metaclass=abc.ABCMeta):
 
         return data
 
+    def _dump_entries(self) -> bytearray:
+        data = bytearray()
+        for record in self.entries:
+            data.extend(record.dump())
+        return data
+
     @property
     def can_add_entry(self) -> bool:
         return self.num_children < self.max_children
@@ -150,8 +209,28 @@ class Node(metaclass=abc.ABCMeta):
     def pop_smallest(self) -> Entry:
         return self.entries.pop(0)
 
+    def find_index(self, key, right: bool = False) -> int:
+        """ 返回 key 在 entries 中的插入位置，和 bisect_left/bisect_right 相同
+
+        查找的方法由 tree_conf.search 决定，插值查找只用于整数键的 Serializer，
+        其他类型的键（例如在浮点数的树中查找整数）使用二分查找
+        """
+        if (self._tree_conf.search == 'interpolation'
+                and self._tree_conf.serializer.integer_keys
+                and isinstance(key, int)):
+            return interpolation_search(self.entries, key, right)
+        entry = self._entry_class(self._tree_conf, key=key)
+        if right:
+            return bisect.bisect_right(self.entries, entry)
+        return bisect.bisect_left(self.entries, entry)
+
     def insert_entry(self, entry: Entry):
-        bisect.insort(self.entries, entry)
+        i = self.find_index(entry.key, right=True)
+        self.entries.insert(i, entry)
+        if i == len(self.entries) - 1:
+            self.append_streak += 1
+        else:
+            self.append_streak = 0
 
     def insert_entry_at_the_end(self, entry: Entry):
         """
@@ -160,6 +239,7 @@ class Node(metaclass=abc.ABCMeta):
         :return:
         """
         self.entries.append(entry)
+        self.append_streak += 1
 
     def remove_entry(self, key):
         self.entries.pop(self._find_entry_index(key))
@@ -168,23 +248,39 @@ class Node(metaclass=abc.ABCMeta):
         return self.entries[self._find_entry_index(key)]
 
     def _find_entry_index(self, key) -> int:
-        entry = self._entry_class(
-            self._tree_conf,
-            key=key
-        )
-        i = bisect.bisect_left(self.entries, entry)
-        if i != len(self.entries) and self.entries[i] == entry:
+        i = self.find_index(key)
+        if i != len(self.entries) and self.entries[i].key == key:
             return i
         raise ValueError('No entry for key {}'.format(key))
 
     def split_entries(self) -> list:
+        """ 将节点后半部分的 entries 分离出来并返回
+
+        分裂点由 split_index 决定，分裂后 append_streak 会被清零，
+        调用者可以把它转移给新的节点。
+        """
         len_entries = len(self.entries)
+        split_index = self.split_index
 
-        rv = self.entries[len_entries//2:]
-        self.entries = self.entries[:len_entries//2]
+        rv = self.entries[split_index:]
+        self.entries = self.entries[:split_index]
+        self.append_streak = 0
         assert len(self.entries) + len(rv) == len_entries
         return rv
 
+    @property
+    def split_index(self) -> int:
+        """ 选择分裂点
+
+        随机插入时从中间分裂。顺序插入 (例如自增 id 和时间戳) 时，
+        从中间分裂会让左边的节点永远只有一半是满的，
+        所以只把最后插入的 entry 分到新节点中，左边的节点保持全满。
+        """
+        len_entries = len(self.entries)
+        if self.append_streak >= SEQUENTIAL_INSERTS_THRESHOLD:
+            return len_entries - 1
+        return len_entries // 2
+
     @classmethod
     def from_page_data(cls, tree_conf: TreeConf, data: bytes,
                        page: int = None) -> 'Node':
@@ -198,6 +294,8 @@ class Node(metaclass=abc.ABCMeta):
             return InternalNode(tree_conf, data, page)
         elif node_type_int == 4:
             return LeafNode(tree_conf, data, page)
+        elif node_type_int == 5:
+            return FreelistNode(tree_conf, data, page)
         else:
             assert False, 'No Node with type {} exists'.format(node_type_int)
 
@@ -219,10 +317,11 @@ class RecordNode(Node):
     __slots__ = ['_entry_class']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None, next_page: int=None):
+                 page: int=None, parent: 'Node'=None, next_page: int=None,
+                 prev_page: int=None):
         # TODO: 这里 Pycharm 为什么会警告 _entry_class 是只读的
         self._entry_class = Record
-        super().__init__(tree_conf, data, page, parent, next_page)
+        super().__init__(tree_conf, data, page, parent, next_page, prev_page)
 
     @property
     def num_children(self) -> int:
@@ -247,6 +346,7 @@ class LonelyRootNode(RecordNode):
     def convert_to_leaf(self):
         leaf = LeafNode(self._tree_conf, page=self.page)
         leaf.entries = self.entries
+        leaf.append_streak = self.append_streak
         return leaf
 
 
@@ -265,6 +365,7 @@ class ReferenceNode(Node):
         if i > 0:
             prev_entry = self.entries[i-1]
             prev_entry.after = entry.before
+            prev_entry.after_count = entry.before_count
 
         try:
             next_entry = self.entries[i+1]
@@ -272,6 +373,50 @@ class ReferenceNode(Node):
             pass
         else:
             next_entry.before = entry.after
+            next_entry.before_count = entry.after_count
+
+    @classmethod
+    def from_children(cls, tree_conf: TreeConf, page: int, children: list,
+                      keys: list, counts: list) -> 'ReferenceNode':
+        """ 用子节点所在的页、它们之间的键和子树中记录的个数创建一个节点 """
+        assert len(children) == len(keys) + 1 == len(counts) >= 2
+        node = cls(tree_conf, page=page)
+        node.entries = [
+            Reference(tree_conf, key, before, after,
+                      before_count=before_count, after_count=after_count)
+            for key, before, after, before_count, after_count in zip(
+                keys, children, children[1:], counts, counts[1:]
+            )
+        ]
+        return node
+
+    @property
+    def children_pages(self) -> list:
+        """ 按照顺序返回所有子节点所在的页 """
+        return [self.smallest_entry.before] + [ref.after for ref in self.entries]
+
+    def add_to_child_count(self, i: int, delta: int):
+        """ 第 i 个子树中的记录的个数同时保存在它两边的引用中 """
+        if i > 0:
+            self.entries[i - 1].after_count += delta
+        if i < len(self.entries):
+            self.entries[i].before_count += delta
+
+    @property
+    def children_counts(self) -> list:
+        """ 按照顺序返回每个子树中记录的个数，需要 order_statistics """
+        return ([self.smallest_entry.before_count]
+                + [ref.after_count for ref in self.entries])
+
+    @property
+    def total_count(self) -> int:
+        """ 这个节点的子树中记录的个数，需要 order_statistics """
+        return sum(self.children_counts)
+
+    @property
+    def split_index(self) -> int:
+        # 新节点的最小的 entry 会被移到父节点中，所以新节点至少要分到两个 entry
+        return min(super().split_index, len(self.entries) - 2)
 
     @property
     def num_children(self) -> int:
@@ -306,6 +451,7 @@ class RootNode(ReferenceNode):
     def convert_to_internal(self) -> InternalNode:
         internal = InternalNode(self._tree_conf, page=self.page)
         internal.entries = self.entries
+        internal.append_streak = self.append_streak
         return internal
 
 
@@ -315,8 +461,48 @@ class LeafNode(RecordNode):
 
     def __init__(self, tree_conf: TreeConf,
                  data: Optional[bytes] = None, page: int = None,
-                 parent: 'Node' = None, next_page: int = None):
+                 parent: 'Node' = None, next_page: int = None,
+                 prev_page: int = None):
         self._node_type_int = 4
         self.min_children = math.ceil(tree_conf.order / 2) - 1
         self.max_children = tree_conf.order - 1
+        super().__init__(tree_conf, data, page, parent, next_page, prev_page)
+
+    def convert_to_lonely_root(self) -> LonelyRootNode:
+        lonely_root = LonelyRootNode(self._tree_conf, page=self.page)
+        lonely_root.entries = self.entries
+        lonely_root.append_streak = self.append_streak
+        return lonely_root
+
+
+class FreelistNode(Node):
+    """ 空闲页链表中的节点
+
+    entries 中保存的是空闲的页号，next_page 指向下一个 FreelistNode 所在的页，
+    FreelistNode 所在的页本身也是空闲的，它中的页号都被用完之后就可以被重新使用
+    """
+
+    __slots__ = ['_node_type_int', 'max_children']
+
+    def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
+                 page: int=None, parent: 'Node'=None, next_page: int=None):
+        self._node_type_int = 5
+        # 节点头的长度为 12
+        self.max_children = (tree_conf.page_size - 12) // PAGE_REFERENCE_BYTES
         super().__init__(tree_conf, data, page, parent, next_page)
+
+    def _load_entries(self, data: bytes):
+        for start_offset in range(0, len(data), PAGE_REFERENCE_BYTES):
+            self.entries.append(int.from_bytes(
+                data[start_offset:start_offset + PAGE_REFERENCE_BYTES], ENDIAN
+            ))
+
+    def _dump_entries(self) -> bytearray:
+        data = bytearray()
+        for page in self.entries:
+            data.extend(page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN))
+        return data
+
+    @property
+    def num_children(self) -> int:
+        return len(self.entries)
@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import abc
-from datetime import datetime, timezone
-
-from uuid import UUID
+import struct
+from typing import Optional
 
 from .const import ENDIAN
 
-try:
-    import temporenc
-except ImportError:
-    temporenc = None
+# 可选的依赖 temporenc 在第一次创建 DatetimeUTCSerializer 时才导入，
+# 没有安装时为 None
+_NOT_IMPORTED = object()
+temporenc = _NOT_IMPORTED
+# 同样只在需要时导入的标准库
+UUID = None
+timezone = None
+timedelta = None
+# 1970-01-01 UTC，DatetimeMicrosSerializer 的起点
+_EPOCH = None
+
+# 有符号的 64 位整数加上这个值之后变成无符号整数，按字节比较的顺序和原来相同
+_SIGN_BIT = 1 << 63
+_ALL_BITS = (1 << 64) - 1
 
 
 class Serializer(metaclass=abc.ABCMeta):
@@ -38,6 +47,13 @@ class Serializer(metaclass=abc.ABCMeta):
     """
     __slots__ = []
 
+    # 保存在树的元数据中，打开已经存在的树时不需要再传入 Serializer，
+    # 自定义的 Serializer 为 0，打开时需要由调用者传入
+    serializer_id = 0
+
+    # 键都是整数时为 True，节点内才可以使用插值查找
+    integer_keys = False
+
     @abc.abstractmethod
     def serialize(self, obj: object, key_size: int) -> bytes:
         """将 key 序列化成 bytes"""
@@ -54,6 +70,9 @@ class IntSerializer(Serializer):
 
     __slots__ = []
 
+    serializer_id = 1
+    integer_keys = True
+
     def serialize(self, obj: int, key_size: int) -> bytes:
         return obj.to_bytes(key_size, ENDIAN)
 
@@ -65,9 +84,14 @@ class StrSerializer(Serializer):
 
     __slots__ = []
 
+    serializer_id = 2
+
     def serialize(self, obj: str, key_size: int) -> bytes:
         rv = obj.encode(encoding='utf-8')
-        assert len(rv) <= key_size
+        if len(rv) > key_size:
+            raise ValueError('Key {} is bigger than key_size {}'.format(
+                obj, key_size
+            ))
         return rv
 
     def deserialize(self, data: bytes) -> str:
@@ -78,10 +102,17 @@ class UUIDSerializer(Serializer):
 
     __slots__ = []
 
-    def serialize(self, obj: UUID, key_size: int) -> bytes:
+    serializer_id = 3
+
+    def __init__(self):
+        global UUID
+        if UUID is None:
+            from uuid import UUID
+
+    def serialize(self, obj: 'UUID', key_size: int) -> bytes:
         return obj.bytes
 
-    def deserialize(self, data: bytes) -> UUID:
+    def deserialize(self, data: bytes) -> 'UUID':
         return UUID(bytes=data)
 
 
@@ -89,18 +120,335 @@ class DatetimeUTCSerializer(Serializer):
 
     __slots__ = []
 
+    serializer_id = 4
+
     def __init__(self):
+        global temporenc, timezone
+        if timezone is None:
+            from datetime import timezone
+        if temporenc is _NOT_IMPORTED:
+            try:
+                import temporenc
+            except ImportError:
+                temporenc = None
         if temporenc is None:
             raise RuntimeError('Serialization to/from datetime needs the '
                                'third-party library "temporenc"')
 
-    def serialize(self, obj: datetime, key_size: int) -> bytes:
+    def serialize(self, obj: 'datetime', key_size: int) -> bytes:
         if obj.tzinfo is None:
             raise ValueError("DatetimeUTCSerializer needs a timezone aware"
                              " datetime")
         return temporenc.packb(obj, type="DTS")
 
-    def deserialize(self, data: bytes) -> datetime:
+    def deserialize(self, data: bytes) -> 'datetime':
         rv = temporenc.unpackb(data).datetime()
         rv = rv.replace(tzinfo=timezone.utc)
         return rv
+
+
+class FixedWidthSerializer(Serializer):
+    """ 序列化成 width 个字节的 Serializer
+
+    结果是大端序，并且按字节比较的顺序和对象的顺序相同，
+    serialize_many 和 deserialize_many 用一次 struct 调用处理一批键，
+    多个键的结果直接拼接在一起。
+    """
+
+    __slots__ = []
+
+    width = 8
+
+    def serialize(self, obj, key_size: int) -> bytes:
+        if key_size < self.width:
+            raise ValueError('{} needs a key_size of at least {}'.format(
+                self.__class__.__name__, self.width
+            ))
+        return self._dump(obj)
+
+    def deserialize(self, data: bytes):
+        return self._load(data)
+
+    @abc.abstractmethod
+    def _dump(self, obj) -> bytes:
+        """ 序列化一个对象 """
+
+    @abc.abstractmethod
+    def _load(self, data: bytes):
+        """ 反序列化一个对象 """
+
+    @abc.abstractmethod
+    def serialize_many(self, objs: list) -> bytes:
+        """ 把多个对象序列化后拼接在一起 """
+
+    @abc.abstractmethod
+    def deserialize_many(self, data: bytes) -> list:
+        """ serialize_many 的逆操作 """
+
+
+_UNSIGNED = struct.Struct('>Q')
+_DOUBLE = struct.Struct('>d')
+
+
+def _pack_unsigned(values: list) -> bytes:
+    try:
+        return struct.pack('>{}Q'.format(len(values)), *values)
+    except struct.error:
+        raise ValueError('Key does not fit in 8 bytes')
+
+
+def _unpack_unsigned(data: bytes) -> tuple:
+    return struct.unpack('>{}Q'.format(len(data) // 8), data)
+
+
+class SignedIntSerializer(FixedWidthSerializer):
+    """ -2 ** 63 到 2 ** 63 - 1 的整数，固定 8 个字节 """
+
+    __slots__ = []
+
+    serializer_id = 5
+    integer_keys = True
+
+    def _dump(self, obj: int) -> bytes:
+        try:
+            return (obj + _SIGN_BIT).to_bytes(8, 'big')
+        except OverflowError:
+            raise ValueError('Key {} does not fit in 8 bytes'.format(obj))
+
+    def _load(self, data: bytes) -> int:
+        return int.from_bytes(data, 'big') - _SIGN_BIT
+
+    def serialize_many(self, objs: list) -> bytes:
+        return _pack_unsigned([obj + _SIGN_BIT for obj in objs])
+
+    def deserialize_many(self, data: bytes) -> list:
+        return [value - _SIGN_BIT for value in _unpack_unsigned(data)]
+
+
+class FloatSerializer(FixedWidthSerializer):
+    """ IEEE 754 双精度浮点数，固定 8 个字节
+
+    正数翻转符号位，负数翻转所有的位，这样按字节比较的顺序和数值的顺序相同。
+    -0.0 被保存为 0.0，NaN 不能比较大小，不能作为键。
+    """
+
+    __slots__ = []
+
+    serializer_id = 6
+
+    def _dump(self, obj: float) -> bytes:
+        if obj != obj:
+            raise ValueError('NaN cannot be used as a key')
+        # + 0.0 把 -0.0 变成 0.0
+        bits = _UNSIGNED.unpack(_DOUBLE.pack(obj + 0.0))[0]
+        return _UNSIGNED.pack(
+            bits ^ _ALL_BITS if bits & _SIGN_BIT else bits | _SIGN_BIT
+        )
+
+    def _load(self, data: bytes) -> float:
+        bits = _UNSIGNED.unpack(data)[0]
+        return _DOUBLE.unpack(_UNSIGNED.pack(
+            bits ^ _SIGN_BIT if bits & _SIGN_BIT else bits ^ _ALL_BITS
+        ))[0]
+
+    def serialize_many(self, objs: list) -> bytes:
+        for obj in objs:
+            if obj != obj:
+                raise ValueError('NaN cannot be used as a key')
+        bits = _unpack_unsigned(
+            struct.pack('>{}d'.format(len(objs)), *[obj + 0.0 for obj in objs])
+        )
+        return _pack_unsigned([
+            b ^ _ALL_BITS if b & _SIGN_BIT else b | _SIGN_BIT for b in bits
+        ])
+
+    def deserialize_many(self, data: bytes) -> list:
+        bits = [
+            b ^ _SIGN_BIT if b & _SIGN_BIT else b ^ _ALL_BITS
+            for b in _unpack_unsigned(data)
+        ]
+        return list(struct.unpack('>{}d'.format(len(bits)),
+                                  _pack_unsigned(bits)))
+
+
+class DatetimeMicrosSerializer(FixedWidthSerializer):
+    """ 带时区的 datetime，保存为 UTC 1970-01-01 之后的微秒数，固定 8 个字节
+
+    和 DatetimeUTCSerializer 相比不需要 temporenc，长度固定，速度快很多，
+    反序列化的结果总是 UTC 时间。
+    """
+
+    __slots__ = []
+
+    serializer_id = 7
+
+    def __init__(self):
+        global timezone, timedelta, _EPOCH
+        if _EPOCH is None:
+            from datetime import datetime, timezone, timedelta
+            _EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    @staticmethod
+    def _to_micros(obj: 'datetime') -> int:
+        if obj.tzinfo is None:
+            raise ValueError('DatetimeMicrosSerializer needs a timezone '
+                             'aware datetime')
+        delta = obj - _EPOCH
+        return ((delta.days * 86400 + delta.seconds) * 1000000
+                + delta.microseconds)
+
+    def _dump(self, obj: 'datetime') -> bytes:
+        return _UNSIGNED.pack(self._to_micros(obj) + _SIGN_BIT)
+
+    def _load(self, data: bytes) -> 'datetime':
+        return _EPOCH + timedelta(
+            microseconds=_UNSIGNED.unpack(data)[0] - _SIGN_BIT
+        )
+
+    def serialize_many(self, objs: list) -> bytes:
+        return _pack_unsigned([self._to_micros(obj) + _SIGN_BIT
+                               for obj in objs])
+
+    def deserialize_many(self, data: bytes) -> list:
+        return [_EPOCH + timedelta(microseconds=value - _SIGN_BIT)
+                for value in _unpack_unsigned(data)]
+
+
+def _escape(data: bytes) -> bytes:
+    """ 变长的字段中 0x00 写成 0x00 0xff，以 0x00 0x00 结束
+
+    字段中的 0x00 后面一定是 0xff，结束标记后面一定是 0x00，
+    和下一个字段的第一个字节无关，按字节比较的顺序不变。
+    """
+    return data.replace(b'\x00', b'\x00\xff') + b'\x00\x00'
+
+
+def _unescape(data: bytes, offset: int) -> tuple:
+    """ _escape 的逆操作，返回 (字段, 下一个字段的位置) """
+    end = data.index(b'\x00', offset)
+    while data[end + 1:end + 2] == b'\xff':
+        end = data.index(b'\x00', end + 2)
+    if data[end + 1:end + 2] != b'\x00':
+        raise ValueError('Field is not terminated')
+    return data[offset:end].replace(b'\x00\xff', b'\x00'), end + 2
+
+
+def _fixed_codec(dump, load, width: int) -> tuple:
+    def load_at(data: bytes, offset: int) -> tuple:
+        end = offset + width
+        return load(data[offset:end]), end
+    return dump, load_at
+
+
+def _unsigned_codec() -> tuple:
+    def dump(obj: int) -> bytes:
+        try:
+            return obj.to_bytes(8, 'big')
+        except OverflowError:
+            raise ValueError('Key {} does not fit in 8 bytes'.format(obj))
+    return _fixed_codec(dump, lambda data: int.from_bytes(data, 'big'), 8)
+
+
+def _str_codec() -> tuple:
+    def load_at(data: bytes, offset: int) -> tuple:
+        field, end = _unescape(data, offset)
+        return field.decode(encoding='utf-8'), end
+    return lambda obj: _escape(obj.encode(encoding='utf-8')), load_at
+
+
+class TupleSerializer(Serializer):
+    """ 由多个字段组成的元组键，每个字段使用一个内置的 Serializer
+
+    每个字段的编码按字节比较的顺序和字段的顺序相同，依次拼接在一起，
+    所以整个键按字节比较的顺序和元组的顺序相同:
+    FixedWidthSerializer 的字段直接使用它的编码，IntSerializer 的字段
+    写成 8 个字节的大端序，UUID 写成 16 个字节，字符串转义之后以 0x00 0x00 结束。
+
+    元数据中保存每个字段的 Serializer 的编号 (field_ids)，字段都是内置的
+    Serializer 时打开已经存在的树不需要再传入，传入的字段不同时抛出 ValueError；
+    有自定义的字段时需要传入同样的 TupleSerializer。
+    配合 BPlusTree.scan_prefix 可以遍历前几个字段相同的所有键。
+    """
+
+    __slots__ = ['_serializers', '_codecs']
+
+    serializer_id = 8
+
+    # 元数据中最多能保存的字段个数
+    MAX_FIELDS = 15
+
+    def __init__(self, *serializers: Serializer):
+        if not serializers:
+            raise ValueError('TupleSerializer needs at least one field')
+        if len(serializers) > self.MAX_FIELDS:
+            raise ValueError('TupleSerializer supports at most {} fields'
+                             .format(self.MAX_FIELDS))
+        self._serializers = serializers
+        self._codecs = [self._codec(s) for s in serializers]
+
+    @staticmethod
+    def _codec(serializer: Serializer) -> tuple:
+        """ 返回字段的 (dump(obj) -> bytes, load(data, offset) -> (obj, end)) """
+        if isinstance(serializer, FixedWidthSerializer):
+            return _fixed_codec(serializer._dump, serializer._load,
+                                serializer.width)
+        if isinstance(serializer, IntSerializer):
+            return _unsigned_codec()
+        if isinstance(serializer, StrSerializer):
+            return _str_codec()
+        if isinstance(serializer, UUIDSerializer):
+            return _fixed_codec(lambda obj: obj.bytes,
+                                lambda data: UUID(bytes=data), 16)
+        raise ValueError('{} cannot be used in a TupleSerializer'.format(
+            serializer
+        ))
+
+    @property
+    def field_ids(self) -> tuple:
+        """ 每个字段的 Serializer 的编号，自定义的字段为 0 """
+        return tuple(s.serializer_id for s in self._serializers)
+
+    def serialize(self, obj: tuple, key_size: int) -> bytes:
+        if len(obj) != len(self._codecs):
+            raise ValueError('Key {} does not have {} fields'.format(
+                obj, len(self._codecs)
+            ))
+        rv = b''.join(dump(field) for (dump, _), field
+                      in zip(self._codecs, obj))
+        if len(rv) > key_size:
+            raise ValueError('Key {} needs {} bytes, key_size is {}'.format(
+                obj, len(rv), key_size
+            ))
+        return rv
+
+    def deserialize(self, data: bytes) -> tuple:
+        fields = []
+        offset = 0
+        for _, load in self._codecs:
+            field, offset = load(data, offset)
+            fields.append(field)
+        return tuple(fields)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            repr(s) for s in self._serializers
+        ))
+
+
+def serializer_from_id(serializer_id: int,
+                       field_ids: tuple = ()) -> Optional[Serializer]:
+    """ 根据元数据中保存的编号创建内置的 Serializer，未知的编号返回 None
+
+    TupleSerializer 由 field_ids 中每个字段的编号创建，有未知的字段时返回 None
+    """
+    if serializer_id == TupleSerializer.serializer_id:
+        fields = [serializer_from_id(i) for i in field_ids]
+        if not fields or any(field is None for field in fields):
+            return None
+        return TupleSerializer(*fields)
+    for cls in (IntSerializer, StrSerializer, UUIDSerializer,
+                DatetimeUTCSerializer, SignedIntSerializer, FloatSerializer,
+                DatetimeMicrosSerializer):
+        if cls.serializer_id == serializer_id:
+            return cls()
+    return None
@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import contextlib
+import json
+import operator
+import os
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 上没有 fcntl，清单文件和分片只受进程内的锁保护
+    fcntl = None
+
+import rwlock
+
+from .cursor import PROJECTIONS, PrefixEnd
+from .memory import open_file_in_dir, fsync_file_and_dir
+from .serializer import IntSerializer, TupleSerializer, serializer_from_id
+from .tree import BPlusTree, ReadOnlyTree
+
+MANIFEST = 'manifest.json'
+# 写入分片的进程持有 filename-owner 的排他锁
+OWNER_SUFFIX = '-owner'
+# 分裂时每个事务复制到新分片中的记录数
+SPLIT_BATCH = 10000
+# 每个分片写入这么多个键之后检查一次是否需要分裂
+SPLIT_CHECK_INTERVAL = 1000
+
+
+class _StaleManifest(Exception):
+    """ 获取分片的所有权时发现清单已经被其他进程修改 """
+
+
+class ShardedTree:
+    """ 按照键的范围把数据分到多个树文件中的树
+
+    directory 中的 manifest.json 记录每个分片的文件名和下界，
+    第 i 个分片保存 [第 i - 1 个边界, 第 i 个边界) 中的键。
+    每个分片是一个独立的 BPlusTree，有自己的 WAL 和写锁，
+    写入不同分片的线程不会互相阻塞，每个分片的 fsync 也是独立的。
+
+    分片在第一次使用时才打开，所以多个进程可以各自打开同一个目录，
+    每个进程只写入分给自己的分片 (见 shard_for)。第一个打开分片的进程持有
+    filename-owner 的排他锁，拥有这个分片，只有它会恢复分片的 WAL 和写入分片；
+    其他进程只读地打开这个分片 (见 ReadOnlyTree)，只能看到已经 checkpoint 的数据，
+    写入时抛出 ValueError。清单文件的修改由文件锁保护，不同的进程可以同时分裂
+    各自的分片，每次操作之前清单被其他进程修改过的话先重新读取清单。
+
+    遍历时依次遍历键的范围内的每个分片，结果是全局有序的。
+    跨越多个分片的 insert_many 和 delete_range 在每个分片中是一个事务，
+    整体不是原子的。
+    """
+
+    __slots__ = ['_directory', '_kwargs', '_serializer', '_key_size',
+                 '_bounds', '_files', '_next_id', '_shards', '_owners',
+                 '_writes', '_max_shard_keys', '_generation', '_lock',
+                 '_split_lock', '_manifest_mutex', '_manifest_file',
+                 '_manifest_stat']
+
+    def __init__(self, directory: str, boundaries: Iterable = (),
+                 max_shard_keys: Optional[int] = None, **kwargs):
+        """
+        :param directory: 保存清单和分片文件的目录，不存在时会被创建
+        :param boundaries: 创建时分片之间的边界，n 个边界得到 n + 1 个分片，
+                           打开已经存在的 ShardedTree 时使用清单中的边界
+        :param max_shard_keys: 分片中的键超过这个数量时自动分裂成两个分片，
+                               默认不自动分裂
+        :param kwargs: 传给每个分片的 BPlusTree 的参数，
+                       key_size 和 serializer 在打开时从清单中读取
+        """
+        self._directory = os.path.abspath(directory)
+        self._kwargs = kwargs
+        self._max_shard_keys = max_shard_keys
+        # 分片的文件名 -> 打开的 BPlusTree 或者 ReadOnlyTree
+        self._shards = dict()
+        # 这个进程拥有的分片的文件名 -> 持有排他锁的 filename-owner
+        self._owners = dict()
+        # 分片的文件名 -> 上一次检查之后写入的键的个数
+        self._writes = dict()
+        # 每次分片改变时加一，遍历用它判断是否需要重新查找分片
+        self._generation = 0
+        self._lock = threading.Lock()
+        # 读写操作持有读锁，分裂持有写锁
+        self._split_lock = rwlock.RWLock()
+        # 清单的文件锁在同一个线程中可以重入
+        self._manifest_mutex = threading.RLock()
+        self._manifest_file = None
+        # 上一次读取或者写入的清单的 (inode, 修改时间, 大小)
+        self._manifest_stat = None
+
+        os.makedirs(self._directory, exist_ok=True)
+        with self._manifest_lock():
+            manifest = self._read_manifest()
+            if manifest is None:
+                self._key_size = kwargs.get('key_size', 8)
+                self._serializer = kwargs.get('serializer') or IntSerializer()
+                self._bounds = sorted(boundaries)
+                if any(a >= b for a, b in zip(self._bounds,
+                                              self._bounds[1:])):
+                    raise ValueError('Shard boundaries must be distinct')
+                self._files = [self._shard_filename(i)
+                               for i in range(len(self._bounds) + 1)]
+                self._next_id = len(self._files)
+                self._write_manifest()
+                return
+
+        self._key_size = manifest['key_size']
+        serializer_id = manifest['serializer_id']
+        field_ids = tuple(manifest.get('field_ids', ()))
+        serializer = kwargs.get('serializer')
+        if serializer is None:
+            serializer = serializer_from_id(serializer_id, field_ids)
+            if serializer is None:
+                if serializer_id == TupleSerializer.serializer_id:
+                    raise ValueError('{} was created with a TupleSerializer '
+                                     'of fields {}, it needs to be passed'
+                                     .format(directory, field_ids))
+                serializer = IntSerializer()
+        elif (serializer.serializer_id != serializer_id
+              or getattr(serializer, 'field_ids', ()) != field_ids):
+            raise ValueError('{} was created with serializer {} {}'.format(
+                directory, serializer_id, field_ids
+            ))
+        self._serializer = serializer
+        self._load_manifest(manifest)
+
+    def close(self):
+        with self._lock:
+            for tree in self._shards.values():
+                tree.close()
+            self._shards.clear()
+            for filename in list(self._owners):
+                self._release_owner(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def checkpoint(self):
+        """ 将所有打开的分片的 WAL 写回树文件 """
+        with self._lock:
+            trees = [tree for filename, tree in self._shards.items()
+                     if filename in self._owners]
+        for tree in trees:
+            tree.checkpoint()
+
+    @property
+    def shards(self) -> list:
+        """ 每个分片的 (下界, 上界)，第一个分片的下界和最后一个分片的上界为 None """
+        with self._split_lock.reader_lock:
+            return list(zip([None] + self._bounds, self._bounds + [None]))
+
+    def shard_for(self, key) -> int:
+        """ 返回 key 所在的分片的序号 """
+        return bisect.bisect_right(self._bounds, key)
+
+    def refresh(self):
+        """ 重新读取清单，看到其他进程对分片的分裂 """
+        with self._split_lock.writer_lock, self._manifest_lock():
+            self._load_manifest(self._read_manifest())
+
+    def insert(self, key, value: bytes, replace: bool = False):
+        def insert():
+            filename, tree = self._route(key, write=True)
+            tree.insert(key, value, replace)
+            return filename
+
+        self._after_write(self._locked(insert), 1)
+
+    def insert_many(self, items, replace: bool = False):
+        """ 批量插入，落在同一个分片中的记录在这个分片中一次批量插入 """
+        if isinstance(items, dict):
+            items = items.items()
+        records = sorted(items, key=operator.itemgetter(0))
+
+        def insert_many():
+            # 先获取所有的分片，清单过期时还没有写入任何记录，可以重试
+            groups = [(i, start, stop, self._open_shard(i, write=True))
+                      for i, start, stop in self._group(
+                          [key for key, _ in records])]
+            written = []
+            for i, start, stop, tree in groups:
+                tree.insert_many(records[start:stop], replace)
+                written.append((self._files[i], stop - start))
+            return written
+
+        for filename, count in self._locked(insert_many):
+            self._after_write(filename, count)
+
+    def update_many(self, items):
+        self.insert_many(items, replace=True)
+
+    def delete_range(self, start=None, end=None):
+        """ 删除 [start, end) 中的所有记录，每个分片中的删除是一个事务 """
+        if start is not None and end is not None and start >= end:
+            raise ValueError('Cannot delete backwards')
+
+        def delete_range():
+            first = 0 if start is None else self.shard_for(start)
+            last = len(self._files) - 1
+            if end is not None:
+                last = bisect.bisect_left(self._bounds, end)
+            ranges = []
+            for i in range(first, last + 1):
+                lower = self._bounds[i - 1] if i else None
+                upper = self._bounds[i] if i < len(self._bounds) else None
+                if start is not None and (lower is None or start > lower):
+                    lower = start
+                if end is not None and (upper is None or end < upper):
+                    upper = end
+                ranges.append((self._open_shard(i, write=True), lower, upper))
+            for tree, lower, upper in ranges:
+                tree.delete_range(lower, upper)
+
+        self._locked(delete_range)
+
+    def get(self, key, default=None) -> bytes:
+        def get():
+            tree = self._route(key)[1]
+            return default if tree is None else tree.get(key, default)
+
+        return self._locked(get)
+
+    def get_many(self, keys: Iterable, default=None) -> list:
+        """ 按照 keys 的顺序返回对应的值，每个分片中的键一次批量查找 """
+        keys = list(keys)
+        probes = sorted(set(keys))
+
+        def get_many():
+            found = dict()
+            for i, start, stop in self._group(probes):
+                tree = self._open_shard(i)
+                if tree is not None:
+                    shard_keys = probes[start:stop]
+                    found.update(zip(shard_keys,
+                                     tree.get_many(shard_keys, default)))
+            return found
+
+        found = self._locked(get_many)
+        return [found.get(key, default) for key in keys]
+
+    def __contains__(self, item):
+        o = object()
+        return self.get(item, default=o) is not o
+
+    def __setitem__(self, key, value):
+        self.insert(key, value, replace=True)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise ValueError('Cannot iterate with a custom step')
+            return dict(self.scan(item.start, item.stop))
+        rv = self.get(item)
+        if rv is None:
+            raise KeyError(item)
+        return rv
+
+    def __len__(self):
+        def length():
+            trees = [self._open_shard(i) for i in range(len(self._files))]
+            return sum(len(tree) for tree in trees if tree is not None)
+
+        return self._locked(length)
+
+    def __bool__(self):
+        for _ in self.scan(projection='keys'):
+            return True
+        return False
+
+    def scan(self, start=None, end=None,
+             projection: str = 'items') -> Iterator:
+        """ 按照键的顺序遍历所有分片中 [start, end) 的记录
+
+        每个分片用一个 Cursor 遍历，只在切换分片的时候查找下一个分片，
+        遍历的过程中不持有锁。遍历时分片被分裂的话，从上一次返回的键之后
+        重新查找分片，不会遗漏或者重复返回键。
+        """
+        if projection not in PROJECTIONS:
+            raise ValueError('Unknown projection {}'.format(projection))
+        if start is not None and end is not None and start >= end:
+            raise ValueError('Cannot iterate backwards')
+        return self._scan(start, end, projection)
+
+    def scan_prefix(self, prefix: tuple,
+                    projection: str = 'items') -> Iterator:
+        """ 遍历所有以 prefix 开头的元组键，见 BPlusTree.scan_prefix """
+        if not isinstance(prefix, tuple):
+            raise ValueError('Prefix {} is not a tuple'.format(prefix))
+        return self.scan(prefix, PrefixEnd(prefix), projection)
+
+    def __iter__(self):
+        return self.scan(projection='keys')
+
+    keys = __iter__
+
+    def items(self) -> Iterator[tuple]:
+        return self.scan()
+
+    def values(self) -> Iterator[bytes]:
+        return self.scan(projection='values')
+
+    def split_shard(self, index: int, key=None):
+        """ 把第 index 个分片从 key 处分成两个分片，key 默认是分片中间的键
+
+        [key, 上界) 中的记录先被复制到一个新的分片文件中，然后更新清单，
+        最后从原来的分片中删除这些记录，其他分片的读写不受影响。
+        在更新清单之后崩溃时，原来的分片中留下的记录在下一次打开它时被删除。
+        分片属于其他进程时抛出 ValueError。
+        """
+        self._refresh_if_changed()
+        with self._split_lock.reader_lock:
+            filename = self._files[index]
+        self._split(filename, key)
+
+    def __repr__(self):
+        return '<ShardedTree: {} {} shards>'.format(self._directory,
+                                                   len(self._files))
+
+    # ############################## 实现 ##################################
+
+    @staticmethod
+    def _shard_filename(shard_id: int) -> str:
+        return 'shard-{:04d}.db'.format(shard_id)
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self._directory, filename)
+
+    @contextlib.contextmanager
+    def _manifest_lock(self):
+        """ 在读取、修改、写入清单的过程中排他地锁住清单，也对其他进程有效
+
+        同一个线程中可以重入，分裂持有它时获取分片的所有权也需要它。
+        """
+        with self._manifest_mutex:
+            if fcntl is None or self._manifest_file is not None:
+                yield
+                return
+            with open(self._path(MANIFEST + '.lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._manifest_file = f
+                try:
+                    yield
+                finally:
+                    self._manifest_file = None
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _stat_manifest(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self._path(MANIFEST))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh_if_changed(self):
+        """ 清单被其他进程替换过时重新读取，调用者不能持有 _split_lock """
+        if self._stat_manifest() != self._manifest_stat:
+            self.refresh()
+
+    def _locked(self, func: Callable):
+        """ 持有 _split_lock 的读锁调用 func
+
+        func 获取分片的所有权时发现清单已经被其他进程修改的话，
+        重新读取清单再调用一次 func，所以 func 需要先获取它用到的所有分片再写入。
+        """
+        self._refresh_if_changed()
+        while True:
+            with self._split_lock.reader_lock:
+                try:
+                    return func()
+                except _StaleManifest:
+                    pass
+            self.refresh()
+
+    def _read_manifest(self) -> Optional[dict]:
+        try:
+            with open(self._path(MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _load_manifest(self, manifest: dict):
+        bounds = [
+            self._serializer.deserialize(bytes.fromhex(shard['lower']))
+            for shard in manifest['shards'][1:]
+        ]
+        files = [shard['file'] for shard in manifest['shards']]
+        if getattr(self, '_files', None) != files:
+            self._generation += 1
+        self._bounds = bounds
+        self._files = files
+        self._next_id = manifest['next_id']
+        self._manifest_stat = self._stat_manifest()
+
+    def _write_manifest(self):
+        """ 先写入临时文件，再替换清单，清单总是完整的 """
+        shards = [{'file': self._files[0], 'lower': None}]
+        for filename, lower in zip(self._files[1:], self._bounds):
+            shards.append({
+                'file': filename,
+                'lower': self._serializer.serialize(lower,
+                                                    self._key_size).hex(),
+            })
+        data = json.dumps({
+            'key_size': self._key_size,
+            'serializer_id': self._serializer.serializer_id,
+            'field_ids': list(getattr(self._serializer, 'field_ids', ())),
+            'next_id': self._next_id,
+            'shards': shards,
+        }, indent=2).encode()
+
+        path = self._path(MANIFEST)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        file_fd, dir_fd = open_file_in_dir(tmp_path)
+        try:
+            file_fd.write(data)
+            fsync_file_and_dir(file_fd.fileno(), None)
+        finally:
+            file_fd.close()
+        os.replace(tmp_path, path)
+        if dir_fd is not None:
+            os.fsync(dir_fd)
+            os.close(dir_fd)
+        self._manifest_stat = self._stat_manifest()
+
+    def _open_tree(self, filename: str) -> BPlusTree:
+        kwargs = dict(self._kwargs, key_size=self._key_size,
+                      serializer=self._serializer)
+        return BPlusTree(self._path(filename), **kwargs)
+
+    def _open_read_only(self, filename: str) -> Optional[ReadOnlyTree]:
+        """ 只读地打开其他进程拥有的分片，分片还没有被 checkpoint 过时返回 None """
+        path = self._path(filename)
+        try:
+            if os.path.getsize(path) == 0:
+                return None
+        except FileNotFoundError:
+            return None
+        kwargs = {name: self._kwargs[name]
+                  for name in ('cache_size', 'search', 'metrics')
+                  if name in self._kwargs}
+        return BPlusTree.open_read_only(path, serializer=self._serializer,
+                                        **kwargs)
+
+    def _acquire_owner(self, filename: str) -> bool:
+        """ 获取分片的所有权，分片属于其他进程时返回 False """
+        if fcntl is None:
+            self._owners[filename] = None
+            return True
+        fd = os.open(self._path(filename + OWNER_SUFFIX),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._owners[filename] = fd
+        return True
+
+    def _release_owner(self, filename: str):
+        fd = self._owners.pop(filename)
+        if fd is not None:
+            os.close(fd)
+
+    def _open_shard(self, index: int,
+                    write: bool = False) -> Optional[BPlusTree]:
+        """ 返回第 index 个分片，调用者需要持有 _split_lock
+
+        没有其他进程拥有这个分片时获取它的所有权，可写地打开分片。
+        分片属于其他进程时只读地打开，不会恢复或者删除它的 WAL，
+        分片还没有数据时返回 None；write 为 True 时抛出 ValueError。
+        获取所有权时清单已经过期的话抛出 _StaleManifest。
+        """
+        filename = self._files[index]
+        with self._lock:
+            tree = self._shards.get(filename)
+            if filename in self._owners or (tree is not None and not write):
+                return tree
+            if not self._acquire_owner(filename):
+                if write:
+                    raise ValueError(
+                        'Shard {} is owned by another process'.format(filename)
+                    )
+                tree = self._open_read_only(filename)
+                if tree is not None:
+                    self._shards[filename] = tree
+                return tree
+
+            try:
+                # 分片的边界只会被它的拥有者改变，获取所有权之后再确认清单
+                # 是最新的，之后这个分片的边界就不会再被其他进程改变
+                with self._manifest_lock():
+                    manifest = self._read_manifest()
+                if [shard['file'] for shard in manifest['shards']] != \
+                        self._files:
+                    raise _StaleManifest()
+                # 之前只读地打开的分片可能还在被遍历，不关闭它，由垃圾回收关闭
+                tree = self._open_tree(filename)
+            except BaseException:
+                self._release_owner(filename)
+                raise
+            # 分裂在更新清单之后、删除原来的记录之前崩溃时，
+            # 分片中会留下超过上界的记录
+            if index < len(self._bounds):
+                upper = self._bounds[index]
+                if any(True for _ in tree.scan(upper, projection='keys',
+                                               prefetch=1)):
+                    tree.delete_range(upper)
+            self._shards[filename] = tree
+            return tree
+
+    def _route(self, key, write: bool = False) -> tuple:
+        """ 返回 (key 所在的分片的文件名, 分片) """
+        i = self.shard_for(key)
+        return self._files[i], self._open_shard(i, write)
+
+    def _group(self, keys: list) -> Iterator[tuple]:
+        """ 把排好序的 keys 按照分片分组，返回 (分片的序号, 开始, 结束) """
+        start = 0
+        while start < len(keys):
+            i = self.shard_for(keys[start])
+            if i < len(self._bounds):
+                stop = bisect.bisect_left(keys, self._bounds[i], start)
+            else:
+                stop = len(keys)
+            yield i, start, stop
+            start = stop
+
+    def _scan(self, start, end, projection: str) -> Iterator:
+        position, after = start, None
+
+        def next_shard():
+            key = after if after is not None else position
+            i = 0 if key is None else self.shard_for(key)
+            upper = self._bounds[i] if i < len(self._bounds) else None
+            return self._generation, self._open_shard(i), upper
+
+        while True:
+            generation, tree, upper = self._locked(next_shard)
+            last = upper is None or (end is not None and end <= upper)
+            records = () if tree is None else tree.scan(
+                position, end if last else upper, after=after
+            )
+            for key, value in records:
+                after = key
+                if projection == 'keys':
+                    yield key
+                elif projection == 'values':
+                    yield value
+                else:
+                    yield key, value
+
+            with self._split_lock.reader_lock:
+                if self._generation != generation:
+                    # 分片在遍历的过程中被分裂了，从 after 之后重新查找分片
+                    continue
+            if last:
+                return
+            position, after = upper, None
+
+    def _after_write(self, filename: str, count: int):
+        """ 分片写入的键足够多时检查它是否需要分裂 """
+        if self._max_shard_keys is None:
+            return
+        with self._lock:
+            written = self._writes.get(filename, 0) + count
+            self._writes[filename] = written % SPLIT_CHECK_INTERVAL
+            if written < SPLIT_CHECK_INTERVAL:
+                return
+        self._split(filename, min_keys=self._max_shard_keys)
+
+    def _split(self, filename: str, key=None, min_keys: Optional[int] = None):
+        """ 分裂文件名为 filename 的分片，min_keys 不为 None 时，
+        只在分片中的键超过 min_keys 个时分裂 """
+        with self._split_lock.writer_lock, self._manifest_lock():
+            # 其他进程可能已经分裂了它们的分片
+            self._load_manifest(self._read_manifest())
+            index = self._files.index(filename)
+            tree = self._open_shard(index, write=True)
+            length = len(tree)
+            if min_keys is not None and length <= min_keys:
+                return
+
+            lower = self._bounds[index - 1] if index else None
+            upper = self._bounds[index] if index < len(self._bounds) else None
+            if key is None:
+                if length < 2:
+                    raise ValueError('Shard {} is too small to split'.format(
+                        index
+                    ))
+                key = tree.select(length // 2)
+            elif ((lower is not None and key <= lower)
+                  or (upper is not None and key >= upper)):
+                raise ValueError('Key {} is not inside shard {}'.format(
+                    key, index
+                ))
+
+            # 没有写入清单的分片文件是之前的分裂崩溃时留下的
+            new_filename = self._shard_filename(self._next_id)
+            with self._lock:
+                if not self._acquire_owner(new_filename):
+                    raise ValueError('Shard {} is owned by another '
+                                     'process'.format(new_filename))
+            path = self._path(new_filename)
+            try:
+                for leftover in (path, path + '-wal', path + '-bloom',
+                                 path + '-extents'):
+                    if os.path.exists(leftover):
+                        os.unlink(leftover)
+                new_tree = self._open_tree(new_filename)
+            except BaseException:
+                with self._lock:
+                    self._release_owner(new_filename)
+                raise
+            try:
+                batch = []
+                for item in tree.scan(key, upper):
+                    batch.append(item)
+                    if len(batch) == SPLIT_BATCH:
+                        new_tree.insert_many(batch)
+                        batch = []
+                if batch:
+                    new_tree.insert_many(batch)
+            except BaseException:
+                new_tree.close()
+                with self._lock:
+                    self._release_owner(new_filename)
+                raise
+
+            self._next_id += 1
+            self._bounds.insert(index, key)
+            self._files.insert(index + 1, new_filename)
+            self._write_manifest()
+            self._generation += 1
+            with self._lock:
+                self._shards[new_filename] = new_tree
+            tree.delete_range(key)
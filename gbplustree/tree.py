@@ -0,0 +1,1325 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import contextlib
+import logging
+import math
+import operator
+import os
+import random
+from functools import partial
+from typing import Optional, Iterable, Iterator, Union
+
+from .const import TreeConf, SEARCH_STRATEGIES
+from .bloom import BloomFilter
+from .cursor import Cursor, ReverseCursor, PrefixEnd
+from .entry import Record, Reference
+from .memory import FileMemory, MmapMemory
+from .metrics import Metrics, timed_operation
+from .node import (
+    Node,
+    LonelyRootNode,
+    RootNode,
+    InternalNode,
+    LeafNode,
+    SEQUENTIAL_INSERTS_THRESHOLD,
+)
+from .serializer import Serializer, IntSerializer
+
+
+logger = logging.getLogger(__name__)
+
+# stats() 统计每一层时，每次读取的节点的个数
+STATS_BATCH_PAGES = 256
+
+
+class BPlusTree:
+
+    __slots__ = ['_filename', '_tree_conf', '_mem', '_root_node_page',
+                 '_structure_version', '_is_open', '_bloom', '_metrics',
+                 'LonelyRootNode',
+                 'RootNode', 'InternalNode', 'LeafNode', 'Record', 'Reference']
+
+    # ############################ 公开的 API ##############################
+
+    def __init__(self, filename: str, page_size: int = 4096, order: int = 50,
+                 key_size: int = 8, value_size: int = 32, cache_size: int = 64,
+                 serializer: Optional[Serializer] = None,
+                 compression: Optional[str] = None,
+                 bloom_filter: bool = False, order_statistics: bool = False,
+                 search: str = 'bisect',
+                 metrics: Union[bool, Metrics] = False,
+                 direct_io: bool = False):
+        """
+        打开已经存在的树时，page_size、order、key_size、value_size 和内置的
+        serializer 都从文件的元数据中读取，不需要再传入
+
+        :param serializer: 键的 Serializer，默认是 IntSerializer，
+                           和已经存在的树中保存的不同时抛出 ValueError
+        :param bloom_filter: 是否使用布隆过滤器，不存在的键不需要读取叶子节点，
+                             过滤器在关闭时保存到 filename-bloom 文件中
+        :param order_statistics: 是否在内部节点中保存子树中记录的个数，
+                                 len、rank、select 和 sample 只需要 O(log n)，
+                                 插入新的键时需要锁住整棵树并修改整条路径
+        :param search: 节点内查找键的方法，'interpolation' 对均匀分布的整数键
+                       使用插值查找，order 较大时比二分查找的比较次数少
+        :param metrics: 为 True 或者一个 Metrics 对象时收集运行时统计，
+                        可以通过 stats() 读取，默认不收集
+        :param direct_io: 用 O_DIRECT 读取树文件，只使用树自己的缓存，
+                          需要配合较大的 cache_size，见 FileMemory
+        """
+        if search not in SEARCH_STRATEGIES:
+            raise ValueError('Unknown search strategy {}'.format(search))
+        self._filename = filename
+        self._tree_conf = TreeConf(
+            page_size, order, key_size, value_size,
+            serializer or IntSerializer(), order_statistics, search
+        )
+        self._create_partials()
+        # 每次树的结构改变 (节点分裂) 时加一，游标用它判断是否需要重新查找
+        self._structure_version = 0
+        if metrics is True:
+            metrics = Metrics()
+        self._metrics = metrics or None
+        created = not os.path.exists(filename)
+        self._mem = FileMemory(filename, self._tree_conf,
+                               cache_size=cache_size, compression=compression,
+                               metrics=self._metrics, direct_io=direct_io)
+        if not self._mem.has_metadata:
+            # 已经存在的树使用保存的元数据，只有新的树需要检查传入的参数
+            try:
+                self._check_page_size()
+            except ValueError:
+                self._mem.close()
+                if created:
+                    os.unlink(filename)
+                raise
+            self._initialize_empty_tree()
+        else:
+            try:
+                self._root_node_page, self._tree_conf = \
+                    self._mem.get_metadata()
+            except ValueError:
+                self._mem.close()
+                raise
+            if (serializer is not None
+                    and self._tree_conf.serializer is not serializer):
+                self._mem.close()
+                raise ValueError('{} was created with {}'.format(
+                    filename, self._tree_conf.serializer
+                ))
+            self._create_partials()
+        self._mem.on_rollback = self._reload_root
+        if bloom_filter:
+            self._bloom = self._open_bloom_filter()
+        else:
+            self._bloom = None
+            # 不使用过滤器时的修改会让之前保存的过滤器过期
+            if os.path.exists(self._bloom_filename):
+                os.unlink(self._bloom_filename)
+        self._is_open = True
+
+    def close(self):
+        with self._mem.write_transaction:
+            if not self._is_open:
+                logger.info('Tree is already closed')
+                return
+
+            self._mem.close()
+            if self._bloom is not None:
+                self._bloom.to_file(self._bloom_filename)
+            self._is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def checkpoint(self) -> bool:
+        """ 将 WAL 写回树文件，有快照没有关闭时只写回最老的快照之前提交的页，返回 False """
+        with self._mem.write_transaction:
+            return self._mem.perform_checkpoint(reopen_wal=True)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ 把多次修改合并成一个事务
+
+        事务中修改过的节点只保存在内存中，退出时每个被修改过的页只写入一次，
+        所有的页按照页号排序，和 COMMIT 帧一起一次追加到 WAL 中。
+        事务中出现异常或者提交失败时，所有的修改都会被回滚 (见 _reload_root)。
+        事务持有整棵树的写锁，其他线程的读写都会被阻塞，事务可以嵌套。
+        """
+        with self._mem.write_transaction:
+            yield self
+
+    @property
+    def metrics(self) -> Optional[Metrics]:
+        """ 收集统计的 Metrics 对象，可以用它添加 hook，没有收集时为 None """
+        return self._metrics
+
+    def stats(self, structure: bool = True) -> dict:
+        """ 返回树的统计信息
+
+        包含 Metrics 中的 counters 和 timings (没有收集时为空)、树的高度 height，
+        structure 为 True 时还包含 levels，从叶子节点开始每一层的
+        节点个数 nodes、entries 个数 entries 和平均填充率 fill_factor。
+        统计每一层需要读取所有的节点，读取的节点不会放入缓存。
+        """
+        if self._metrics is not None:
+            rv = self._metrics.snapshot()
+        else:
+            rv = {'counters': {}, 'timings': {}}
+
+        with self._mem.read_transaction:
+            if not structure:
+                height = 1
+                node = self._root_node
+                while not isinstance(node, (LonelyRootNode, LeafNode)):
+                    node = self._mem.get_node(node.smallest_entry.before)
+                    height += 1
+                rv['height'] = height
+                return rv
+
+            levels = []
+            pages = [self._root_node_page]
+            while pages:
+                entries = capacity = 0
+                children = []
+                # 每次只读取一部分节点，不会把一整层都放在内存中
+                for i in range(0, len(pages), STATS_BATCH_PAGES):
+                    for node in self._mem.read_nodes(
+                            pages[i:i + STATS_BATCH_PAGES]):
+                        entries += len(node.entries)
+                        capacity += node.max_children
+                        if not isinstance(node, (LonelyRootNode, LeafNode)):
+                            children.extend(node.children_pages)
+                levels.append({
+                    'nodes': len(pages),
+                    'entries': entries,
+                    'fill_factor': entries / capacity,
+                })
+                pages = children
+
+        rv['height'] = len(levels)
+        rv['levels'] = levels[::-1]
+        return rv
+
+    @classmethod
+    def open_read_only(cls, filename: str, cache_size: int = 64,
+                       serializer: Optional[Serializer] = None,
+                       search: str = 'bisect',
+                       metrics: Union[bool, Metrics] = False
+                       ) -> 'ReadOnlyTree':
+        """ 只读地打开一个已经存在的树文件，多个进程可以共享同一份映射，见 ReadOnlyTree """
+        return ReadOnlyTree(filename, cache_size, serializer, search, metrics)
+
+    def snapshot(self) -> 'Snapshot':
+        """ 打开一个快照，快照中的读取不会阻塞写者，也看不到之后的修改
+
+        快照需要被关闭，快照没有关闭时 checkpoint 只能写回它打开之前提交的页，
+        之后的修改留在 WAL 中。不再被引用的快照被垃圾回收时自动释放。
+        """
+        return Snapshot(self)
+
+    @timed_operation('insert')
+    def insert(self, key, value: bytes, replace: bool = False):
+        """ 向树中插入一个值
+
+        :param key: 值对应的键，类型需要和 Serializer 使用的类型一致
+        :param value: 需要保存的值，必须是 bytes
+        :param replace: 为 True 时覆盖已经存在的值，否则抛出 ValueError
+        """
+        self._check_value(value)
+
+        # 先尝试只锁住叶子节点插入，叶子节点需要分裂时再锁住整棵树，
+        # 在 transaction 中时修改需要和整个事务一起提交，不能单独提交叶子节点
+        if (not self._mem.in_write_transaction
+                and self._insert_in_leaf(key, value, replace)):
+            return
+
+        with self._mem.write_transaction:
+            node = self._search_in_tree(key, self._root_node)
+
+            # 检查键是否已经存在
+            try:
+                existing_record = node.get_entry(key)
+            except ValueError:
+                pass
+            else:
+                if not replace:
+                    raise ValueError('Key {} already exists'.format(key))
+
+                existing_record.value = value
+                self._mem.set_node(node)
+                return
+
+            # 只有新的键需要加入过滤器，覆盖已有的值不会改变过滤器中键的个数
+            self._grow_bloom_filter()
+            self._add_key_to_bloom_filter(key)
+            record = self.Record(key, value=value)
+            node.insert_entry(record)
+            self._add_to_counts(node, key, 1)
+            if len(node.entries) <= node.max_children:
+                self._mem.set_node(node)
+            else:
+                self._split_leaf(node)
+
+    def insert_many(self, items, replace: bool = False):
+        """ 在一个事务中批量插入 (key, value)，items 也可以是一个字典
+
+        先把记录按照键排序，然后从左到右处理叶子节点：每个叶子节点只查找一次，
+        落在同一个叶子节点中的记录一起插入，比节点中的键都大的记录直接追加到末尾，
+        插入之后超出容量的叶子节点只分裂一次，分裂成需要的多个叶子节点。
+        有任何一个键已经存在并且 replace 为 False 时，整个批量插入都会被回滚。
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        records = sorted(items, key=operator.itemgetter(0))
+        for _, value in records:
+            self._check_value(value)
+        keys = [key for key, _ in records]
+
+        with self.transaction(), self._mem.sequential_access():
+            # 修改节点之前先检查过滤器是否需要重新创建，之后只加入新的键
+            self._grow_bloom_filter()
+            i = 0
+            while i < len(records):
+                node = self._search_in_tree(keys[i], self._root_node)
+                fence = self._leaf_fence(node, keys[i])
+                if fence is None:
+                    j = len(keys)
+                else:
+                    j = bisect.bisect_left(keys, fence, i)
+
+                num_entries = len(node.entries)
+                for key, value in records[i:j]:
+                    if not node.entries or key > node.biggest_key:
+                        self._add_key_to_bloom_filter(key)
+                        node.insert_entry_at_the_end(
+                            self.Record(key, value=value)
+                        )
+                        continue
+                    try:
+                        existing_record = node.get_entry(key)
+                    except ValueError:
+                        self._add_key_to_bloom_filter(key)
+                        node.insert_entry(self.Record(key, value=value))
+                    else:
+                        if not replace:
+                            raise ValueError(
+                                'Key {} already exists'.format(key)
+                            )
+                        existing_record.value = value
+
+                self._add_to_counts(node, keys[i],
+                                    len(node.entries) - num_entries)
+                if len(node.entries) > node.max_children:
+                    self._split_leaf_many(node)
+                else:
+                    self._mem.set_node(node)
+                i = j
+
+    def update_many(self, items):
+        """ 批量插入或者替换 (key, value)，和 insert_many(items, True) 相同 """
+        self.insert_many(items, replace=True)
+
+    def delete_range(self, start=None, end=None):
+        """ 在一个事务中删除 [start, end) 中的所有记录
+
+        只有两端的叶子节点需要删除其中的一部分记录，完全落在区间中的叶子节点和
+        子树不会被读取，它们所在的页被整体放入空闲页链表中，之后会被重新使用。
+        删除之后只有从根节点到两端的叶子节点的路径上的节点需要重新平衡。
+        """
+        if start is not None and end is not None and start >= end:
+            raise ValueError('Cannot delete backwards')
+
+        with self.transaction():
+            self._structure_version += 1
+            root = self._root_node
+            if isinstance(root, LonelyRootNode):
+                self._trim_leaf(root, start, end)
+                self._mem.set_node(root)
+                return
+
+            height = 0
+            node = root
+            while not isinstance(node, LeafNode):
+                node = self._mem.get_node(node.smallest_entry.before)
+                height += 1
+
+            # 这次删除修改过的节点，页号 -> LeafNode 或者 _Branch
+            loaded = dict()
+            root_branch = self._delete_range_in(root.page, height, start, end,
+                                                None, None, loaded)
+            if self._tree_conf.order_statistics:
+                self._refresh_counts(root_branch, loaded)
+            del loaded[root.page]
+            self._collapse_root(root_branch, height, loaded)
+            for page, item in loaded.items():
+                if isinstance(item, _Branch):
+                    item = InternalNode.from_children(
+                        self._tree_conf, page, item.children, item.keys,
+                        item.counts
+                    )
+                self._mem.set_node(item)
+            self._relink_leaves(start, end)
+
+    @timed_operation('get')
+    def get(self, key, default=None) -> bytes:
+        if not self._may_contain(key):
+            return default
+        with self._mem.read_transaction:
+            node = self._search_in_tree(key, self._root_node)
+            with self._mem.latch(node.page):
+                try:
+                    record = node.get_entry(key)
+                except ValueError:
+                    return default
+                else:
+                    return record.value
+
+    def get_many(self, keys: Iterable, default=None) -> list:
+        """ 批量查找，按照 keys 的顺序返回对应的值，不存在的键返回 default
+
+        先把键排序，再从根节点一层一层地把它们分给子节点，
+        每个节点在一次批量查找中只会被读取一次
+        """
+        keys = list(keys)
+        probes = sorted(key for key in set(keys) if self._may_contain(key))
+        if not probes:
+            return [default] * len(keys)
+        found = dict()
+        with self._mem.read_transaction:
+            level = [(self._root_node, probes)]
+            while not isinstance(level[0][0], (LonelyRootNode, LeafNode)):
+                next_level = list()
+                for node, node_keys in level:
+                    for page, child_keys in self._group_by_child(node,
+                                                                 node_keys):
+                        next_level.append((self._mem.get_node(page),
+                                           child_keys))
+                level = next_level
+
+            for node, node_keys in level:
+                with self._mem.latch(node.page):
+                    for key in node_keys:
+                        try:
+                            found[key] = node.get_entry(key).value
+                        except ValueError:
+                            pass
+        return [found.get(key, default) for key in keys]
+
+    def __contains__(self, item):
+        with self._mem.read_transaction:
+            o = object()
+            return self.get(item, default=o) is not o
+
+    def __setitem__(self, key, value):
+        self.insert(key, value, replace=True)
+
+    def __getitem__(self, item):
+        with self._mem.read_transaction:
+
+            if isinstance(item, slice):
+                # 一个方法不能有时返回生成器，有时返回普通的值，所以这里返回一个字典
+                rv = dict()
+                for record in self._iter_slice(item):
+                    rv[record.key] = record.value
+                return rv
+
+            rv = self.get(item)
+            if rv is None:
+                raise KeyError(item)
+            return rv
+
+    def __len__(self):
+        with self._mem.read_transaction:
+            if self._tree_conf.order_statistics:
+                root = self._root_node
+                if isinstance(root, LonelyRootNode):
+                    with self._mem.latch(root.page):
+                        return len(root.entries)
+                return root.total_count
+
+            node = self._left_record_node
+            rv = 0
+            while True:
+                with self._mem.latch(node.page):
+                    rv += len(node.entries)
+                    next_page = node.next_page
+                if not next_page:
+                    return rv
+                node = self._mem.get_node(next_page)
+
+    def rank(self, key) -> int:
+        """ 返回小于 key 的键的个数
+
+        使用 order_statistics 时只需要从根节点下降一次，否则需要遍历这些键
+        """
+        with self._mem.read_transaction:
+            if not self._tree_conf.order_statistics:
+                return sum(1 for _ in self._iter_slice(slice(None, key)))
+
+            rv = 0
+            node = self._root_node
+            while not isinstance(node, (LonelyRootNode, LeafNode)):
+                i = node.find_index(key, right=True)
+                rv += sum(node.children_counts[:i])
+                node = self._mem.get_node(node.children_pages[i])
+            with self._mem.latch(node.page):
+                return rv + node.find_index(key)
+
+    def select(self, k: int):
+        """ 返回从小到大的第 k 个键 (从 0 开始)，k 可以是负数 """
+        with self._mem.read_transaction:
+            length = len(self)
+            if k < 0:
+                k += length
+            if not 0 <= k < length:
+                raise IndexError('Index {} out of range'.format(k))
+            return self._select_many([k])[k]
+
+    def sample(self, n: int = 1, rng: Optional[random.Random] = None) -> list:
+        """ 均匀地随机选择 n 个不同的键，n 大于键的个数时抛出 ValueError """
+        rng = rng or random
+        with self._mem.read_transaction:
+            positions = rng.sample(range(len(self)), n)
+            keys = self._select_many(positions)
+        return [keys[k] for k in positions]
+
+    # 下面的迭代器都使用 Cursor，只在读取每一批 (prefetch 个) 叶子节点时持有读锁，
+    # 批与批之间和 yield 的时候都不持有，没有迭代完的游标不会阻塞写者。
+    # 读取下一批之前游标比较 _structure_version，树的结构改变之后从根节点
+    # 重新查找上一次返回的键之后的位置，所以不会重复或者跳过没有被修改的键。
+    # 写者和打开的游标同时进行时，游标看到的不是一个快照：已经读入的这一批记录
+    # 不会反映之后的修改，之后的批次可以看到新插入的键，看不到已经删除的键。
+    # 需要一致的视图时使用 snapshot()。
+
+    def scan(self, start=None, end=None, projection: str = 'items',
+             prefetch: int = 8, after=None, reverse: bool = False):
+        """ 返回一个遍历 [start, end) 的游标，参数的含义见 Cursor
+
+        reverse 为 True 时返回从大到小遍历的 ReverseCursor，
+        它沿着叶子节点的 prev_page 读取，不使用 prefetch
+        """
+        if reverse:
+            return ReverseCursor(self, start, end, projection, after)
+        return Cursor(self, start, end, projection, prefetch, after)
+
+    def scan_prefix(self, prefix: tuple, projection: str = 'items',
+                    prefetch: int = 8, reverse: bool = False):
+        """ 返回一个遍历所有以 prefix 开头的元组键的游标
+
+        游标从根节点直接下降到第一个 >= prefix 的键所在的叶子节点，
+        在第一个不以 prefix 开头的键处停止，只读取连续的一段叶子节点。
+        键需要是元组，通常使用 TupleSerializer。
+        """
+        if not isinstance(prefix, tuple):
+            raise ValueError('Prefix {} is not a tuple'.format(prefix))
+        return self.scan(prefix, PrefixEnd(prefix), projection, prefetch,
+                         reverse=reverse)
+
+    def __iter__(self, slice_: Optional[slice] = None):
+        return self._iter_cursor(slice_, 'keys')
+
+    keys = __iter__
+
+    def items(self, slice_: Optional[slice] = None) -> Iterator[tuple]:
+        return self._iter_cursor(slice_, 'items')
+
+    def values(self, slice_: Optional[slice] = None) -> Iterator[bytes]:
+        return self._iter_cursor(slice_, 'values')
+
+    def __bool__(self):
+        with self._mem.read_transaction:
+            for _ in self:
+                return True
+            return False
+
+    def __repr__(self):
+        return '<BPlusTree: {} {}>'.format(self._filename, self._tree_conf)
+
+    # ############################## 实现 ##################################
+
+    def _initialize_empty_tree(self):
+        self._root_node_page = self._mem.next_available_page
+        with self._mem.write_transaction:
+            self._mem.set_node(self.LonelyRootNode(page=self._root_node_page))
+            self._mem.set_metadata(self._root_node_page, self._tree_conf)
+
+    def _check_page_size(self):
+        """ 检查一个满的节点能否放进一页中，节点头的长度为 12 """
+        max_used = (self._tree_conf.order - 1) * max(
+            self.Record().length, self.Reference().length
+        ) + 12
+        if max_used >= self._tree_conf.page_size:
+            raise ValueError('Page size {} is too small for order {}'.format(
+                self._tree_conf.page_size, self._tree_conf.order
+            ))
+
+    def _reload_root(self):
+        """ 最外层的写事务回滚之后调用，根节点可能又变回了之前的页 """
+        self._root_node_page = self._mem.get_metadata()[0]
+        self._structure_version += 1
+
+    def _create_partials(self):
+        self.LonelyRootNode = partial(LonelyRootNode, self._tree_conf)
+        self.RootNode = partial(RootNode, self._tree_conf)
+        self.InternalNode = partial(InternalNode, self._tree_conf)
+        self.LeafNode = partial(LeafNode, self._tree_conf)
+        self.Record = partial(Record, self._tree_conf)
+        self.Reference = partial(Reference, self._tree_conf)
+
+    @property
+    def _root_node(self) -> Union['LonelyRootNode', 'RootNode']:
+        root_node = self._mem.get_node(self._root_node_page)
+        assert isinstance(root_node, (LonelyRootNode, RootNode))
+        return root_node
+
+    @property
+    def _left_record_node(self) -> Union['LonelyRootNode', 'LeafNode']:
+        node = self._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            node = self._mem.get_node(node.smallest_entry.before)
+        return node
+
+    def _iter_cursor(self, slice_: Optional[slice], projection: str):
+        """ keys/items/values 使用游标遍历
+
+        游标只在读取每一批叶子节点时持有读锁，yield 的时候不持有，
+        循环中插入的值导致节点分裂时不会因为不能升级读锁而失败。
+        """
+        if not slice_:
+            slice_ = slice(None)
+        if slice_.step is not None:
+            raise ValueError('Cannot iterate with a custom step')
+        yield from Cursor(self, slice_.start, slice_.stop, projection)
+
+    def _iter_slice(self, slice_: slice) -> Iterator[Record]:
+        if slice_.step is not None:
+            raise ValueError('Cannot iterate with a custom step')
+
+        if (slice_.start is not None and slice_.stop is not None
+                and slice_.start >= slice_.stop):
+            raise ValueError('Cannot iterate backwards')
+
+        if slice_.start is None:
+            node = self._left_record_node
+        else:
+            node = self._search_in_tree(slice_.start, self._root_node)
+
+        while True:
+            # 只在复制 entries 的时候持有 latch，yield 的时候不持有
+            with self._mem.latch(node.page):
+                entries = list(node.entries)
+                next_page = node.next_page
+
+            for entry in entries:
+                if slice_.start is not None and entry.key < slice_.start:
+                    continue
+
+                if slice_.stop is not None and entry.key >= slice_.stop:
+                    return
+
+                yield entry
+
+            if next_page:
+                node = self._mem.get_node(next_page)
+            else:
+                return
+
+    def _insert_in_leaf(self, key, value: bytes, replace: bool) -> bool:
+        """ 乐观地插入一个值，只有叶子节点会被修改
+
+        持有读事务时树的结构不会改变，所以下降的过程中不需要锁住祖先节点，
+        只需要排他地锁住叶子节点，不同的叶子节点可以被多个线程同时修改。
+        叶子节点不能安全地加入新的 entry (can_add_entry 为 False) 时，
+        不做任何修改，返回 False，由调用者锁住整棵树重新插入。
+        """
+        with self._mem.read_transaction:
+            page = self._search_in_tree(key, self._root_node).page
+            with self._mem.latch(page, exclusive=True):
+                node = self._mem.get_node(page)
+                try:
+                    existing_record = node.get_entry(key)
+                except ValueError:
+                    # 保存了子树中记录的个数时，新的键需要修改整条路径
+                    if (not node.can_add_entry
+                            or self._tree_conf.order_statistics):
+                        return False
+                    # 持有读事务时过滤器不会被重新创建，先加入过滤器，
+                    # 读者看到这个键的时候它一定已经在过滤器中了
+                    self._add_key_to_bloom_filter(key)
+                    node.insert_entry(self.Record(key, value=value))
+                else:
+                    if not replace:
+                        raise ValueError('Key {} already exists'.format(key))
+                    existing_record.value = value
+                self._mem.commit_node(node)
+        return True
+
+    def _search_in_tree(self, key, node: Node) -> Node:
+        """ 从 node 开始向下查找，返回 key 所在的叶子节点 """
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            child_node = self._mem.get_node(self._child_page(key, node))
+            child_node.parent = node
+            node = child_node
+        return node
+
+    def _child_page(self, key, node: Node) -> int:
+        """ 返回内部节点 node 中 key 所在的子节点的页 """
+        i = node.find_index(key, right=True)
+        if i == 0:
+            return node.smallest_entry.before
+        return node.entries[i - 1].after
+
+    @property
+    def _bloom_filename(self) -> str:
+        return self._filename + '-bloom'
+
+    def _open_bloom_filter(self) -> BloomFilter:
+        """ 读取上一次关闭时保存的布隆过滤器，没有时扫描所有的键重新创建
+
+        读取之后文件会被删除，只有正常关闭时才会重新写入，
+        所以没有正常关闭时，下一次打开会重新创建过滤器，不会漏掉任何键。
+        """
+        try:
+            bloom = BloomFilter.from_file(self._bloom_filename)
+        except FileNotFoundError:
+            return self._build_bloom_filter()
+        except (OSError, ValueError):
+            logger.warning('Bloom filter of {} is corrupted, rebuilding it'
+                           .format(self._filename))
+            bloom = self._build_bloom_filter()
+        os.unlink(self._bloom_filename)
+        return bloom
+
+    def _build_bloom_filter(self) -> BloomFilter:
+        with self._mem.read_transaction:
+            bloom = BloomFilter(2 * len(self))
+            serializer = self._tree_conf.serializer
+            for key in self.keys():
+                bloom.add(serializer.serialize(key, self._tree_conf.key_size))
+        return bloom
+
+    def _grow_bloom_filter(self):
+        """ 过滤器中的键太多时用两倍的容量重新创建，需要持有写事务
+
+        重新创建时只会加入已经在树中的键，所以需要在修改节点之前调用，
+        写事务保证不会同时有乐观插入 (在读事务中把键加入过滤器) 正在进行。
+        """
+        if self._bloom is not None and self._bloom.is_full:
+            logger.info('Rebuilding the bloom filter of {}'.format(
+                self._filename
+            ))
+            self._bloom = self._build_bloom_filter()
+
+    def _add_key_to_bloom_filter(self, key):
+        """ 把一个键加入过滤器，需要持有读事务或者写事务 """
+        if self._bloom is not None:
+            self._bloom.add(
+                self._tree_conf.serializer.serialize(key,
+                                                     self._tree_conf.key_size)
+            )
+
+    def _may_contain(self, key) -> bool:
+        """ 返回 False 时 key 一定不存在 """
+        if self._bloom is None:
+            return True
+        return self._tree_conf.serializer.serialize(
+            key, self._tree_conf.key_size
+        ) in self._bloom
+
+    def _select_many(self, positions: list) -> dict:
+        """ 返回 {k: 第 k 个键}，positions 需要都在范围内 """
+        if not self._tree_conf.order_statistics:
+            # 遍历一次所有的键
+            wanted = set(positions)
+            rv = dict()
+            for k, record in enumerate(self._iter_slice(slice(None))):
+                if k in wanted:
+                    rv[k] = record.key
+                    if len(rv) == len(wanted):
+                        break
+            return rv
+
+        rv = dict()
+        for k in positions:
+            node = self._root_node
+            i = k
+            while not isinstance(node, (LonelyRootNode, LeafNode)):
+                for child, count in zip(node.children_pages,
+                                        node.children_counts):
+                    if i < count:
+                        break
+                    i -= count
+                node = self._mem.get_node(child)
+            with self._mem.latch(node.page):
+                rv[k] = node.entries[i].key
+        return rv
+
+    def _add_to_counts(self, node: Node, key, delta: int):
+        """ key 所在的叶子节点 node 中增加了 delta 个记录，修改所有祖先节点中的个数
+
+        node 需要是 _search_in_tree 返回的节点，它的 parent 已经被设置好了
+        """
+        if not self._tree_conf.order_statistics or not delta:
+            return
+        while node.parent is not None:
+            parent = node.parent
+            parent.add_to_child_count(
+                parent.find_index(key, right=True), delta
+            )
+            self._mem.set_node(parent)
+            node = parent
+
+    def _check_value(self, value: bytes):
+        if not isinstance(value, bytes):
+            raise ValueError('Values must be bytes objects')
+        if len(value) > self._tree_conf.value_size:
+            raise ValueError('Value is bigger than value_size {}'.format(
+                self._tree_conf.value_size
+            ))
+
+    def _leaf_fence(self, node: Node, key) -> Optional[object]:
+        """ 返回 key 所在的叶子节点 node 中的键的上界 (不包含)，最右边的为 None
+
+        node 需要是 _search_in_tree 返回的节点，它的 parent 已经被设置好了
+        """
+        while node.parent is not None:
+            parent = node.parent
+            i = parent.find_index(key, right=True)
+            if i < len(parent.entries):
+                return parent.entries[i].key
+            node = parent
+        return None
+
+    def _group_by_child(self, node: Node, keys: list) -> Iterator[tuple]:
+        """ 把排好序的 keys 分给内部节点 node 的子节点，返回 (页, 键的列表) """
+        start = 0
+        while start < len(keys):
+            i = node.find_index(keys[start], right=True)
+            if i == len(node.entries):
+                end = len(keys)
+            else:
+                end = bisect.bisect_left(keys, node.entries[i].key, start)
+            page = node.smallest_entry.before if i == 0 else \
+                node.entries[i - 1].after
+            yield page, keys[start:end]
+            start = end
+
+    def _trim_leaf(self, node: Node, start, end):
+        """ 删除叶子节点中 [start, end) 之间的记录 """
+        i = 0
+        if start is not None:
+            i = node.find_index(start)
+        j = len(node.entries)
+        if end is not None:
+            j = node.find_index(end)
+        if i < j:
+            del node.entries[i:j]
+            node.append_streak = 0
+
+    def _load_for_delete(self, page: int, loaded: dict):
+        item = loaded.get(page)
+        if item is None:
+            node = self._mem.get_node(page)
+            if isinstance(node, LeafNode):
+                item = node
+            else:
+                item = _Branch(node, node.children_pages,
+                               [ref.key for ref in node.entries],
+                               node.children_counts)
+            loaded[page] = item
+        return item
+
+    def _delete_range_in(self, page: int, height: int, start, end, lower,
+                         upper, loaded: dict):
+        """ 从 page 为根的子树中删除 [start, end) 中的记录
+
+        lower 和 upper 是这个子树中的键的范围，height 为 0 时 page 是叶子节点。
+        只有和区间部分重叠的子节点会被读取，完全被覆盖的子节点被整体释放。
+        返回修改后的节点，它可能不满足最少子节点的要求，由父节点重新平衡。
+        """
+        item = self._load_for_delete(page, loaded)
+        if height == 0:
+            self._trim_leaf(item, start, end)
+            return item
+
+        lowers = [lower] + item.keys
+        uppers = item.keys + [upper]
+        covered = list()
+        for i, child in enumerate(item.children):
+            lo, hi = lowers[i], uppers[i]
+            if not _overlaps(start, end, lo, hi):
+                continue
+            if _covers(start, end, lo, hi):
+                covered.append(i)
+            else:
+                self._delete_range_in(child, height - 1, start, end, lo, hi,
+                                      loaded)
+
+        if covered:
+            # 被覆盖的子节点一定是连续的
+            a, b = covered[0], covered[-1] + 1
+            for child in item.children[a:b]:
+                self._free_subtree(child, height - 1, loaded)
+            del item.children[a:b]
+            del item.counts[a:b]
+            if a > 0:
+                del item.keys[a - 1:b - 1]
+            else:
+                del item.keys[0:b]
+
+        self._rebalance(item, height, loaded)
+        return item
+
+    def _free_subtree(self, page: int, height: int, loaded: dict):
+        """ 释放一个子树中的所有页，叶子节点不会被读取 """
+        if height > 0:
+            item = loaded.get(page)
+            if item is None:
+                children = self._mem.get_node(page).children_pages
+            else:
+                children = item.children
+            for child in children:
+                self._free_subtree(child, height - 1, loaded)
+        loaded.pop(page, None)
+        self._mem.del_page(page)
+
+    def _rebalance(self, branch: '_Branch', height: int, loaded: dict):
+        """ 合并或者重新分配 branch 中子节点数太少的子节点
+
+        只有这次删除读取过的子节点 (在 loaded 中) 可能太少，其他的子节点不需要检查
+        """
+        while len(branch.children) > 1:
+            for i, page in enumerate(branch.children):
+                item = loaded.get(page)
+                if item is not None and _size(item) < _node(item).min_children:
+                    break
+            else:
+                return
+
+            if _size(item) == 0:
+                del loaded[page]
+                self._mem.del_page(page)
+                del branch.children[i]
+                del branch.counts[i]
+                del branch.keys[i - 1 if i > 0 else 0]
+                continue
+
+            left = i - 1 if i > 0 else i
+            right = left + 1
+            left_item = self._load_for_delete(branch.children[left], loaded)
+            right_item = self._load_for_delete(branch.children[right], loaded)
+            separator = branch.keys[left]
+
+            if (_size(left_item) + _size(right_item)
+                    <= _node(left_item).max_children):
+                # 把右边的节点合并到左边的节点中
+                if height == 1:
+                    left_item.entries.extend(right_item.entries)
+                else:
+                    left_item.children.extend(right_item.children)
+                    left_item.keys.extend([separator] + right_item.keys)
+                    left_item.counts.extend(right_item.counts)
+                del loaded[branch.children[right]]
+                self._mem.del_page(branch.children[right])
+                del branch.children[right]
+                del branch.counts[right]
+                del branch.keys[left]
+                if height > 1:
+                    self._rebalance(left_item, height - 1, loaded)
+                continue
+
+            # 两个节点合并之后放不下，平均分配它们的子节点
+            if height == 1:
+                entries = left_item.entries + right_item.entries
+                half = len(entries) // 2
+                left_item.entries = entries[:half]
+                right_item.entries = entries[half:]
+                branch.keys[left] = right_item.smallest_key
+            else:
+                children = left_item.children + right_item.children
+                keys = left_item.keys + [separator] + right_item.keys
+                counts = left_item.counts + right_item.counts
+                half = len(children) // 2
+                left_item.children = children[:half]
+                left_item.keys = keys[:half - 1]
+                left_item.counts = counts[:half]
+                branch.keys[left] = keys[half - 1]
+                right_item.children = children[half:]
+                right_item.keys = keys[half:]
+                right_item.counts = counts[half:]
+                self._rebalance(left_item, height - 1, loaded)
+                self._rebalance(right_item, height - 1, loaded)
+
+    def _refresh_counts(self, branch: '_Branch', loaded: dict) -> int:
+        """ 重新计算被修改过的子树中记录的个数，返回 branch 中记录的个数 """
+        for i, page in enumerate(branch.children):
+            item = loaded.get(page)
+            if isinstance(item, _Branch):
+                branch.counts[i] = self._refresh_counts(item, loaded)
+            elif item is not None:
+                branch.counts[i] = len(item.entries)
+        return sum(branch.counts)
+
+    def _collapse_root(self, branch: '_Branch', height: int, loaded: dict):
+        """ 写入删除之后的根节点，根节点只剩一个子节点时，它的子节点成为新的根节点 """
+        while len(branch.children) == 1:
+            self._mem.del_page(branch.node.page)
+            height -= 1
+            item = self._load_for_delete(branch.children[0], loaded)
+            del loaded[branch.children[0]]
+            if height == 0:
+                self._set_root(item.convert_to_lonely_root())
+                return
+            branch = item
+
+        if branch.children:
+            self._set_root(RootNode.from_children(
+                self._tree_conf, branch.node.page, branch.children,
+                branch.keys, branch.counts
+            ))
+        else:
+            # 所有的记录都被删除了
+            self._set_root(self.LonelyRootNode(page=branch.node.page))
+
+    def _set_root(self, root: Node):
+        if root.page != self._root_node_page:
+            self._root_node_page = root.page
+            self._mem.set_metadata(self._root_node_page, self._tree_conf)
+        self._mem.set_node(root)
+
+    def _relink_leaves(self, start, end):
+        """ 修复删除区间两端的叶子节点和它们相邻的叶子节点之间的 prev/next """
+        if isinstance(self._root_node, LonelyRootNode):
+            return
+
+        for key, rightmost in ((start, False), (end, True)):
+            path, leaf = self._leaf_path(key, rightmost)
+            prev_leaf = self._adjacent_leaf(path, -1)
+            next_leaf = self._adjacent_leaf(path, 1)
+            leaf.prev_page = prev_leaf.page if prev_leaf else None
+            leaf.next_page = next_leaf.page if next_leaf else None
+            if prev_leaf:
+                prev_leaf.next_page = leaf.page
+                self._mem.set_node(prev_leaf)
+            if next_leaf:
+                next_leaf.prev_page = leaf.page
+                self._mem.set_node(next_leaf)
+            self._mem.set_node(leaf)
+
+    def _leaf_path(self, key, rightmost: bool = False) -> tuple:
+        """ 返回 ([(内部节点, 子节点的序号)], 叶子节点)
+
+        key 为 None 时，rightmost 决定下降到最左边还是最右边的叶子节点
+        """
+        path = list()
+        node = self._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            if key is not None:
+                i = node.find_index(key, right=True)
+            else:
+                i = len(node.entries) if rightmost else 0
+            path.append((node, i))
+            node = self._mem.get_node(node.children_pages[i])
+        return path, node
+
+    def _adjacent_leaf(self, path: list, step: int) -> Optional[Node]:
+        """ 根据路径返回左边 (step 为 -1) 或者右边 (step 为 1) 相邻的叶子节点 """
+        for node, i in reversed(path):
+            children = node.children_pages
+            if 0 <= i + step < len(children):
+                node = self._mem.get_node(children[i + step])
+                while not isinstance(node, LeafNode):
+                    node = self._mem.get_node(
+                        node.children_pages[0 if step > 0 else -1]
+                    )
+                return node
+        return None
+
+    def _split_leaf(self, old_node: Node):
+        """ 分裂一个叶子节点，使树能够继续增长 """
+        self._structure_version += 1
+        if self._metrics is not None:
+            self._metrics.incr('split.level.0')
+        parent = old_node.parent
+        new_node = self.LeafNode(page=self._mem.next_available_page,
+                                 next_page=old_node.next_page,
+                                 prev_page=old_node.page)
+        append_streak = old_node.append_streak
+        new_entries = old_node.split_entries()
+        new_node.entries = new_entries
+        new_node.append_streak = append_streak
+        ref = self.Reference(new_node.smallest_key,
+                             old_node.page, new_node.page,
+                             before_count=len(old_node.entries),
+                             after_count=len(new_node.entries))
+
+        if isinstance(old_node, LonelyRootNode):
+            # 将 LonelyRoot 转换成 Leaf
+            old_node = old_node.convert_to_leaf()
+            self._create_new_root(ref)
+        else:
+            self._insert_in_parent(parent, ref)
+
+        if old_node.next_page:
+            next_node = self._mem.get_node(old_node.next_page)
+            next_node.prev_page = new_node.page
+            self._mem.set_node(next_node)
+        old_node.next_page = new_node.page
+
+        self._mem.set_node(old_node)
+        self._mem.set_node(new_node)
+
+    def _split_leaf_many(self, old_node: Node):
+        """ 把批量插入之后超出容量的叶子节点一次分裂成多个叶子节点
+
+        顺序插入时除了最后一个节点都是全满的，否则 entries 被平均分配
+        """
+        self._structure_version += 1
+        entries = old_node.entries
+        max_children = old_node.max_children
+        if old_node.append_streak >= SEQUENTIAL_INSERTS_THRESHOLD:
+            size = max_children
+        else:
+            size = math.ceil(
+                len(entries) / math.ceil(len(entries) / max_children)
+            )
+        chunks = [entries[i:i + size] for i in range(0, len(entries), size)]
+
+        is_lonely_root = isinstance(old_node, LonelyRootNode)
+        if is_lonely_root:
+            old_node = old_node.convert_to_leaf()
+        append_streak = old_node.append_streak
+        next_page = old_node.next_page
+        old_node.entries = chunks[0]
+        old_node.append_streak = 0
+
+        node = old_node
+        # 还没有插入到父节点中的 entries 的个数，
+        # 暂时都算在新节点中，父节点中间分裂时子树中记录的个数才是正确的
+        remaining = len(entries) - len(chunks[0])
+        for chunk in chunks[1:]:
+            new_node = self.LeafNode(page=self._mem.next_available_page,
+                                     prev_page=node.page)
+            new_node.entries = chunk
+            node.next_page = new_node.page
+            ref = self.Reference(new_node.smallest_key, node.page,
+                                 new_node.page,
+                                 before_count=len(node.entries),
+                                 after_count=remaining)
+            remaining -= len(chunk)
+            if self._metrics is not None:
+                self._metrics.incr('split.level.0')
+            if is_lonely_root and node is old_node:
+                self._create_new_root(ref)
+            else:
+                # 父节点可能已经分裂过了，从根节点重新找到 node 现在的父节点
+                parent = self._search_in_tree(node.smallest_key,
+                                              self._root_node).parent
+                self._insert_in_parent(parent, ref)
+            self._mem.set_node(node)
+            self._mem.set_node(new_node)
+            node = new_node
+
+        node.next_page = next_page
+        node.append_streak = append_streak
+        if next_page:
+            next_node = self._mem.get_node(next_page)
+            next_node.prev_page = node.page
+            self._mem.set_node(next_node)
+        self._mem.set_node(node)
+
+    def _split_parent(self, old_node: Node, level: int = 1):
+        """ 分裂一个内部节点，level 是它所在的层，叶子节点是第 0 层 """
+        if self._metrics is not None:
+            self._metrics.incr('split.level.{}'.format(level))
+        parent = old_node.parent
+        new_node = self.InternalNode(page=self._mem.next_available_page)
+        append_streak = old_node.append_streak
+        new_entries = old_node.split_entries()
+        new_node.entries = new_entries
+        new_node.append_streak = append_streak
+
+        ref = new_node.pop_smallest()
+        ref.before = old_node.page
+        ref.after = new_node.page
+        ref.before_count = old_node.total_count
+        ref.after_count = new_node.total_count
+
+        if isinstance(old_node, RootNode):
+            # 将 Root 转换成 Internal
+            old_node = old_node.convert_to_internal()
+            self._create_new_root(ref)
+        else:
+            self._insert_in_parent(parent, ref, level + 1)
+
+        self._mem.set_node(old_node)
+        self._mem.set_node(new_node)
+
+    def _insert_in_parent(self, parent: Node, ref: Reference,
+                          level: int = 1):
+        if parent.can_add_entry:
+            parent.insert_entry(ref)
+            self._mem.set_node(parent)
+        else:
+            parent.insert_entry(ref)
+            self._split_parent(parent, level)
+
+    def _create_new_root(self, reference: Reference):
+        new_root = self.RootNode(page=self._mem.next_available_page)
+        new_root.insert_entry(reference)
+        self._root_node_page = new_root.page
+        self._mem.set_metadata(self._root_node_page, self._tree_conf)
+        self._mem.set_node(new_root)
+
+
+class Snapshot(BPlusTree):
+    """ 树在某个时刻的只读视图
+
+    支持 BPlusTree 所有的读取操作，写入操作会抛出 ValueError
+    """
+
+    __slots__ = []
+
+    def __init__(self, tree: BPlusTree):
+        self._filename = tree._filename
+        self._tree_conf = tree._tree_conf
+        self._create_partials()
+        self._structure_version = 0
+        # 过滤器中的键是快照中的键的超集，可以直接共享
+        self._bloom = tree._bloom
+        self._metrics = tree._metrics
+        with tree._mem.read_transaction:
+            self._mem = tree._mem.open_snapshot()
+            self._root_node_page = tree._root_node_page
+        self._is_open = True
+
+    def close(self):
+        if self._is_open:
+            self._mem.close()
+            self._is_open = False
+
+    def checkpoint(self):
+        raise ValueError('Snapshots are read-only')
+
+    def snapshot(self):
+        raise ValueError('Cannot take a snapshot of a snapshot')
+
+    def insert(self, key, value: bytes, replace: bool = False):
+        raise ValueError('Snapshots are read-only')
+
+    def transaction(self):
+        raise ValueError('Snapshots are read-only')
+
+    def __repr__(self):
+        return '<Snapshot: {} {}>'.format(self._filename, self._tree_conf)
+
+
+class _Branch:
+    """ 范围删除过程中正在被修改的内部节点
+
+    内部节点中的 Reference 不能表示只有一个子节点的节点，
+    所以删除的过程中用子节点的页和它们之间的键表示，最后再转换回节点
+    """
+
+    __slots__ = ['node', 'children', 'keys', 'counts']
+
+    def __init__(self, node: Node, children: list, keys: list, counts: list):
+        self.node = node
+        self.children = children
+        self.keys = keys
+        # 每个子树中记录的个数，只有 order_statistics 时才有意义
+        self.counts = counts
+
+
+def _size(item) -> int:
+    if isinstance(item, _Branch):
+        return len(item.children)
+    return len(item.entries)
+
+
+def _node(item) -> Node:
+    return item.node if isinstance(item, _Branch) else item
+
+
+def _overlaps(start, end, lower, upper) -> bool:
+    """ [start, end) 和 [lower, upper) 是否有交集，None 表示没有边界 """
+    return ((end is None or lower is None or lower < end)
+            and (start is None or upper is None or start < upper))
+
+
+def _covers(start, end, lower, upper) -> bool:
+    """ [start, end) 是否包含 [lower, upper) """
+    return ((start is None or (lower is not None and start <= lower))
+            and (end is None or (upper is not None and upper <= end)))
+
+
+class ReadOnlyTree(BPlusTree):
+    """ 用 mmap 只读地打开的树，用于多个进程 (例如 fork 出的 web worker)
+    共享同一个树文件
+
+    支持 BPlusTree 所有的读取操作，写入操作会抛出 ValueError。
+    只能看到写者 checkpoint 到树文件中的数据，还在 WAL 中的修改看不到，
+    写者需要定期调用 checkpoint。树文件被 checkpoint 之后，
+    下一次读取时重新映射，游标会从根节点重新查找。不支持压缩的树文件。
+    """
+
+    __slots__ = []
+
+    def __init__(self, filename: str, cache_size: int = 64,
+                 serializer: Optional[Serializer] = None,
+                 search: str = 'bisect',
+                 metrics: Union[bool, Metrics] = False):
+        if search not in SEARCH_STRATEGIES:
+            raise ValueError('Unknown search strategy {}'.format(search))
+        self._filename = filename
+        if metrics is True:
+            metrics = Metrics()
+        self._metrics = metrics or None
+        self._bloom = None
+        tree_conf = TreeConf(4096, 50, 8, 32, serializer or IntSerializer(),
+                             False, search)
+        self._mem = MmapMemory(filename, tree_conf, cache_size=cache_size,
+                               metrics=self._metrics)
+        self._tree_conf = self._mem.get_metadata()[1]
+        if (serializer is not None
+                and self._tree_conf.serializer is not serializer):
+            self._mem.close()
+            raise ValueError('{} was created with {}'.format(
+                filename, self._tree_conf.serializer
+            ))
+        self._create_partials()
+        self._is_open = True
+
+    # 树文件被 checkpoint 之后根节点可能改变，游标需要重新查找
+    @property
+    def _root_node_page(self) -> int:
+        return self._mem.root_node_page
+
+    @property
+    def _structure_version(self) -> int:
+        return self._mem.generation
+
+    def close(self):
+        if self._is_open:
+            self._mem.close()
+            self._is_open = False
+
+    def checkpoint(self):
+        raise ValueError('Tree is opened read-only')
+
+    def snapshot(self):
+        raise ValueError('Tree is opened read-only')
+
+    def insert(self, key, value: bytes, replace: bool = False):
+        raise ValueError('Tree is opened read-only')
+
+    def transaction(self):
+        raise ValueError('Tree is opened read-only')
+
+    def __repr__(self):
+        return '<ReadOnlyTree: {} {}>'.format(self._filename, self._tree_conf)
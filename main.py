@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from bplustree import BPlusTree
+from gbplustree import BPlusTree
 
 
 def main():
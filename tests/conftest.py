@@ -1,3 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+
+import pytest
+
 filename = "/tmp/gbplustree-testfile.index"
+
+
+def _remove_files():
+    for path in (filename, filename + '-wal', filename + '-extents',
+                 filename + '-turnstile'):
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+@pytest.fixture
+def clean_file():
+    _remove_files()
+    yield
+    _remove_files()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from unittest import mock
+
+import pytest
+
+from gbplustree.aio import AsyncBPlusTree
+from gbplustree.memory import FileMemory
+
+from .conftest import filename
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_async_insert_get(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4) as tree:
+            await asyncio.gather(*(
+                tree.insert(i, str(i).encode()) for i in range(50)
+            ))
+            assert await tree.get(10) == b'10'
+            assert await tree.get(100) is None
+            assert await tree.contains(49)
+            assert not await tree.contains(50)
+
+    run(main())
+
+
+def test_async_iteration(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4) as tree:
+            for i in range(50):
+                await tree.insert(i, str(i).encode())
+
+            assert [k async for k in tree.keys()] == list(range(50))
+            assert [k async for k in tree.keys(slice(10, 20))] == list(
+                range(10, 20)
+            )
+            assert [v async for v in tree.values(slice(48, None))] == [
+                b'48', b'49'
+            ]
+
+            # 遍历的过程中插入值
+            keys = []
+            async for k, _ in tree.items():
+                keys.append(k)
+                if k == 10:
+                    await tree.insert(1000, b'')
+            assert keys == list(range(50)) + [1000]
+
+    run(main())
+
+
+def test_async_cache_hit_does_not_use_executor(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4) as tree:
+            await tree.insert(1, b'1')
+            with mock.patch.object(tree._executor, 'submit') as submit:
+                assert await tree.get(1) == b'1'
+                assert not submit.called
+
+    run(main())
+
+
+def test_async_concurrent_reads_are_coalesced(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4,
+                                             cache_size=0) as tree:
+            await tree.insert(1, b'1')
+            with mock.patch.object(FileMemory, 'get_node', autospec=True,
+                                   side_effect=FileMemory.get_node) as get_node:
+                results = await asyncio.gather(*(tree.get(1)
+                                                 for _ in range(10)))
+            assert results == [b'1'] * 10
+            # 每个协程都读取同一个根节点，但是只读取了一次
+            assert get_node.call_count == 1
+
+    run(main())
+
+
+def test_async_transaction(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4) as tree:
+            with mock.patch.object(FileMemory, 'commit', autospec=True,
+                                   side_effect=FileMemory.commit) as commit:
+                async with tree.transaction() as txn:
+                    for i in range(50):
+                        await txn.insert(i, str(i).encode())
+                    assert await txn.get(10) == b'10'
+                    await txn.delete_range(40)
+                    await txn.update_many({0: b'zero'})
+            # 整个事务只提交一次
+            assert commit.call_count == 1
+            assert await tree.get(0) == b'zero'
+            assert [k async for k in tree.keys()] == list(range(40))
+
+            with pytest.raises(ValueError):
+                async with tree.transaction() as txn:
+                    await txn.insert(100, b'')
+                    await txn.insert(1, b'')
+            # 出现异常时整个事务被回滚
+            assert not await tree.contains(100)
+            await tree.insert(100, b'')
+            assert await tree.contains(100)
+
+    run(main())
+
+
+def test_async_cancelled_read_blocks_writers_until_loaded(clean_file):
+    async def main():
+        async with await AsyncBPlusTree.open(filename, order=4,
+                                             cache_size=0) as tree:
+            await tree.insert(1, b'old')
+            started, release = asyncio.Event(), asyncio.Event()
+            loop = asyncio.get_running_loop()
+            get_node = FileMemory.get_node
+
+            def slow_get_node(memory, page):
+                # 只有第一次读取 (被取消的读者的读取) 很慢
+                if not started.is_set():
+                    loop.call_soon_threadsafe(started.set)
+                    asyncio.run_coroutine_threadsafe(release.wait(),
+                                                     loop).result()
+                return get_node(memory, page)
+
+            with mock.patch.object(FileMemory, 'get_node', autospec=True,
+                                   side_effect=slow_get_node):
+                reader = asyncio.ensure_future(tree.get(1))
+                await started.wait()
+                reader.cancel()
+                # 被取消的读者留下的读取还在进行，写者需要等待它结束
+                writer = asyncio.ensure_future(tree.insert(1, b'new',
+                                                           replace=True))
+                await asyncio.sleep(0.05)
+                assert not writer.done()
+                release.set()
+                await writer
+            with pytest.raises(asyncio.CancelledError):
+                await reader
+            assert await tree.get(1) == b'new'
+
+    run(main())
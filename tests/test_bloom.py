@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from unittest import mock
+
+import pytest
+
+from gbplustree.bloom import BloomFilter
+from gbplustree.memory import FileMemory
+from gbplustree.tree import BPlusTree
+
+from .conftest import filename
+
+bloom_filename = filename + '-bloom'
+
+
+@pytest.fixture
+def clean_bloom_file(clean_file):
+    if os.path.isfile(bloom_filename):
+        os.unlink(bloom_filename)
+    yield
+    if os.path.isfile(bloom_filename):
+        os.unlink(bloom_filename)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    keys = [str(i).encode() for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    false_positives = sum(str(i).encode() in bloom
+                          for i in range(1000, 11000))
+    assert false_positives < 300
+    assert not bloom.is_full
+
+    copy = BloomFilter(1000, data=bloom.dump())
+    assert copy.count == 1000
+    assert all(key in copy for key in keys)
+
+    with pytest.raises(ValueError):
+        BloomFilter(5000, data=bloom.dump())
+
+
+def test_tree_bloom_filter_skips_leaves(clean_bloom_file):
+    with BPlusTree(filename, order=4, bloom_filter=True) as b:
+        b.insert_many((i, b'') for i in range(0, 1000, 2))
+        b.insert(1001, b'')
+
+        with mock.patch.object(FileMemory, 'get_node', autospec=True,
+                               side_effect=FileMemory.get_node) as get_node:
+            misses = sum(b.get(i) is None for i in range(1, 1000, 2))
+        assert misses == 500
+        # 几乎所有不存在的键都不需要读取节点
+        assert get_node.call_count < 50
+        assert b.get_many([2, 3, 1001]) == [b'', None, b'']
+        assert 1001 in b
+
+    assert os.path.isfile(bloom_filename)
+    with BPlusTree(filename, order=4, bloom_filter=True) as b:
+        # 读取之后文件会被删除，没有正常关闭时下一次会重新创建
+        assert not os.path.isfile(bloom_filename)
+        assert b._bloom.count == 501
+        assert all(i in b for i in range(0, 1000, 2))
+
+
+def test_tree_bloom_filter_grows(clean_bloom_file):
+    with BPlusTree(filename, order=10, bloom_filter=True) as b:
+        for i in range(3000):
+            b.insert(i, b'')
+        assert b._bloom.capacity >= 3000
+        assert all(i in b for i in range(3000))
+
+
+def test_tree_bloom_filter_grows_during_concurrent_inserts(clean_bloom_file):
+    num_threads = 4
+    with BPlusTree(filename, order=10, bloom_filter=True) as b:
+        def writer(start):
+            for i in range(start, 6000, num_threads):
+                b.insert(i, b'')
+
+        threads = [threading.Thread(target=writer, args=(i,))
+                   for i in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # 乐观插入和重新创建过滤器同时进行时，不能漏掉任何一个键
+        assert b._bloom.capacity >= 6000
+        assert [i for i in range(6000) if i not in b] == []
+
+
+
+def test_tree_bloom_filter_counts_only_new_keys(clean_bloom_file):
+    with BPlusTree(filename, order=4, bloom_filter=True) as b:
+        b.insert_many((i, b'') for i in range(100))
+        count = b._bloom.count
+
+        # 覆盖已有的值不会加入过滤器，也不会让过滤器提前被重新创建
+        for _ in range(10):
+            b.update_many((i, b'x') for i in range(100))
+            with b.transaction():
+                for i in range(100):
+                    b.insert(i, b'y', replace=True)
+            b.insert(0, b'z', replace=True)
+        assert b._bloom.count == count
+
+        b.update_many((i, b'') for i in range(95, 105))
+        with b.transaction():
+            b.insert(105, b'')
+        assert b._bloom.count == count + 6
+        assert all(i in b for i in range(106))
+
+def test_tree_without_bloom_filter_removes_stale_file(clean_bloom_file):
+    with BPlusTree(filename, order=4, bloom_filter=True) as b:
+        b.insert(1, b'')
+    with BPlusTree(filename, order=4) as b:
+        b.insert(2, b'')
+    assert not os.path.isfile(bloom_filename)
+
+    with BPlusTree(filename, order=4, bloom_filter=True) as b:
+        assert 2 in b
@@ -3,8 +3,11 @@ import io
 from unittest import mock
 import os
 import platform
+import threading
+import time
 import pytest
 
+from gbplustree import memory
 from gbplustree.memory import (
     FileMemory,
     WAL,
@@ -14,7 +17,9 @@ from gbplustree.memory import (
 )
 from gbplustree.const import (TreeConf)
 from gbplustree.serializer import IntSerializer
+from gbplustree.entry import Record
 from gbplustree.node import LeafNode
+from gbplustree.tree import BPlusTree
 
 from .conftest import filename
 
@@ -23,7 +28,7 @@ tree_conf = TreeConf(4096, 4, 16, 16, IntSerializer())
 node = LeafNode(tree_conf, page=3)
 
 
-def test_file_memory_node():
+def test_file_memory_node(clean_file):
     mem = FileMemory(filename, tree_conf)
 
     with pytest.raises(ReachedEndOfFile):
@@ -35,14 +40,92 @@ def test_file_memory_node():
     mem.close()
 
 
-def test_wal_create_reopen_empty():
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_file_memory_compressed_node(clean_file, compression):
+    mem = FileMemory(filename, tree_conf, compression=compression)
+
+    with pytest.raises(ReachedEndOfFile):
+        mem.get_node(3)
+
+    leaf = LeafNode(tree_conf, page=3)
+    for i in range(3):
+        leaf.insert_entry(Record(tree_conf, i, b'value'))
+    mem.set_node(leaf)
+    mem.commit()
+    mem.close()
+
+    # 压缩后的页远小于 page_size
+    assert os.path.getsize(filename) < tree_conf.page_size // 4
+
+    mem = FileMemory(filename, tree_conf, compression=compression)
+    assert mem.last_page == 3
+    assert mem.get_node(3) == leaf
+    mem.close()
+
+
+def test_file_memory_compressed_last_extent_wins(clean_file):
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    leaf = LeafNode(tree_conf, page=1)
+    mem._write_page_in_tree(1, leaf.dump())
+    leaf.insert_entry(Record(tree_conf, 42, b'42'))
+    mem._write_page_in_tree(1, leaf.dump())
+    mem.close()
+
+    mem = FileMemory(filename, tree_conf, compression='zlib', cache_size=0)
+    assert mem.get_node(1).entries == [Record(tree_conf, 42, b'42')]
+    mem.close()
+
+
+def test_file_memory_compressed_file_size_is_bounded(clean_file):
+    keys = range(2000)
+    with BPlusTree(filename, order=50, compression='zlib') as b:
+        b.insert_many((k, os.urandom(16)) for k in keys)
+        b.checkpoint()
+        size = os.path.getsize(filename)
+        stale_map = open(filename + '-extents', 'rb').read()
+        for _ in range(10):
+            values = {k: os.urandom(16) for k in keys}
+            b.update_many(values)
+            b.checkpoint()
+            # 旧的 extent 在 checkpoint 时被回收，文件不会一直变大
+            assert os.path.getsize(filename) < 3 * size
+        assert b._mem._epoch != stale_map[:memory.EPOCH_BYTES]
+        b.update_many({k: values[k] for k in range(0, 2000, 2)})
+
+    # 打开时从映射文件读取 extent 的位置，不需要扫描整个文件
+    with mock.patch.object(memory, 'read_from_file',
+                           side_effect=memory.read_from_file) as read:
+        b = BPlusTree(filename)
+    assert read.call_count < 10
+    with b:
+        assert b._mem._compression == 'zlib'
+        assert dict(b.items()) == values
+
+    # 压实之前的映射文件和映射文件不存在时都扫描整个文件
+    for stale in (stale_map, None):
+        if stale is None:
+            os.unlink(filename + '-extents')
+        else:
+            with open(filename + '-extents', 'wb') as f:
+                f.write(stale)
+        with BPlusTree(filename) as b:
+            assert dict(b.items()) == values
+
+
+def test_file_memory_unknown_compression(clean_file):
+    with pytest.raises(ValueError):
+        FileMemory(filename, tree_conf, compression='foo')
+
+
+def test_wal_create_reopen_empty(clean_file):
     WAL(filename, 64)
 
     wal = WAL(filename, 64)
     assert wal._page_size == 64
 
 
-def test_write_to_file_multi_times():
+@mock.patch('gbplustree.memory.fsync_file_and_dir')
+def test_write_to_file_multi_times(_):
     def side_effect(*args, **kwargs):
         if len(args) == 1:
             data = args[0]
@@ -82,7 +165,179 @@ def test_open_file_in_dir_on_windows(_):
     assert dir_fd is None
 
 
-def test_file_memory_repr():
+def test_file_memory_repr(clean_file):
     mem = FileMemory(filename, tree_conf)
     assert repr(mem) == '<FileMemory: {}>'.format(filename)
     mem.close()
+
+
+def test_file_memory_concurrent_readers(clean_file):
+    mem = FileMemory(filename, tree_conf)
+    inside = threading.Barrier(2, timeout=5)
+
+    def reader():
+        with mem.read_transaction:
+            # 两个读者必须同时持有读锁才能通过 barrier
+            inside.wait()
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not inside.broken
+
+    mem.close()
+
+
+def test_file_memory_writer_excludes_readers(clean_file):
+    mem = FileMemory(filename, tree_conf)
+    acquired = []
+
+    with mem.write_transaction:
+        t = threading.Thread(target=lambda: acquired.append(
+            mem._lock.reader_lock.acquire(blocking=False)
+        ))
+        t.start()
+        t.join()
+    assert acquired == [False]
+
+    mem.close()
+
+
+def test_file_memory_write_transaction_rollback(clean_file):
+    mem = FileMemory(filename, tree_conf)
+    with pytest.raises(ValueError):
+        with mem.write_transaction:
+            mem.set_node(node)
+            raise ValueError()
+
+    with pytest.raises(ReachedEndOfFile):
+        mem.get_node(3)
+    mem.close()
+
+
+def test_file_memory_latch(clean_file):
+    mem = FileMemory(filename, tree_conf)
+    acquired = []
+
+    def try_exclusive():
+        with mem._latches_lock:
+            lock = mem._latches[3][0]
+        acquired.append(lock.writer_lock.acquire(blocking=False))
+
+    with mem.latch(3, exclusive=True):
+        # 同一个线程可以重复获取
+        with mem.latch(3):
+            pass
+        t = threading.Thread(target=try_exclusive)
+        t.start()
+        t.join()
+
+    assert acquired == [False]
+    assert mem._latches == {}
+    mem.close()
+
+
+def test_file_memory_write_transaction_writes_pages_once(clean_file):
+    mem = FileMemory(filename, tree_conf)
+    with mock.patch('gbplustree.memory.write_to_file',
+                    side_effect=write_to_file) as write:
+        with mem.write_transaction:
+            for page in (5, 2, 5):
+                leaf = LeafNode(tree_conf, page=page)
+                leaf.insert_entry(Record(tree_conf, page, b''))
+                mem.set_node(leaf)
+            # 嵌套的写事务不会单独提交
+            with mem.write_transaction:
+                mem.set_node(LeafNode(tree_conf, page=1))
+            assert write.call_count == 0
+    assert write.call_count == 1
+
+    # 页按照页号排序，同一个页只写入最后一个版本
+    positions = mem._wal._committed_pages
+    assert sorted(positions, key=positions.get) == [1, 2, 5]
+    mem.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'O_DIRECT'), reason='No O_DIRECT')
+def test_file_memory_direct_io(clean_file):
+    with pytest.raises(ValueError):
+        FileMemory(filename, tree_conf, compression='zlib', direct_io=True)
+    with pytest.raises(ValueError):
+        FileMemory(filename, tree_conf._replace(page_size=1000),
+                   direct_io=True)
+
+    try:
+        b = BPlusTree(filename, order=10, cache_size=0, direct_io=True)
+    except ValueError:
+        pytest.skip('The file system does not support O_DIRECT')
+    with b:
+        b.insert_many((k, str(k).encode()) for k in range(1000))
+        b.checkpoint()
+        assert b._mem._direct_fd is not None
+        assert b.get(500) == b'500'
+        assert list(b.keys(slice(10, 20))) == list(range(10, 20))
+
+    with BPlusTree(filename, cache_size=0, direct_io=True) as b:
+        assert list(b.scan(projection='keys')) == list(range(1000))
+        with pytest.raises(ReachedEndOfFile):
+            b._mem._read_page(10000)
+
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'),
+                    reason='No posix_fadvise')
+def test_file_memory_io_hints(clean_file):
+    with mock.patch('gbplustree.memory._fadvise') as fadvise:
+        with BPlusTree(filename, order=10, cache_size=0) as b:
+            advice = [c[0][3] for c in fadvise.call_args_list]
+            assert advice == [os.POSIX_FADV_RANDOM]
+
+            fadvise.reset_mock()
+            b.insert_many((k, b'v') for k in range(2000))
+            advice = [c[0][3] for c in fadvise.call_args_list]
+            assert advice[0] == os.POSIX_FADV_SEQUENTIAL
+            assert advice[-1] == os.POSIX_FADV_RANDOM
+
+            b.checkpoint()
+            fadvise.reset_mock()
+            assert len(list(b.scan(prefetch=2))) == 2000
+            advice = [c[0][3] for c in fadvise.call_args_list]
+            assert os.POSIX_FADV_SEQUENTIAL in advice
+            assert os.POSIX_FADV_WILLNEED in advice
+
+            fadvise.reset_mock()
+            b.delete_range(100, 1900)
+            dropped = [c[0][1:3] for c in fadvise.call_args_list
+                       if c[0][3] == os.POSIX_FADV_DONTNEED]
+            assert dropped
+            assert all(start % 4096 == 0 and length % 4096 == 0
+                       for start, length in dropped)
+
+
+def test_file_memory_group_commit(clean_file):
+    fsync = memory.fsync_file_and_dir
+
+    def slow_fsync(*args):
+        time.sleep(0.005)
+        fsync(*args)
+
+    with BPlusTree(filename, order=60) as b:
+        b.insert_many((k, b'') for k in range(0, 8000, 10))
+        with mock.patch('gbplustree.memory.fsync_file_and_dir',
+                        side_effect=slow_fsync) as fsyncs:
+            def writer(start):
+                for k in range(start + 1, start + 1000, 40):
+                    b.insert(k, b'')
+
+            threads = [threading.Thread(target=writer, args=(i * 1000,))
+                       for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        # 200 次提交，等待 fsync 的提交被合并
+        assert fsyncs.call_count < 150
+        assert len(b) == 1000
+    with BPlusTree(filename, order=60) as b:
+        assert len(b) == 1000
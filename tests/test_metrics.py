@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from gbplustree.metrics import Metrics, Histogram
+
+
+def test_counters_and_timings():
+    m = Metrics()
+    m.incr('pages.read')
+    m.incr('pages.read', 3)
+    m.observe('fsync', 0.5)
+    m.observe('fsync', 1.5)
+    with m.timer('node.load'):
+        pass
+
+    snapshot = m.snapshot()
+    assert snapshot['counters'] == {'pages.read': 4}
+    assert snapshot['timings']['fsync'] == {
+        'count': 2, 'total': 2.0, 'mean': 1.0, 'max': 1.5,
+        'p50': 0.524288, 'p90': 1.5, 'p99': 1.5
+    }
+    assert snapshot['timings']['node.load']['count'] == 1
+
+    m.reset()
+    assert m.snapshot() == {'counters': {}, 'timings': {}}
+
+
+def test_hooks():
+    events = []
+    m = Metrics(hooks=[lambda name, value: events.append((name, value))])
+    m.incr('wal.frames', 2)
+    m.observe('fsync', 0.25)
+    assert events == [('wal.frames', 2), ('fsync', 0.25)]
+
+    m.remove_hook(m._hooks[0])
+    m.incr('wal.frames')
+    assert len(events) == 2
+
+
+def test_histogram_percentiles():
+    h = Histogram()
+    assert h.percentile(99) == 0.0
+    for _ in range(98):
+        h.record(0.000010)
+    h.record(0.001)
+    h.record(0.5)
+    assert h.count == 100
+    assert h.percentile(50) == 16 / 1000000
+    assert h.percentile(99) == 1024 / 1000000
+    assert h.percentile(100) == 0.5
+    h.record(10 ** 9)
+    assert h.buckets[-1] == 1
+
+    merged = Histogram()
+    merged.merge(h)
+    merged.merge(h)
+    assert merged.count == 2 * h.count
+    assert merged.max == h.max
+    assert merged.percentile(50) == h.percentile(50)
+
+
+def test_slow_hook_reports_breakdown():
+    slow = []
+    m = Metrics()
+    m.add_slow_hook(lambda *args: slow.append(args), threshold=0)
+
+    with m.operation('insert'):
+        m.incr('pages.read', 2)
+        with m.operation('commit'):
+            m.observe('fsync', 0.25)
+    m.incr('pages.read')
+
+    assert len(slow) == 1
+    name, seconds, breakdown = slow[0]
+    assert name == 'insert'
+    assert breakdown['counters'] == {'pages.read': 2}
+    assert breakdown['timings']['fsync'] == 0.25
+    assert 'op.commit' in breakdown['timings']
+    assert 'op.insert' not in breakdown['timings']
+    assert m.snapshot()['timings']['op.insert']['count'] == 1
+
+    m.remove_slow_hook(m._slow_hooks[0][1])
+    with m.operation('get'):
+        pass
+    assert len(slow) == 1
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import random
+
 import pytest
 
 from gbplustree.const import ENDIAN, TreeConf
@@ -10,7 +13,9 @@ from gbplustree.node import (
     RootNode,
     InternalNode,
     LeafNode,
+    FreelistNode,
     Node,
+    interpolation_search,
 )
 
 
@@ -72,6 +77,15 @@ def test_leaf_node_serialization_on_next_page():
     assert n1.next_page == n2.next_page
 
 
+def test_leaf_node_serialization_on_prev_page():
+    n1 = LeafNode(tree_conf, next_page=23, prev_page=5)
+    data = n1.dump()
+
+    n2 = LeafNode(tree_conf, data=data)
+    assert n2.next_page == 23
+    assert n2.prev_page == 5
+
+
 def test_root_node_serialization():
     n1 = RootNode(tree_conf)
     n1.insert_entry(Reference(tree_conf, 43, 2, 3))
@@ -155,3 +169,78 @@ def test_smallest_biggest():
 
     assert node.pop_smallest() == r42
     assert node.entries == [r43]
+
+
+def test_split_entries_in_the_middle():
+    node = LeafNode(tree_conf)
+    for i in (5, 1, 3, 2, 4, 0):
+        node.insert_entry(Record(tree_conf, i, b''))
+
+    rv = node.split_entries()
+    assert [e.key for e in node.entries] == [0, 1, 2]
+    assert [e.key for e in rv] == [3, 4, 5]
+
+
+def test_split_entries_after_sequential_inserts():
+    node = LeafNode(tree_conf)
+    for i in range(6):
+        node.insert_entry(Record(tree_conf, i, b''))
+    assert node.append_streak == 6
+
+    rv = node.split_entries()
+    assert [e.key for e in node.entries] == [0, 1, 2, 3, 4]
+    assert [e.key for e in rv] == [5]
+    assert node.append_streak == 0
+
+
+def test_split_reference_entries_after_sequential_inserts():
+    node = InternalNode(tree_conf)
+    for i in range(6):
+        node.insert_entry_at_the_end(Reference(tree_conf, i, i, i + 1))
+
+    rv = node.split_entries()
+    assert len(node.entries) == 4
+    assert len(rv) == 2
+
+
+def test_freelist_node_serialization():
+    n1 = FreelistNode(tree_conf, page=7, next_page=3)
+    n1.entries = list(range(10, 10 + n1.max_children))
+    data = n1.dump()
+
+    n2 = Node.from_page_data(tree_conf, data, page=7)
+    assert isinstance(n2, FreelistNode)
+    assert n2.entries == n1.entries
+    assert n2.next_page == 3
+
+
+@pytest.mark.parametrize('keys', [
+    list(range(0, 3000, 3)),
+    sorted(random.Random(0).sample(range(10 ** 6), 500)),
+    sorted(int(1.05 ** i) for i in range(300)),
+    [5],
+    [],
+])
+def test_interpolation_search_matches_bisect(keys):
+    entries = [Record(tree_conf, k, b'') for k in keys]
+    probes = set(keys) | {-1, 0, 1, 2, 10 ** 7}
+    if keys:
+        probes |= {keys[0] - 1, keys[-1] + 1, keys[len(keys) // 2] + 1}
+    for key in probes:
+        assert (interpolation_search(entries, key)
+                == bisect.bisect_left(keys, key))
+        assert (interpolation_search(entries, key, right=True)
+                == bisect.bisect_right(keys, key))
+
+
+def test_find_index_with_interpolation():
+    conf = TreeConf(4096, 7, 16, 16, IntSerializer(), search='interpolation')
+    node = LeafNode(conf)
+    for i in (30, 10, 20):
+        node.insert_entry(Record(conf, i, b''))
+    assert [e.key for e in node.entries] == [10, 20, 30]
+    assert node.find_index(20) == 1
+    assert node.find_index(20, right=True) == 2
+    assert node.get_entry(30).key == 30
+    with pytest.raises(ValueError):
+        node.get_entry(25)
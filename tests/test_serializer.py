@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from unittest import mock
 import uuid
@@ -11,6 +11,11 @@ from gbplustree.serializer import (
     StrSerializer,
     UUIDSerializer,
     DatetimeUTCSerializer,
+    SignedIntSerializer,
+    FloatSerializer,
+    DatetimeMicrosSerializer,
+    TupleSerializer,
+    serializer_from_id,
 )
 
 
@@ -62,3 +67,113 @@ def test_datetime_utc_serializer_no_timezone():
         s = DatetimeUTCSerializer()
         dt = datetime(2018, 4, 15, 12, 00, 0, 424739)
         s.serialize(dt, 8)
+
+
+@pytest.mark.parametrize('serializer,values', [
+    (SignedIntSerializer(), [-2 ** 63, -300, -1, 0, 1, 255, 2 ** 63 - 1]),
+    (FloatSerializer(), [float('-inf'), -1e300, -2.5, -1e-300, 0.0, 1e-300,
+                         0.5, 3.0, 1e300, float('inf')]),
+    (DatetimeMicrosSerializer(), [
+        datetime(1900, 1, 1, tzinfo=timezone.utc),
+        datetime(1969, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc),
+        datetime(1970, 1, 1, tzinfo=timezone.utc),
+        datetime(2018, 4, 15, 12, 0, 0, 424739, tzinfo=timezone.utc),
+        datetime(2038, 1, 19, 3, 14, 8, tzinfo=timezone.utc),
+    ]),
+])
+def test_fixed_width_serializers_preserve_order(serializer, values):
+    encoded = [serializer.serialize(v, 8) for v in values]
+    assert all(len(data) == 8 for data in encoded)
+    assert encoded == sorted(encoded)
+    assert [serializer.deserialize(data) for data in encoded] == values
+
+    batch = serializer.serialize_many(values)
+    assert batch == b''.join(encoded)
+    assert serializer.deserialize_many(batch) == values
+    assert serializer_from_id(serializer.serializer_id).__class__ is \
+        serializer.__class__
+
+
+def test_fixed_width_serializers_errors():
+    with pytest.raises(ValueError):
+        SignedIntSerializer().serialize(2 ** 63, 8)
+    with pytest.raises(ValueError):
+        SignedIntSerializer().serialize_many([-2 ** 63 - 1])
+    with pytest.raises(ValueError):
+        SignedIntSerializer().serialize(1, 4)
+    with pytest.raises(ValueError):
+        FloatSerializer().serialize(float('nan'), 8)
+    with pytest.raises(ValueError):
+        DatetimeMicrosSerializer().serialize(datetime(2018, 4, 15), 8)
+
+    s = FloatSerializer()
+    assert s.serialize(-0.0, 8) == s.serialize(0.0, 8)
+
+
+def test_datetime_micros_serializer_converts_to_utc():
+    s = DatetimeMicrosSerializer()
+    dt = datetime(2018, 4, 15, 20, 0, tzinfo=timezone(timedelta(hours=8)))
+    rv = s.deserialize(s.serialize(dt, 8))
+    assert rv == dt
+    assert rv.tzinfo is timezone.utc
+
+
+def test_tuple_serializer_preserves_order():
+    s = TupleSerializer(StrSerializer(), SignedIntSerializer(),
+                        IntSerializer(), UUIDSerializer())
+    u = uuid.UUID(int=42)
+    keys = sorted([
+        ('', -5, 0, u),
+        ('a', -5, 3, u),
+        ('a', 0, 1, u),
+        ('a\x00', -7, 0, u),
+        ('a\x00b', 2, 0, u),
+        ('ab', -2 ** 63, 2 ** 64 - 1, u),
+        ('b', 1, 0, uuid.UUID(int=0)),
+        ('\u00e9', 1, 0, u),
+    ])
+    encoded = [s.serialize(k, 64) for k in keys]
+    assert encoded == sorted(encoded)
+    assert [s.deserialize(data) for data in encoded] == keys
+
+
+@pytest.mark.parametrize('second,keys', [
+    (UUIDSerializer(), [uuid.UUID('ff' + '0' * 30), uuid.UUID(int=2 ** 128 - 1),
+                        uuid.UUID(int=0)]),
+    (SignedIntSerializer(), [2 ** 63 - 1, -1, 0]),
+    (FloatSerializer(), [float('inf'), float('-inf'), 1.5]),
+])
+def test_tuple_serializer_field_after_string(second, keys):
+    # 字符串后面的字段以 0xff 开头时，不能被当成字符串中转义的 0x00
+    s = TupleSerializer(StrSerializer(), second)
+    tuples = sorted((prefix, key) for prefix in ('', 'a', 'a\x00', 'tenant')
+                    for key in keys)
+    encoded = [s.serialize(t, 64) for t in tuples]
+    assert encoded == sorted(encoded)
+    assert [s.deserialize(data) for data in encoded] == tuples
+
+
+def test_tuple_serializer_errors():
+    s = TupleSerializer(StrSerializer(), IntSerializer())
+    with pytest.raises(ValueError):
+        s.serialize(('a',), 16)
+    with pytest.raises(ValueError):
+        s.serialize(('a' * 20, 1), 16)
+    with pytest.raises(ValueError):
+        s.serialize(('a', -1), 16)
+    with pytest.raises(ValueError):
+        TupleSerializer()
+    with pytest.raises(ValueError):
+        TupleSerializer(TupleSerializer(IntSerializer()))
+    assert repr(s) == 'TupleSerializer(StrSerializer(), IntSerializer())'
+    with pytest.raises(ValueError):
+        TupleSerializer(*[IntSerializer()] * (TupleSerializer.MAX_FIELDS + 1))
+
+
+def test_tuple_serializer_from_field_ids():
+    s = TupleSerializer(StrSerializer(), SignedIntSerializer())
+    assert s.field_ids == (2, 5)
+    rebuilt = serializer_from_id(s.serializer_id, s.field_ids)
+    assert repr(rebuilt) == repr(s)
+    assert serializer_from_id(s.serializer_id, (2, 0)) is None
+    assert serializer_from_id(s.serializer_id) is None
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import json
+import multiprocessing
+import os
+import random
+import shutil
+
+import pytest
+
+from gbplustree.sharding import ShardedTree, MANIFEST
+from gbplustree.serializer import StrSerializer, TupleSerializer
+
+directory = '/tmp/gbplustree-test-shards'
+
+
+@pytest.fixture
+def clean_directory():
+    shutil.rmtree(directory, ignore_errors=True)
+    yield
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_sharded_tree_routes_by_range(clean_directory):
+    keys = random.Random(0).sample(range(1000), 1000)
+    with ShardedTree(directory, boundaries=[300, 600], order=10) as t:
+        t.insert_many((k, str(k).encode()) for k in keys[:500])
+        for k in keys[500:]:
+            t.insert(k, str(k).encode())
+        assert t.shards == [(None, 300), (300, 600), (600, None)]
+        assert t.shard_for(299) == 0 and t.shard_for(300) == 1
+        assert t.get(750) == b'750'
+        assert t.get(1000) is None
+        assert 5 in t and 1000 not in t
+        assert t.get_many([999, 5, 1000, 300]) == [b'999', b'5', None,
+                                                   b'300']
+        assert len(t) == 1000
+
+    assert sorted(f for f in os.listdir(directory)
+                  if f.endswith('.db')) == [
+        'shard-0000.db', 'shard-0001.db', 'shard-0002.db'
+    ]
+
+    # 打开时使用清单中的边界
+    with ShardedTree(directory, boundaries=[10]) as t:
+        assert t.shards == [(None, 300), (300, 600), (600, None)]
+        assert list(t) == list(range(1000))
+        assert list(t.scan(250, 650, projection='values')) == [
+            str(k).encode() for k in range(250, 650)
+        ]
+        assert t[598:602] == {k: str(k).encode() for k in range(598, 602)}
+        t.delete_range(100, 900)
+        assert list(t) == list(range(100)) + list(range(900, 1000))
+
+
+def test_sharded_tree_split(clean_directory):
+    with ShardedTree(directory, max_shard_keys=1500, order=10) as t:
+        t.insert_many((k, b'v') for k in range(1000))
+        t.split_shard(0, 400)
+        assert t.shards == [(None, 400), (400, None)]
+        with pytest.raises(ValueError):
+            t.split_shard(0, 400)
+
+        # 遍历的过程中分裂分片，不会遗漏或者重复返回键
+        cursor = t.scan(projection='keys')
+        rv = [next(cursor) for _ in range(100)]
+        t.split_shard(0)
+        t.split_shard(2, 700)
+        rv.extend(cursor)
+        assert rv == list(range(1000))
+
+        # 写入足够多的键之后自动分裂
+        t.insert_many((k, b'v') for k in range(1000, 4000))
+        assert len(t.shards) == 5
+        assert list(t) == list(range(4000))
+
+    with ShardedTree(directory) as t:
+        assert len(t.shards) == 5
+        assert len(t) == 4000
+        assert t.shards[1] == (200, 400)
+
+
+def test_sharded_tree_cleans_interrupted_split(clean_directory):
+    with ShardedTree(directory, order=10) as t:
+        t.insert_many((k, b'v') for k in range(100))
+        t.split_shard(0, 50)
+        # 模拟在删除原来的分片中的记录之前崩溃
+        t._shards['shard-0000.db'].insert_many((k, b'x') for k in range(50,
+                                                                       60))
+
+    with ShardedTree(directory) as t:
+        assert t.get(55) == b'v'
+        assert list(t) == list(range(100))
+        assert len(t) == 100
+
+
+def test_sharded_tree_tuple_keys(clean_directory):
+    serializer = TupleSerializer(StrSerializer(), StrSerializer())
+    with ShardedTree(directory, boundaries=[('m', '')], key_size=16,
+                     serializer=serializer, order=10) as t:
+        t.insert_many(((tenant, str(i)), b'v')
+                      for tenant in 'akmz' for i in range(20))
+        assert len(list(t.scan_prefix(('m',)))) == 20
+        assert list(t.scan_prefix(('k', '1'), projection='keys')) == [
+            ('k', '1')
+        ]
+
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+        assert manifest['serializer_id'] == serializer.serializer_id
+        assert manifest['field_ids'] == [2, 2]
+    with ShardedTree(directory, serializer=serializer) as t:
+        assert t.shards[1][0] == ('m', '')
+        assert len(t) == 80
+    # 字段都是内置的 Serializer，不需要再传入
+    with ShardedTree(directory) as t:
+        assert t.shards[1][0] == ('m', '')
+        assert len(t) == 80
+    with pytest.raises(ValueError):
+        ShardedTree(directory, serializer=TupleSerializer(StrSerializer()))
+
+
+def _write_shard(lower):
+    with ShardedTree(directory) as t:
+        t.insert_many((k, b'v') for k in range(lower, lower + 500))
+
+
+def test_sharded_tree_multiple_processes(clean_directory):
+    ShardedTree(directory, boundaries=[500, 1000, 1500]).close()
+    processes = [multiprocessing.Process(target=_write_shard, args=(lower,))
+                 for lower in range(0, 2000, 500)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with ShardedTree(directory) as t:
+        assert list(t) == list(range(2000))
+
+
+def _own_shard(ready, done):
+    with ShardedTree(directory) as t:
+        t.insert_many((k, b'v') for k in range(100))
+        t.checkpoint()
+        t.insert_many((k, b'v') for k in range(100, 150))
+        ready.set()
+        done.wait(10)
+        t.insert_many((k, b'v') for k in range(150, 200))
+
+
+def test_sharded_tree_shard_owned_by_another_process(clean_directory):
+    ShardedTree(directory, boundaries=[1000]).close()
+    ready, done = multiprocessing.Event(), multiprocessing.Event()
+    process = multiprocessing.Process(target=_own_shard, args=(ready, done))
+    process.start()
+    try:
+        assert ready.wait(10)
+        with ShardedTree(directory) as t:
+            # 其他进程拥有的分片只读地打开，只能看到 checkpoint 过的数据，
+            # 不会恢复或者删除它的 WAL
+            assert t.get(5) == b'v' and t.get(120) is None
+            assert list(t) == list(range(100))
+            assert os.path.getsize(
+                os.path.join(directory, 'shard-0000.db-wal')
+            ) > 0
+            with pytest.raises(ValueError):
+                t.insert(7, b'x', replace=True)
+            with pytest.raises(ValueError):
+                t.split_shard(0)
+            t.insert(2000, b'v')
+
+            done.set()
+            process.join(10)
+            assert process.exitcode == 0
+
+            # 拥有者关闭之后可以写入这个分片
+            t.insert(7, b'x', replace=True)
+            assert t.get(7) == b'x'
+            assert len(t) == 201
+    finally:
+        done.set()
+        process.join()
+
+
+def test_sharded_tree_reloads_manifest_before_writing(clean_directory):
+    stale = ShardedTree(directory, order=10)
+    with ShardedTree(directory, order=10) as t:
+        t.insert_many((k, b'v') for k in range(100))
+        t.split_shard(0, 50)
+
+    # 清单在另一个 ShardedTree 中被修改过，写入之前重新读取清单，
+    # 不会把键写入原来的分片，也不会删除分裂出去的记录
+    stale.insert(75, b'x', replace=True)
+    assert stale.shards == [(None, 50), (50, None)]
+    assert stale.get(75) == b'x'
+    assert len(stale) == 100
+    stale.close()
@@ -0,0 +1,1043 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from gbplustree.memory import FileMemory
+from gbplustree.tree import BPlusTree
+from gbplustree.node import LonelyRootNode, LeafNode
+from gbplustree.serializer import (
+    FloatSerializer,
+    IntSerializer,
+    StrSerializer,
+    SignedIntSerializer,
+    TupleSerializer,
+)
+
+from .conftest import filename
+
+
+@pytest.fixture
+def b(clean_file):
+    b = BPlusTree(filename, key_size=16, value_size=16, order=4)
+    yield b
+    b.close()
+
+
+def iter_leaves(tree):
+    node = tree._left_record_node
+    while True:
+        yield node
+        if not node.next_page:
+            return
+        node = tree._mem.get_node(node.next_page)
+
+
+def test_create_and_load_file(clean_file):
+    b = BPlusTree(filename)
+    assert isinstance(b._mem, object)
+    b.insert(5, b'foo')
+    b.close()
+
+    b = BPlusTree(filename)
+    assert b.get(5) == b'foo'
+    b.close()
+
+
+def test_closing_context_manager(clean_file):
+    with BPlusTree(filename, page_size=512, value_size=128,
+                   order=3) as b:
+        pass
+    b.close()
+
+
+def test_insert_get_record_in_tree(b):
+    b.insert(1, b'foo')
+    assert b.get(1) == b'foo'
+    assert b.get(2) is None
+    assert b.get(2, b'bar') == b'bar'
+    assert 1 in b
+    assert 2 not in b
+
+
+def test_insert_existing_key(b):
+    b.insert(1, b'foo')
+    with pytest.raises(ValueError):
+        b.insert(1, b'bar')
+
+    b.insert(1, b'bar', replace=True)
+    assert b[1] == b'bar'
+
+    b[1] = b'baz'
+    assert b[1] == b'baz'
+
+
+def test_insert_value_too_big(b):
+    with pytest.raises(ValueError):
+        b.insert(1, b'x' * 17)
+
+
+def test_getitem_setitem(b):
+    with pytest.raises(KeyError):
+        b[1]
+
+    b[1] = b'foo'
+    assert b[1] == b'foo'
+    assert b[0:2] == {1: b'foo'}
+
+
+@pytest.mark.parametrize('keys', [
+    list(range(100)),
+    list(reversed(range(100))),
+    random.Random(42).sample(range(1000), 100),
+])
+def test_insert_split(clean_file, keys):
+    with BPlusTree(filename, key_size=16, value_size=16, order=4) as b:
+        for k in keys:
+            b.insert(k, str(k).encode())
+
+        assert len(b) == 100
+        assert list(b) == sorted(keys)
+        assert list(b.values()) == [str(k).encode() for k in sorted(keys)]
+
+    with BPlusTree(filename, key_size=16, value_size=16, order=4) as b:
+        for k in keys:
+            assert b[k] == str(k).encode()
+        assert list(b.keys(slice(10, 40))) == [
+            k for k in sorted(keys) if 10 <= k < 40
+        ]
+
+
+def test_sequential_inserts_fill_leaves(clean_file):
+    with BPlusTree(filename, order=10) as b:
+        for k in range(1000):
+            b.insert(k, b'')
+
+        leaves = list(iter_leaves(b))
+        # 除了最右边的叶子节点，其他的叶子节点都是满的
+        for leaf in leaves[:-1]:
+            assert len(leaf.entries) == leaf.max_children
+
+
+def test_random_inserts_split_in_the_middle(clean_file):
+    keys = random.Random(42).sample(range(10000), 1000)
+    with BPlusTree(filename, order=10) as b:
+        for k in keys:
+            b.insert(k, b'')
+
+        leaves = list(iter_leaves(b))
+        assert all(len(leaf.entries) >= leaf.min_children for leaf in leaves)
+        assert any(len(leaf.entries) < leaf.max_children for leaf in leaves)
+
+
+def test_iter_slice(b):
+    with pytest.raises(ValueError):
+        next(b._iter_slice(slice(None, None, 2)))
+
+    with pytest.raises(ValueError):
+        next(b._iter_slice(slice(2, 0)))
+
+    for i in range(10):
+        b.insert(i, str(i).encode())
+
+    assert [r.key for r in b._iter_slice(slice(3, 6))] == [3, 4, 5]
+    assert [r.key for r in b._iter_slice(slice(None, 2))] == [0, 1]
+    assert [r.key for r in b._iter_slice(slice(8, None))] == [8, 9]
+    assert dict(b.items(slice(8, 20))) == {8: b'8', 9: b'9'}
+    with pytest.raises(ValueError):
+        next(b.keys(slice(2, 0)))
+
+
+def test_insert_while_iterating(b):
+    b.insert_many((k, b'even') for k in range(0, 1000, 2))
+    seen = list()
+    for key in b.keys():
+        seen.append(key)
+        if key % 2 == 0:
+            # 插入导致节点分裂，遍历不持有读锁，不会因为不能升级锁而失败
+            b.insert(key + 1, b'odd')
+    assert seen == sorted(set(seen))
+    assert set(range(0, 1000, 2)) <= set(seen)
+    assert len(b) == 1000
+    assert list(b.values(slice(10, 12))) == [b'even', b'odd']
+
+
+def test_left_record_node(b):
+    assert isinstance(b._left_record_node, LonelyRootNode)
+    for i in range(10):
+        b.insert(i, b'')
+    assert isinstance(b._left_record_node, LeafNode)
+    assert b._left_record_node.smallest_key == 0
+
+
+def test_bool(b):
+    assert not b
+    b.insert(1, b'')
+    assert b
+
+
+def test_page_size_too_small(clean_file):
+    with pytest.raises(ValueError):
+        BPlusTree(filename, page_size=512, order=100)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(filename + '-wal')
+
+
+def test_concurrent_readers_and_writer(clean_file):
+    with BPlusTree(filename, order=10) as b:
+        for i in range(0, 1000, 2):
+            b.insert(i, str(i).encode())
+
+        errors = []
+
+        def reader():
+            try:
+                for _ in range(3):
+                    for i in range(0, 1000, 2):
+                        assert b.get(i) == str(i).encode()
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            for i in range(1, 1000, 2):
+                b.insert(i, str(i).encode())
+
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        threads.append(threading.Thread(target=writer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert list(b) == list(range(1000))
+
+
+def test_insert_in_leaf_does_not_lock_the_tree(clean_file):
+    with BPlusTree(filename, order=10) as b:
+        # 倒序插入，叶子节点从中间分裂，都有空闲的位置
+        for i in reversed(range(100)):
+            b.insert(i * 10, b'')
+
+        done = threading.Event()
+
+        def writer():
+            # 插入到一个没有满的叶子节点中，只需要叶子节点的 latch
+            b.insert(5, b'5')
+            done.set()
+
+        with b._mem.read_transaction:
+            t = threading.Thread(target=writer)
+            t.start()
+            assert done.wait(timeout=5)
+            t.join()
+
+        assert b.get(5) == b'5'
+
+
+def test_concurrent_writers_on_disjoint_ranges(clean_file):
+    with BPlusTree(filename, order=10) as b:
+        def writer(start):
+            for i in range(start, start + 300):
+                b.insert(i, str(i).encode())
+
+        threads = [threading.Thread(target=writer, args=(i * 1000,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        expected = [k for i in range(4) for k in range(i * 1000, i * 1000 + 300)]
+        assert list(b) == expected
+        assert all(b[k] == str(k).encode() for k in expected)
+
+    with BPlusTree(filename, order=10) as b:
+        assert list(b) == expected
+
+
+def test_snapshot_does_not_see_later_writes(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(20):
+            b.insert(i, b'old')
+
+        with b.snapshot() as snapshot:
+            # 新的插入会导致很多次分裂，也会修改已有的值
+            for i in range(20, 200):
+                b.insert(i, b'new')
+            b[3] = b'new'
+
+            assert snapshot[3] == b'old'
+            assert 100 not in snapshot
+            assert len(snapshot) == 20
+            assert list(snapshot.values()) == [b'old'] * 20
+
+            with pytest.raises(ValueError):
+                snapshot.insert(300, b'')
+            with pytest.raises(ValueError):
+                snapshot[300] = b''
+
+        assert b[3] == b'new'
+        assert len(b) == 200
+
+
+def test_snapshot_delays_checkpoint(clean_file):
+    b = BPlusTree(filename, order=4)
+    for i in range(20):
+        b.insert(i, b'old')
+
+    snapshot = b.snapshot()
+    assert b.checkpoint() is False
+    for i in range(20):
+        b[i] = b'new'
+    assert b.checkpoint() is False
+    assert snapshot[0] == b'old'
+    assert list(snapshot.values()) == [b'old'] * 20
+
+    with pytest.raises(ValueError):
+        b.close()
+
+    snapshot.close()
+    assert b.checkpoint() is True
+    b.close()
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.values()) == [b'new'] * 20
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_checkpoint_with_open_snapshots(clean_file, compression):
+    b = BPlusTree(filename, order=4, compression=compression)
+    b.insert_many((i, b'old') for i in range(200))
+    first = b.snapshot()
+    for i in range(200):
+        b[i] = b'mid'
+    second = b.snapshot()
+    b.insert_many((i, b'new') for i in range(200, 300))
+
+    # 只写回第一个快照之前提交的页，WAL 中只留下之后的帧
+    wal_size = os.path.getsize(filename + '-wal')
+    assert b.checkpoint() is False
+    assert os.path.getsize(filename + '-wal') < wal_size
+    assert list(first.values()) == [b'old'] * 200
+    assert list(second.values()) == [b'mid'] * 200
+    assert len(b) == 300
+
+    # 第一个快照关闭之后，第二个快照之前的帧也可以写回
+    first.close()
+    wal_size = os.path.getsize(filename + '-wal')
+    assert b.checkpoint() is False
+    assert os.path.getsize(filename + '-wal') < wal_size
+    assert list(second.values()) == [b'mid'] * 200
+
+    # 没有被关闭、也不再被引用的快照不会阻塞 checkpoint
+    del second
+    gc.collect()
+    assert b.checkpoint() is True
+    b.close()
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.values()) == [b'mid'] * 200 + [b'new'] * 100
+
+
+def test_scan(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in reversed(range(200)):
+            b.insert(i, str(i).encode())
+
+        assert list(b.scan(projection='keys')) == list(range(200))
+        assert list(b.scan(10, 20)) == [(i, str(i).encode())
+                                        for i in range(10, 20)]
+        assert list(b.scan(198, projection='values')) == [b'198', b'199']
+        assert list(b.scan(end=3, projection='keys', prefetch=1)) == [0, 1, 2]
+        assert list(b.scan(500, projection='keys')) == []
+
+        with pytest.raises(ValueError):
+            b.scan(projection='foo')
+        with pytest.raises(ValueError):
+            b.scan(20, 10)
+
+
+def test_scan_seek_and_resume(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(0, 200, 2):
+            b.insert(i, b'')
+
+        cursor = b.scan(projection='keys')
+        assert [next(cursor) for _ in range(3)] == [0, 2, 4]
+        assert cursor.position == 4
+
+        resumed = b.scan(after=cursor.position, projection='keys')
+        assert next(resumed) == 6
+
+        cursor.seek(101)
+        assert next(cursor) == 102
+        cursor.close()
+        assert list(cursor) == []
+
+
+def test_scan_sees_splits_during_iteration(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(0, 100, 2):
+            b.insert(i, b'')
+
+        keys = []
+        for key in b.scan(projection='keys', prefetch=2):
+            keys.append(key)
+            if key == 20:
+                # 插入会让后面的叶子节点分裂
+                for i in range(21, 60, 2):
+                    b.insert(i, b'')
+        # 不会重复也不会遗漏遍历开始之前就存在的键
+        assert keys == sorted(set(keys))
+        assert set(range(0, 100, 2)) <= set(keys)
+        assert 59 in keys
+
+
+def test_scan_does_not_fill_the_cache(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(200):
+            b.insert(i, b'')
+        b.checkpoint()
+        b._mem._cache.clear()
+
+        assert len(list(b.scan())) == 200
+        cached = [node for node in b._mem._cache.values()
+                  if isinstance(node, LeafNode)]
+        assert cached == []
+
+
+@pytest.mark.parametrize('keys', [
+    list(range(200)),
+    list(reversed(range(200))),
+    random.Random(7).sample(range(200), 200),
+])
+def test_prev_page_links_after_splits(clean_file, keys):
+    with BPlusTree(filename, order=4) as b:
+        for i in keys:
+            b.insert(i, b'')
+
+        leaves = list(iter_leaves(b))
+        assert leaves[0].prev_page is None
+        for left, right in zip(leaves, leaves[1:]):
+            assert right.prev_page == left.page
+
+
+def test_reverse_scan(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(200):
+            b.insert(i, str(i).encode())
+
+        assert list(b.scan(projection='keys', reverse=True)) == \
+            list(reversed(range(200)))
+        assert list(b.scan(10, 20, reverse=True)) == [
+            (i, str(i).encode()) for i in reversed(range(10, 20))
+        ]
+        assert list(b.scan(end=2, projection='values', reverse=True)) == \
+            [b'1', b'0']
+        assert list(b.scan(end=0, reverse=True)) == []
+
+        # 最新的 N 条记录
+        cursor = b.scan(projection='keys', reverse=True)
+        assert [next(cursor) for _ in range(3)] == [199, 198, 197]
+        resumed = b.scan(after=cursor.position, projection='keys',
+                         reverse=True)
+        assert next(resumed) == 196
+        cursor.seek(100)
+        assert next(cursor) == 100
+        cursor.close()
+        assert list(cursor) == []
+
+
+def test_reverse_scan_sees_splits_during_iteration(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(0, 100, 2):
+            b.insert(i, b'')
+
+        keys = []
+        for key in b.scan(projection='keys', reverse=True):
+            keys.append(key)
+            if key == 80:
+                for i in range(21, 60, 2):
+                    b.insert(i, b'')
+        assert keys == sorted(set(keys), reverse=True)
+        assert set(range(0, 100, 2)) <= set(keys)
+        assert 59 in keys
+
+
+def test_get_many(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(0, 200, 2):
+            b.insert(i, str(i).encode())
+
+        keys = [150, 3, 0, 198, 150, 500, 41, 42]
+        assert b.get_many(keys) == [b.get(key) for key in keys]
+        assert b.get_many([1, 2], default=b'') == [b'', b'2']
+        assert b.get_many([]) == []
+
+
+def test_get_many_reads_each_node_once(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        for i in range(200):
+            b.insert(i, b'')
+
+        with mock.patch.object(FileMemory, 'get_node', autospec=True,
+                               side_effect=FileMemory.get_node) as get_node:
+            b.get_many(range(200))
+        pages = [call[0][1] for call in get_node.call_args_list]
+        assert len(pages) == len(set(pages))
+        assert len(pages) >= len(list(iter_leaves(b)))
+
+
+def test_transaction(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        with b.transaction():
+            for i in range(100):
+                b.insert(i, str(i).encode())
+            # 事务中可以读到还没有提交的修改
+            assert b.get(42) == b'42'
+        assert b._mem._dirty_pages == {}
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.keys()) == list(range(100))
+
+
+def test_transaction_rollback(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        b.insert(0, b'0')
+        with pytest.raises(ValueError):
+            with b.transaction():
+                for i in range(1, 100):
+                    b.insert(i, b'')
+                b.insert(0, b'duplicate')
+
+        assert list(b.items()) == [(0, b'0')]
+        b.insert(1, b'1')
+        assert list(b.keys()) == [0, 1]
+
+
+def test_oversized_key_is_rejected_before_writing(clean_file):
+    with BPlusTree(filename, key_size=8, order=4,
+                   serializer=StrSerializer()) as b:
+        b.insert_many((k, b'v') for k in 'abc')
+        with pytest.raises(ValueError):
+            b.insert('zzzzzzzzzzzzzzzz', b'x')
+        assert list(b.keys()) == ['a', 'b', 'c']
+        b.insert('d', b'v')
+        assert b.get('d') == b'v'
+
+
+def test_failed_commit_reloads_root(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        b.insert_many((i, b'v') for i in range(3))
+        root = b._root_node_page
+        # 插入第 4 个键时根节点分裂，提交失败之后回滚到原来的根节点
+        with mock.patch('gbplustree.memory.WAL.commit_pages',
+                        side_effect=OSError('disk full')):
+            with pytest.raises(OSError):
+                b.insert(3, b'v')
+            with pytest.raises(OSError):
+                b.insert_many((i, b'v') for i in range(3, 10))
+        assert b._root_node_page == root
+        assert list(b.keys()) == [0, 1, 2]
+        assert b.get(3) is None
+
+        b.insert_many((i, b'v') for i in range(3, 10))
+        assert list(b.keys()) == list(range(10))
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.keys()) == list(range(10))
+
+
+@pytest.mark.parametrize('existing, batch', [
+    ([], list(range(500))),
+    (list(range(0, 500, 2)), list(range(1, 500, 2))),
+    (list(range(100)), list(range(100, 600))),
+    ([], random.Random(3).sample(range(5000), 500)),
+])
+def test_insert_many(clean_file, existing, batch):
+    with BPlusTree(filename, order=4) as b:
+        for i in existing:
+            b.insert(i, b'old')
+        b.insert_many((i, str(i).encode()) for i in batch)
+
+        assert list(b.keys()) == sorted(existing + batch)
+        assert b.get(batch[0]) == str(batch[0]).encode()
+        leaves = list(iter_leaves(b))
+        assert all(0 < len(leaf.entries) <= leaf.max_children
+                   for leaf in leaves)
+        for left, right in zip(leaves, leaves[1:]):
+            assert right.prev_page == left.page
+            assert left.biggest_key < right.smallest_key
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.keys()) == sorted(existing + batch)
+
+
+def test_insert_many_duplicate_rolls_back(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        b.insert(250, b'old')
+        with pytest.raises(ValueError):
+            b.insert_many({i: b'' for i in range(500)})
+        assert list(b.items()) == [(250, b'old')]
+
+        b.update_many({i: b'new' for i in range(500)})
+        assert len(b) == 500
+        assert b[250] == b'new'
+
+
+@pytest.mark.parametrize('start, end', [
+    (None, None),
+    (None, 150),
+    (150, None),
+    (100, 900),
+    (401, 405),
+    (-10, 5000),
+])
+def test_delete_range(clean_file, start, end):
+    keys = list(range(0, 1000, 2))
+    expected = [k for k in keys if not (
+        (start is None or k >= start) and (end is None or k < end)
+    )]
+    with BPlusTree(filename, order=4) as b:
+        b.insert_many((k, b'') for k in random.Random(5).sample(keys, 500))
+        b.delete_range(start, end)
+
+        assert list(b.keys()) == expected
+        assert list(b.scan(projection='keys', reverse=True)) == \
+            expected[::-1]
+        leaves = list(iter_leaves(b))
+        for left, right in zip(leaves, leaves[1:]):
+            assert right.prev_page == left.page
+            assert len(left.entries) >= left.min_children
+
+        b.insert_many((k, b'') for k in range(1, 1000, 2))
+        assert len(b) == len(expected) + 500
+
+    with BPlusTree(filename, order=4) as b:
+        assert len(b) == len(expected) + 500
+
+
+def test_delete_range_does_not_read_covered_leaves(clean_file):
+    with BPlusTree(filename, order=10) as b:
+        b.insert_many((i, b'') for i in range(3000))
+        b.checkpoint()
+        b._mem._cache.clear()
+        num_leaves = len(list(iter_leaves(b)))
+        b._mem._cache.clear()
+
+        with mock.patch.object(FileMemory, '_read_page', autospec=True,
+                               side_effect=FileMemory._read_page) as read:
+            b.delete_range(100, 2900)
+        # 只读取了两端的路径和内部节点，没有读取被删除的叶子节点
+        assert read.call_count < num_leaves / 4
+        assert list(b.keys()) == list(range(100)) + list(range(2900, 3000))
+
+
+def test_delete_range_reuses_freed_pages(clean_file):
+    with BPlusTree(filename, order=4) as b:
+        b.insert_many((i, b'') for i in range(1000))
+        last_page = b._mem.last_page
+
+        b.delete_range(0, 900)
+        assert b._mem._freelist_start_page
+        b.insert_many((i, b'') for i in range(900))
+        # 叶子节点的填充率可能和之前不同，但是大部分的页都被重新使用了
+        assert b._mem.last_page - last_page < 10
+
+    with BPlusTree(filename, order=4) as b:
+        assert list(b.keys()) == list(range(1000))
+
+
+def test_delete_range_backwards(b):
+    with pytest.raises(ValueError):
+        b.delete_range(10, 5)
+
+
+def check_subtree_counts(tree, page) -> int:
+    """ 检查内部节点中保存的个数，返回子树中记录的个数 """
+    node = tree._mem.get_node(page)
+    if isinstance(node, (LonelyRootNode, LeafNode)):
+        return len(node.entries)
+    for child, count in zip(node.children_pages, node.children_counts):
+        assert check_subtree_counts(tree, child) == count
+    return node.total_count
+
+
+def test_order_statistics(clean_file):
+    keys = random.Random(11).sample(range(10000), 800)
+    with BPlusTree(filename, order=4, order_statistics=True) as b:
+        for key in keys[:400]:
+            b.insert(key, b'')
+        b.insert_many((key, b'') for key in keys[400:])
+        b.delete_range(2000, 4000)
+        expected = sorted(k for k in keys if not 2000 <= k < 4000)
+
+        assert check_subtree_counts(b, b._root_node_page) == len(expected)
+        assert len(b) == len(expected)
+        assert b.rank(-1) == 0
+        assert b.rank(expected[10]) == 10
+        assert b.rank(expected[10] + 1) == 11
+        assert b.rank(20000) == len(expected)
+        assert [b.select(k) for k in (0, 100, -1)] == \
+            [expected[0], expected[100], expected[-1]]
+        with pytest.raises(IndexError):
+            b.select(len(expected))
+
+        sample = b.sample(50, rng=random.Random(0))
+        assert len(set(sample)) == 50
+        assert set(sample) <= set(expected)
+
+    # 打开已有的树时使用文件中保存的设置
+    with BPlusTree(filename, order=4) as b:
+        assert b._tree_conf.order_statistics
+        assert len(b) == len(expected)
+
+
+def test_rank_and_select_without_order_statistics(b):
+    for i in range(0, 100, 2):
+        b.insert(i, b'')
+    assert b.rank(11) == 6
+    assert b.select(5) == 10
+    assert sorted(b.sample(50)) == list(range(0, 100, 2))
+
+
+def test_interpolation_search(clean_file):
+    keys = random.Random(1).sample(range(10 ** 6), 2000)
+    with BPlusTree(filename, order=60, search='interpolation') as b:
+        for key in keys:
+            b.insert(key, str(key).encode())
+        for key in keys[:200]:
+            assert b.get(key) == str(key).encode()
+        assert b.get(-1) is None
+        assert list(b.keys(slice(1000, 5000))) == sorted(
+            k for k in keys if 1000 <= k < 5000
+        )
+
+    with pytest.raises(ValueError):
+        BPlusTree(filename, search='learned')
+
+
+def test_interpolation_search_float_keys(clean_file):
+    with BPlusTree(filename, order=60, serializer=FloatSerializer(),
+                   search='interpolation') as b:
+        for i in range(500):
+            b.insert(i / 2, str(i).encode())
+        assert b.get(3) == b'6'
+        assert b.get(3.25) is None
+        assert list(b.keys(slice(2, 4))) == [2.0, 2.5, 3.0, 3.5]
+
+
+def test_stats(clean_file):
+    events = []
+    with BPlusTree(filename, order=4, cache_size=8, metrics=True) as b:
+        b.metrics.add_hook(lambda name, value: events.append(name))
+        for i in range(100):
+            b.insert(i, b'foo')
+        for i in range(100):
+            b.get(i)
+
+        stats = b.stats()
+        counters = stats['counters']
+        assert counters['split.level.0'] > counters['split.level.1'] > 0
+        assert counters['cache.hit.LeafNode'] > 0
+        assert counters['cache.miss.LeafNode'] > 0
+        assert counters['wal.frames'] > 0
+        assert counters['wal.bytes'] > 0
+        assert stats['timings']['fsync']['count'] > 0
+        assert stats['timings']['node.dump']['count'] > 0
+        assert 'fsync' in events
+
+        levels = stats['levels']
+        assert stats['height'] == len(levels) == b.stats(False)['height']
+        assert levels[0]['entries'] == 100
+        assert levels[-1]['nodes'] == 1
+        assert all(0 < level['fill_factor'] <= 1 for level in levels)
+
+
+def test_stats_without_metrics(b):
+    b.insert(1, b'foo')
+    assert b.metrics is None
+    stats = b.stats()
+    assert stats['counters'] == {}
+    assert stats['height'] == 1
+    assert stats['levels'] == [{'nodes': 1, 'entries': 1,
+                                'fill_factor': 1 / 3}]
+
+
+def test_slow_operation_tracing(clean_file):
+    slow = []
+    with BPlusTree(filename, order=4, cache_size=0, metrics=True) as b:
+        for i in range(50):
+            b.insert(i, b'foo')
+        b.metrics.add_slow_hook(lambda *args: slow.append(args), threshold=0)
+        b.get(25)
+        b.insert(100, b'bar')
+        list(b.scan(10, 20))
+
+        timings = b.stats()['timings']
+        for name in ('op.get', 'op.insert', 'op.commit', 'op.scan_step'):
+            assert timings[name]['p99'] >= timings[name]['p50'] > 0
+
+    names = [name for name, _, _ in slow]
+    assert names[:2] == ['get', 'insert']
+    assert 'scan_step' in names
+    get_breakdown = slow[0][2]
+    assert get_breakdown['counters']['pages.read'] > 0
+    assert get_breakdown['counters']['cache.miss.LeafNode'] == 1
+    insert_breakdown = slow[1][2]
+    assert insert_breakdown['timings']['fsync'] > 0
+    assert insert_breakdown['timings']['wal.write'] > 0
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_open_existing_tree_from_metadata(clean_file, compression):
+    with BPlusTree(filename, page_size=8192, order=100, key_size=20,
+                   serializer=StrSerializer(),
+                   compression=compression) as b:
+        b.insert('foo', b'bar')
+    b = BPlusTree(filename, compression=compression)
+    b.checkpoint()
+    b.close()
+
+    with BPlusTree(filename, compression=compression) as b:
+        conf = b._tree_conf
+        assert (conf.page_size, conf.order, conf.key_size) == (8192, 100, 20)
+        assert isinstance(conf.serializer, StrSerializer)
+        assert b.get('foo') == b'bar'
+
+    with pytest.raises(ValueError):
+        BPlusTree(filename, serializer=IntSerializer(),
+                  compression=compression)
+
+
+def test_open_by_filename_uses_file_header(clean_file):
+    with BPlusTree(filename, page_size=8192, order=100,
+                   compression='zlib') as b:
+        b.insert_many((k, b'v') for k in range(100))
+
+    # 压缩算法和页大小都从文件中读取，只检查文件中保存的参数
+    with BPlusTree(filename, order=100) as b:
+        assert b._mem._compression == 'zlib'
+        assert b._tree_conf.page_size == 8192
+        assert len(b) == 100
+
+    with pytest.raises(ValueError):
+        BPlusTree(filename, compression='lzma')
+    assert not os.path.exists(filename + '-wal')
+
+
+@pytest.mark.parametrize('data', [
+    # 没有文件头的旧格式: 根节点在第 1 页，页大小 4096
+    (1).to_bytes(4, 'little') + (4096).to_bytes(4, 'little') + bytes(4088),
+    b'GBPT' + (99).to_bytes(4, 'little') + bytes(4088),
+    b'GBPT' + (1).to_bytes(4, 'little') + (7).to_bytes(4, 'little')
+    + bytes(4084),
+    b'GBP',
+])
+def test_open_rejects_unknown_files(clean_file, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        BPlusTree(filename)
+    with pytest.raises(ValueError):
+        BPlusTree.open_read_only(filename)
+    # 在解析任何节点之前失败，不会创建 WAL，也不会修改文件
+    assert not os.path.exists(filename + '-wal')
+    with open(filename, 'rb') as f:
+        assert f.read() == data
+
+
+def test_import_does_not_load_optional_dependencies():
+    code = ('import sys, gbplustree; '
+            'print(sorted({"cachetools", "rwlock", "temporenc", "lzma", '
+            '"hashlib"} & set(sys.modules)))')
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE).stdout
+    assert output.strip() == b'[]'
+
+
+def test_signed_int_keys(clean_file):
+    keys = random.Random(2).sample(range(-10 ** 6, 10 ** 6), 500)
+    with BPlusTree(filename, order=10,
+                   serializer=SignedIntSerializer()) as b:
+        b.insert_many((k, b'v') for k in keys)
+
+    with BPlusTree(filename) as b:
+        assert list(b.keys(slice(-1000, 1000))) == sorted(
+            k for k in keys if -1000 <= k < 1000
+        )
+        assert list(b.keys()) == sorted(keys)
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_scan_prefix(clean_file, reverse):
+    serializer = TupleSerializer(StrSerializer(), IntSerializer())
+    keys = [(tenant, i) for tenant in ('a', 'ab', 'b', 'c') for i in range(300)]
+    random.Random(3).shuffle(keys)
+    with BPlusTree(filename, order=10, key_size=16,
+                   serializer=serializer) as b:
+        b.insert_many((k, str(k[1]).encode()) for k in keys)
+
+    with BPlusTree(filename, serializer=serializer) as b:
+        expected = [('b', i) for i in range(300)]
+        if reverse:
+            expected.reverse()
+        rv = list(b.scan_prefix(('b',), projection='keys', reverse=reverse))
+        assert rv == expected
+        assert list(b.scan_prefix(('ab', 7))) == [(('ab', 7), b'7')]
+        assert list(b.scan_prefix(('aa',))) == []
+        assert len(list(b.scan_prefix(()))) == len(keys)
+        with pytest.raises(ValueError):
+            b.scan_prefix('b')
+
+
+def test_tuple_serializer_layout_is_stored(clean_file):
+    serializer = TupleSerializer(StrSerializer(), IntSerializer())
+    with BPlusTree(filename, key_size=16, serializer=serializer) as b:
+        b.insert(('a', 1), b'v')
+
+    # 字段都是内置的 Serializer 时不需要再传入
+    with BPlusTree(filename) as b:
+        assert b.get(('a', 1)) == b'v'
+    with BPlusTree.open_read_only(filename) as b:
+        assert list(b.keys()) == [('a', 1)]
+    for other in (IntSerializer(),
+                  TupleSerializer(IntSerializer(), StrSerializer()),
+                  TupleSerializer(StrSerializer())):
+        with pytest.raises(ValueError):
+            BPlusTree(filename, serializer=other)
+    with BPlusTree(filename, serializer=serializer) as b:
+        assert b.get(('a', 1)) == b'v'
+
+
+def test_tuple_serializer_with_custom_field_needs_serializer(clean_file):
+    class Custom(SignedIntSerializer):
+        __slots__ = []
+        serializer_id = 0
+
+    serializer = TupleSerializer(StrSerializer(), Custom())
+    with BPlusTree(filename, key_size=16, serializer=serializer) as b:
+        b.insert(('a', -1), b'v')
+    with pytest.raises(ValueError):
+        BPlusTree(filename)
+    with BPlusTree(filename, serializer=serializer) as b:
+        assert b.get(('a', -1)) == b'v'
+
+
+def _read_only_get(key):
+    with BPlusTree.open_read_only(filename) as b:
+        return b.get(key)
+
+
+def test_open_read_only(clean_file):
+    with BPlusTree(filename, order=10, serializer=SignedIntSerializer()) as b:
+        b.insert_many((k, str(k).encode()) for k in range(-100, 100))
+
+    with BPlusTree.open_read_only(filename) as b:
+        assert b.get(-5) == b'-5'
+        assert list(b.keys(slice(-3, 3))) == list(range(-3, 3))
+        assert len(b) == 200
+        assert list(b.scan(95, projection='keys')) == list(range(95, 100))
+        for write in (lambda: b.insert(500, b'v'),
+                      lambda: b.insert_many([(500, b'v')]),
+                      lambda: b.delete_range(0, 10), b.checkpoint):
+            with pytest.raises(ValueError):
+                write()
+    assert not os.path.exists(filename + '-wal')
+
+    with multiprocessing.Pool(2) as pool:
+        assert pool.map(_read_only_get, [-100, 0, 99, 100]) == [
+            b'-100', b'0', b'99', None
+        ]
+
+
+def _poll_read_only(key):
+    # 不停地读取，直到看到打开之后才写入的键
+    deadline = time.monotonic() + 30
+    with BPlusTree.open_read_only(filename) as b:
+        while time.monotonic() < deadline:
+            if b.get(key) is not None:
+                return b.get(key)
+            assert b.get(0) == b'v'
+    return None
+
+
+def test_read_only_readers_do_not_starve_checkpoints(clean_file):
+    with BPlusTree(filename, order=10) as writer:
+        writer.insert_many((k, b'v') for k in range(100))
+        writer.checkpoint()
+
+        with multiprocessing.Pool(4) as pool:
+            result = pool.map_async(_poll_read_only, [1000] * 4)
+            # 读者打开树时创建 turnstile 文件
+            while not os.path.exists(filename + '-turnstile'):
+                time.sleep(0.01)
+            # 读者一直在读取时，每次 checkpoint 都会成功
+            for i in range(100, 150):
+                writer.insert(i, b'v')
+                assert writer.checkpoint() is True
+            # WAL 没有因为推迟的 checkpoint 而变大
+            assert os.path.getsize(filename + '-wal') < 4096
+            writer.insert(1000, b'new')
+            assert writer.checkpoint() is True
+            assert result.get(timeout=60) == [b'new'] * 4
+
+
+def test_read_only_rejects_compressed_tree(clean_file):
+    with BPlusTree(filename, order=10, compression='zlib') as b:
+        b.insert_many((k, b'v') for k in range(100))
+    with pytest.raises(ValueError, match='compressed'):
+        BPlusTree.open_read_only(filename)
+
+
+def test_read_only_sees_checkpoints_in_place(clean_file):
+    with BPlusTree(filename, order=10) as writer:
+        writer.insert_many((k, b'old') for k in range(100))
+        writer.checkpoint()
+
+        with BPlusTree.open_read_only(filename) as reader:
+            assert reader.get(5) == b'old'
+            stat = os.stat(filename)
+            # 原地覆盖已有的页，文件大小不变，粗粒度的修改时间也可能不变
+            writer.update_many((k, b'new') for k in range(100))
+            assert writer.checkpoint() is True
+            os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            assert os.path.getsize(filename) == stat.st_size
+            assert reader.get(5) == b'new'
+            assert list(reader.values()) == [b'new'] * 100
+
+
+def test_read_only_sees_checkpoints(clean_file):
+    with BPlusTree(filename, order=10) as writer:
+        writer.insert_many((k, b'v') for k in range(100))
+        writer.checkpoint()
+
+        reader = BPlusTree.open_read_only(filename)
+        keys = reader.keys()
+        assert next(keys) == 0
+
+        # 遍历只在读取每一批叶子节点时持有锁，checkpoint 不会被推迟，
+        # 剩下的遍历从新的文件中继续读取
+        writer.insert_many((k, b'v') for k in range(100, 200))
+        assert writer.checkpoint() is True
+        assert list(keys) == list(range(1, 200))
+
+        writer.insert_many((k, b'v') for k in range(200, 1000))
+        assert len(reader) == 200
+        cursor = reader.scan(projection='keys')
+        assert [next(cursor) for _ in range(50)] == list(range(50))
+        assert writer.checkpoint() is True
+        assert list(cursor) == list(range(50, 1000))
+        assert reader.get(999) == b'v'
+        assert len(reader) == 1000
+        reader.close()